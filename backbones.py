@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Backbone Registry
+可選擇的特徵提取骨幹網路與延遲/準確率比較
+
+每個骨幹網路記錄建構函數、ImageNet 權重、輸出維度與預處理參數。建立索引時使用的骨幹網路
+與預處理會寫入索引中繼資料，載入索引時自動切換，查詢特徵永遠與建立時一致。
+
+比較目前資料集上各骨幹網路的每張圖片提取時間、索引大小與留一法 top-1 準確率：
+    python backbones.py --compare --dataset dataset
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from torchvision import transforms, models
+
+from model_weights import resolve as resolve_weights, load_state_dict, registry_entry, verify
+
+DEFAULT_BACKBONE = os.environ.get('FAISS_BACKBONE', 'resnet50')
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+# 名稱 -> (torchvision 建構函數, 權重列舉類別, 權重版本, 特徵維度)
+BACKBONES = {
+    'resnet50': ('resnet50', 'ResNet50_Weights', 'IMAGENET1K_V1', 2048),
+    'resnet18': ('resnet18', 'ResNet18_Weights', 'IMAGENET1K_V1', 512),
+    'mobilenet_v3_large': ('mobilenet_v3_large', 'MobileNet_V3_Large_Weights', 'IMAGENET1K_V1', 960),
+    'mobilenet_v3_small': ('mobilenet_v3_small', 'MobileNet_V3_Small_Weights', 'IMAGENET1K_V1', 576),
+    'efficientnet_b0': ('efficientnet_b0', 'EfficientNet_B0_Weights', 'IMAGENET1K_V1', 1280),
+}
+INPUT_SIZE = 224
+
+# 舊版索引沒有記錄骨幹網路，皆為 ResNet50
+LEGACY_BACKBONE = 'resnet50'
+
+
+def backbone_spec(name=None):
+    """
+    骨幹網路與預處理設定（寫入索引中繼資料）
+
+    Returns:
+        {'name', 'weights', 'dim', 'input_size', 'mean', 'std'}
+    """
+    name = name or DEFAULT_BACKBONE
+    if name not in BACKBONES:
+        raise ValueError(f"不支援的骨幹網路: {name}（可用: {', '.join(BACKBONES)}）")
+    _, _, weights, dim = BACKBONES[name]
+    return {'name': name, 'weights': weights, 'dim': dim, 'input_size': INPUT_SIZE,
+            'mean': IMAGENET_MEAN, 'std': IMAGENET_STD}
+
+
+def make_transform(spec):
+    """依設定建立預處理轉換"""
+    size = spec['input_size']
+    return transforms.Compose([
+        transforms.Resize((size, size)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=spec['mean'], std=spec['std'])
+    ])
+
+
+def feature_namespace(spec):
+    """特徵快取命名空間：骨幹網路 + 權重 + 輸入尺寸，例如 'resnet50_imagenet1k_v1_r224'"""
+    return f"{spec['name']}_{spec['weights'].lower()}_r{spec['input_size']}"
+
+
+def export_key(spec):
+    """
+    匯出模型（TorchScript / ONNX）的檔名鍵：特徵命名空間 + 權重雜湊
+
+    權重目錄中的檔案以其 SHA-256 識別（檔案被取代時鍵隨之改變）；線上下載的 torchvision 權重以
+    官方檔名中的雜湊前綴識別。鍵不同時重新匯出，不會沿用以舊權重匯出的模型。
+    """
+    path = resolve_weights(spec['name'])
+    digest = verify(path) if path is not None else registry_entry(spec['name'])[2]
+    return f"{feature_namespace(spec)}_{(digest or 'unknown')[:12]}"
+
+
+def build_backbone(name):
+    """
+    建立去掉分類層的骨幹網路（輸出 N×D×1×1，eval 模式）
+
+    權重從權重目錄（model_weights.py）讀取；目錄中沒有時報錯（MODEL_WEIGHTS_ALLOW_DOWNLOAD=1 時退回 torchvision 下載）。
+    """
+    builder, weights_enum, weights, _ = BACKBONES[name]
+    path = resolve_weights(name)
+    if path is not None:
+        # 權重目錄中的本機檔案（記憶體映射，不連網）
+        model = getattr(models, builder)(weights=None)
+        model.load_state_dict(load_state_dict(path), assign=True)
+    else:
+        try:
+            # 新版 API (torchvision >= 0.13)
+            model = getattr(models, builder)(weights=getattr(models, weights_enum)[weights])
+        except (ImportError, AttributeError):
+            # 降級到舊版 API
+            model = getattr(models, builder)(pretrained=True)
+
+    if name.startswith('resnet'):
+        model = nn.Sequential(*list(model.children())[:-1])
+    else:
+        # MobileNetV3 / EfficientNet：卷積特徵 + 全域平均池化
+        model = nn.Sequential(model.features, model.avgpool)
+    return model.eval()
+
+
+def compare_backbones(names=None, dataset_dir='dataset', n_timing=64, batch_size=32):
+    """
+    在資料集上比較各骨幹網路
+
+    Returns:
+        每個骨幹網路一筆 {'backbone', 'dim', 'ms_per_image', 'index_mb', 'loo_top1'}
+    """
+    from faiss_recognition import FAISSRecognitionEngine, list_class_images, loo_top1_accuracy
+
+    classes = sorted(d for d in os.listdir(dataset_dir) if os.path.isdir(os.path.join(dataset_dir, d)))
+    image_paths, class_ids = [], []
+    for class_id, class_name in enumerate(classes):
+        images = list_class_images(os.path.join(dataset_dir, class_name))
+        image_paths.extend(os.path.join(dataset_dir, class_name, f) for f in images)
+        class_ids.extend([class_id] * len(images))
+    if not image_paths:
+        print("❌ 資料集中沒有圖片")
+        return []
+    class_ids = np.asarray(class_ids)
+    timing_paths = image_paths[::max(1, len(image_paths) // n_timing)][:n_timing]
+
+    results = []
+    for name in names or BACKBONES:
+        print(f"\n🧪 {name}")
+        engine = FAISSRecognitionEngine(backbone=name)
+        engine.load_feature_extractor()
+
+        # 計時：預處理 + 前向傳播（不使用快取）
+        tensors = torch.stack([engine._preprocess(p) for p in timing_paths])
+        engine.extract_features_batch(tensors[:1])  # 預熱
+        start = time.time()
+        for i in range(0, len(tensors), batch_size):
+            engine.extract_features_batch(tensors[i:i + batch_size])
+        ms_per_image = (time.time() - start) * 1000 / len(tensors)
+
+        # 準確率：提取全部圖片（使用該骨幹網路的特徵快取）
+        features, valid = engine._extract_paths(image_paths, batch_size)
+        results.append({
+            'backbone': name,
+            'dim': int(features.shape[1]),
+            'ms_per_image': round(ms_per_image, 2),
+            'index_mb': round(features.nbytes / (1024 * 1024), 2),
+            'loo_top1': round(loo_top1_accuracy(features, class_ids[valid]), 4)
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="特徵提取骨幹網路比較")
+    parser.add_argument('--compare', action='store_true', help='比較各骨幹網路的延遲、索引大小與準確率')
+    parser.add_argument('--backbones', nargs='+', choices=list(BACKBONES), default=None, help='要比較的骨幹網路')
+    parser.add_argument('--dataset', default='dataset', help='資料集目錄')
+    parser.add_argument('--json', default=None, help='另存結果為 JSON 檔')
+    args = parser.parse_args()
+
+    if not args.compare:
+        parser.print_help()
+        raise SystemExit(0)
+
+    report = compare_backbones(args.backbones, args.dataset)
+    print(f"\n{'骨幹網路':<20}{'維度':>6}{'ms/張':>10}{'索引 MB':>10}{'LOO top-1':>12}")
+    for row in report:
+        print(f"{row['backbone']:<20}{row['dim']:>6}{row['ms_per_image']:>10.2f}{row['index_mb']:>10.2f}{row['loo_top1']:>12.1%}")
+    if args.json:
+        import json
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 結果已儲存: {args.json}")
@@ -7,8 +7,9 @@ Search Blueprint - CLIP + FAISS 圖像相似性搜尋
 """
 
 from flask import Blueprint, render_template, request, jsonify
-from pathlib import Path
 import os
+import time
+import threading
 from werkzeug.utils import secure_filename
 import logging
 
@@ -27,6 +28,9 @@ os.makedirs(SEARCH_UPLOAD_FOLDER, exist_ok=True)
 
 # 全域搜尋引擎實例
 search_engine = None
+_engine_lock = threading.Lock()
+# 載入失敗的版本目錄：發布的版本改變前不再重試（避免每個請求都在鎖內重新載入）
+_failed_index_dir = None
 
 
 def allowed_file(filename):
@@ -35,29 +39,50 @@ def allowed_file(filename):
 
 
 def init_search_engine():
-    """初始化 CLIP + FAISS 搜尋引擎"""
-    global search_engine
+    """
+    初始化 CLIP + FAISS 搜尋引擎
 
-    if search_engine is not None:
-        return search_engine
+    每次請求比對 CLIP_INDEX_ROOT 目前發布的版本，版本改變（例如另外執行 clip_feature_extractor.py）時
+    重新載入；新版本載入失敗時繼續使用舊版本，且在發布的版本再次改變前不重試。
+    """
+    global search_engine, _failed_index_dir
 
+    index_dir = None
     try:
-        from clip_faiss_search import CLIPFAISSSearch
-
-        # 檢查索引檔案是否存在
-        if not Path('clip_features.npy').exists():
-            logger.warning("⚠️ CLIP 特徵索引不存在，請先執行 clip_feature_extractor.py")
-            return None
-
-        logger.info("🚀 初始化 CLIP + FAISS 搜尋引擎...")
-        search_engine = CLIPFAISSSearch()
-        logger.info("✅ 搜尋引擎初始化成功！")
+        from clip_faiss_search import CLIPFAISSSearch, artifact_exists, published_index_dir
+
+        index_dir = published_index_dir()
+        if search_engine is not None and search_engine.index_dir == index_dir or index_dir == _failed_index_dir:
+            return search_engine
+
+        with _engine_lock:
+            if search_engine is not None and search_engine.index_dir == index_dir or index_dir == _failed_index_dir:
+                return search_engine
+
+            # 檢查索引是否存在（提取特徵時已發布的版本，或舊版工作目錄下的特徵檔）
+            if not artifact_exists():
+                logger.warning("⚠️ CLIP 特徵索引不存在，請先執行 clip_feature_extractor.py")
+                return search_engine
+
+            if search_engine is None:
+                logger.info("🚀 初始化 CLIP + FAISS 搜尋引擎...")
+            else:
+                logger.info(f"🔄 偵測到新的 CLIP 索引版本，重新載入: {index_dir}")
+            start_time = time.time()
+            # 直接載入已發布的索引（記憶體映射），CLIP 模型在第一次查詢時才載入
+            engine = CLIPFAISSSearch(index_dir=str(index_dir))
+            if search_engine is not None:
+                engine.reuse_model(search_engine)
+            search_engine = engine
+            _failed_index_dir = None
+            logger.info(f"✅ 搜尋引擎初始化成功！({(time.time() - start_time) * 1000:.0f} ms)")
 
         return search_engine
 
     except Exception as e:
+        _failed_index_dir = index_dir
         logger.error(f"❌ 搜尋引擎初始化失敗: {e}")
-        return None
+        return search_engine
 
 
 @search_bp.route('/search')
@@ -205,6 +230,69 @@ def api_search_by_text():
         }), 500
 
 
+@search_bp.route('/api/search/classes', methods=['POST'])
+def api_search_classes():
+    """
+    API: 類別層級文字搜尋（零樣本，每個類別一筆結果）
+
+    POST /api/search/classes
+    JSON:
+        - text: 搜尋文字
+        - k: 返回類別數量 (預設 5)
+        - drill_down: 每個類別列出的圖片數 (預設 1)
+        - class_name: 指定時改為只在該類別的圖片中搜尋 (可選)
+    """
+    engine = init_search_engine()
+    if engine is None:
+        return jsonify({
+            'success': False,
+            'error': 'CLIP 搜尋引擎未初始化，請先建立索引'
+        }), 500
+
+    data = request.get_json()
+
+    if not data or not str(data.get('text', '')).strip():
+        return jsonify({
+            'success': False,
+            'error': '未提供搜尋文字'
+        }), 400
+
+    text = data['text']
+    k = int(data.get('k', 5))
+    drill_down = int(data.get('drill_down', 1))
+    class_name = data.get('class_name')
+
+    try:
+        if class_name:
+            # 展開單一類別
+            results = engine.search_in_class(text, class_name, k=k)
+            for result in results:
+                result['image_url'] = '/' + result['image_path']
+        else:
+            results = engine.search_classes(text, k=k, drill_down=drill_down)
+            for result in results:
+                for image in result.get('images', []):
+                    image['image_url'] = '/' + image['image_path']
+                # 以最相似的圖片作為類別代表圖
+                if result.get('images'):
+                    result['image_url'] = result['images'][0]['image_url']
+
+        return jsonify({
+            'success': True,
+            'query_text': text,
+            'class_name': class_name,
+            'results': results,
+            'total': len(results)
+        })
+
+    except Exception as e:
+        logger.error(f"❌ 類別文字搜尋失敗: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
 @search_bp.route('/api/search/hybrid', methods=['POST'])
 def api_search_hybrid():
     """
@@ -294,14 +382,11 @@ def api_rebuild_index():
         # 建立索引
         success = extractor.build_dataset_index(
             dataset_dir="dataset",
-            output_dir=".",
             batch_size=32
         )
 
         if success:
-            # 重新初始化搜尋引擎
-            global search_engine
-            search_engine = None
+            # 載入新發布的版本（沿用已載入的 CLIP 模型）
             init_search_engine()
 
             return jsonify({
@@ -8,6 +8,13 @@ CLIP 特徵 + FAISS 索引的圖像相似性搜尋引擎
 3. 混合搜尋 (Hybrid Search)
 """
 
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+from collections import OrderedDict
 import numpy as np
 import faiss
 import pickle
@@ -17,35 +24,346 @@ import logging
 from PIL import Image
 
 from clip_feature_extractor import CLIPFeatureExtractor
+from feature_cache import FeatureCache
+from faiss_index_factory import make_index_config, create_index, read_index, DEFAULT_MMAP
+from index_store import CLIP_INDEX_ROOT, current_index_dir, begin_version, abort_version, publish
 
 # 設定日誌
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 版本目錄內的檔案
+FEATURE_FILE = "clip_features.npy"
+LABEL_FILE = "clip_labels.pkl"
+PATH_FILE = "clip_paths.pkl"
+INDEX_FILE = "clip_faiss.index"
+META_FILE = "clip_meta.json"
+CLASS_FILE = "clip_classes.npz"
+
+# 類別層級（零樣本）文字搜尋：每個類別以類別名稱與 class_names.json 顯示名稱套用提示模板，
+# 文字特徵平均後與類別圖片特徵中心一起存成 C×D 小矩陣
+CLASS_NAMES_FILE = os.environ.get('CLASS_NAMES_FILE', 'class_names.json')
+PROMPT_TEMPLATES = (
+    "a photo of {}.",
+    "a product photo of {}.",
+    "a 3D rendering of {}.",
+    "a close-up photo of the {} jewelry.",
+)
+# 類別分數 = (1 - w) × 文字提示相似度 + w × 圖片特徵中心相似度
+CLASS_CENTROID_WEIGHT = float(os.environ.get('CLIP_CLASS_CENTROID_WEIGHT', 0.5))
+
+# 文字查詢特徵快取：記憶體 LRU 容量；設定目錄時另存磁碟層（重啟後仍可命中）
+TEXT_CACHE_SIZE = int(os.environ.get('CLIP_TEXT_CACHE_SIZE', 1024))
+TEXT_CACHE_DIR = os.environ.get('CLIP_TEXT_CACHE_DIR', '')
+# 磁碟層批次寫入：累積的新特徵達到筆數或距上次寫入超過秒數時才寫入（結束時寫入剩餘的）
+TEXT_CACHE_FLUSH_SIZE = int(os.environ.get('CLIP_TEXT_CACHE_FLUSH_SIZE', 32))
+TEXT_CACHE_FLUSH_SECONDS = float(os.environ.get('CLIP_TEXT_CACHE_FLUSH_SECONDS', 30))
+
+
+def load_display_names(path: str = CLASS_NAMES_FILE) -> Dict[str, str]:
+    """讀取 class_names.json（{'<類別>.stl': 顯示名稱}），回傳 {類別: 顯示名稱}"""
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            names = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠️ 讀取類別顯示名稱失敗 {path}: {e}")
+        return {}
+    return {os.path.splitext(key)[0]: value for key, value in names.items() if value}
+
+
+def class_prompts(class_name: str, display_name: str = None) -> List[str]:
+    """類別的提示文字：類別名稱與顯示名稱（不同時）各套用所有模板"""
+    names = [class_name] if not display_name or display_name == class_name else [class_name, display_name]
+    return [template.format(name) for name in names for template in PROMPT_TEMPLATES]
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return (matrix / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def class_centroids(features: np.ndarray, labels: List[str], classes: List[str]) -> np.ndarray:
+    """各類別圖片特徵的正規化平均（C×D）"""
+    class_ids = {name: i for i, name in enumerate(classes)}
+    ids = np.fromiter((class_ids[label] for label in labels), dtype=np.int64, count=len(labels))
+    sums = np.zeros((len(classes), features.shape[1]), dtype=np.float64)
+    for start in range(0, len(features), 65536):
+        np.add.at(sums, ids[start:start + 65536], np.asarray(features[start:start + 65536], dtype=np.float64))
+    return _normalize_rows(sums)
+
+
+def class_text_embeddings(extractor, classes: List[str], display_names: Dict[str, str]) -> np.ndarray:
+    """各類別提示文字特徵的正規化平均（C×D）"""
+    prompts, owners = [], []
+    for i, class_name in enumerate(classes):
+        for prompt in class_prompts(class_name, display_names.get(class_name)):
+            prompts.append(prompt)
+            owners.append(i)
+    embeddings = extractor.extract_batch_text_features(prompts)
+    sums = np.zeros((len(classes), embeddings.shape[1]), dtype=np.float64)
+    np.add.at(sums, np.asarray(owners), embeddings)
+    return _normalize_rows(sums)
+
+
+def publish_artifact(features, labels, paths, model_name, index_type=None, root=CLIP_INDEX_ROOT,
+                     extractor=None, display_names=None):
+    """
+    建立 FAISS 索引，連同特徵、標籤、路徑與中繼資料原子發布為新版本（提取特徵時呼叫一次）
+
+    提供 extractor 時另外預先計算類別層級的提示文字特徵與圖片特徵中心（clip_classes.npz）。
+
+    Args:
+        features: 特徵矩陣，或串流建立好的 .npy 特徵檔路徑（直接移入版本目錄，不再複製一份）
+
+    Returns:
+        新版本目錄
+    """
+    staging = begin_version(root)
+    try:
+        feature_path = os.path.join(staging, FEATURE_FILE)
+        if isinstance(features, (str, Path)):
+            os.replace(features, feature_path)
+            features = np.load(feature_path, mmap_mode='r')
+        else:
+            features = np.ascontiguousarray(features, dtype=np.float32)
+            np.save(feature_path, features)
+
+        index_config = make_index_config(index_type)
+        index = create_index(index_config, features.shape[1], features)
+        index.add(features)
+
+        class_counts = {}
+        for label in labels:
+            class_counts[label] = class_counts.get(label, 0) + 1
+
+        if extractor is not None:
+            classes = sorted(class_counts)
+            if display_names is None:
+                display_names = load_display_names()
+            np.savez(os.path.join(staging, CLASS_FILE),
+                     classes=np.array(classes),
+                     display_names=np.array([display_names.get(name, name) for name in classes]),
+                     text=class_text_embeddings(extractor, classes, display_names),
+                     centroids=class_centroids(features, labels, classes))
+
+        with open(os.path.join(staging, LABEL_FILE), 'wb') as f:
+            pickle.dump(list(labels), f)
+        with open(os.path.join(staging, PATH_FILE), 'wb') as f:
+            pickle.dump([str(p) for p in paths], f)
+        faiss.write_index(index, os.path.join(staging, INDEX_FILE))
+        with open(os.path.join(staging, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump({
+                'model_name': model_name,
+                'index_config': index_config,
+                'num_vectors': int(len(features)),
+                'feature_dim': int(features.shape[1]),
+                'class_counts': class_counts,
+                'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
+            }, f, ensure_ascii=False, indent=2)
+        del features
+        version = publish(staging, root)
+    except Exception:
+        abort_version(staging)
+        raise
+    logger.info(f"💾 CLIP 索引已發布為版本 {version} ({index_config['type']}, {len(labels)} 個向量)")
+    return os.path.join(root, version)
+
+
+class TextEmbeddingCache:
+    """
+    CLIP 文字特徵的 LRU 快取（鍵：模型名稱 + 正規化文字），可選磁碟層
+
+    磁碟層可由多個工作行程共用：新特徵先暫存在記憶體，批次在跨行程鎖內重新讀取鍵表後追加寫入；
+    查詢未命中時重新讀取其他行程已寫入的鍵表。
+    """
+
+    def __init__(self, model_name: str, capacity: int = TEXT_CACHE_SIZE, cache_dir: str = TEXT_CACHE_DIR):
+        """
+        Args:
+            model_name: CLIP 模型名稱（不同模型的文字特徵不共用）
+            capacity: 記憶體中保留的查詢數（0 表示停用記憶體層）
+            cache_dir: 磁碟層目錄（空字串表示停用；不要與圖片特徵快取共用目錄，其垃圾回收會清除文字項目）
+        """
+        self.model_name = model_name
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = FeatureCache(f"clip_text_{model_name}", cache_dir) if cache_dir else None
+        self._disk_lock = threading.Lock()
+        self._pending = {}  # 尚未寫入磁碟層的 {磁碟鍵: 特徵}
+        self._last_flush = time.time()
+        self._flush_at_exit = False
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """正規化查詢文字（CLIP tokenizer 本身即轉小寫並合併空白，正規化前後的特徵相同）"""
+        return ' '.join(text.split()).lower()
+
+    def _disk_key(self, text: str) -> bytes:
+        return hashlib.blake2b(f"{self.model_name}\0{text}".encode('utf-8'), digest_size=16).digest()
+
+    def get(self, text: str, compute) -> np.ndarray:
+        """
+        取得文字特徵；記憶體與磁碟都未命中時呼叫 compute(正規化文字) 計算並寫入快取
+
+        Returns:
+            唯讀的特徵向量，compute 失敗時為 None
+        """
+        key = self.normalize(text)
+        with self._lock:
+            features = self._entries.get(key)
+            if features is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return features
+
+        if self._disk is not None:
+            features = self._disk_get(self._disk_key(key))
+            if features is not None:
+                with self._lock:
+                    self.disk_hits += 1
+
+        if features is None:
+            # 模型推論不持有鎖，其他查詢可同時命中快取
+            features = compute(key)
+            if features is None:
+                return None
+            features = np.asarray(features, dtype=np.float32)
+            with self._lock:
+                self.misses += 1
+            if self._disk is not None:
+                self._disk_put(self._disk_key(key), features)
+
+        features.flags.writeable = False
+        with self._lock:
+            if self.capacity > 0:
+                self._entries[key] = features
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.capacity:
+                    self._entries.popitem(last=False)
+        return features
+
+    def _disk_get(self, disk_key: bytes):
+        """從磁碟層（含尚未寫入的暫存）讀取；未命中時重新讀取其他行程更新過的鍵表再找一次"""
+        with self._disk_lock:
+            features = self._pending.get(disk_key)
+            if features is not None:
+                return features
+            row = self._disk.find([disk_key])[0]
+            if row < 0 and self._disk.refresh():
+                row = self._disk.find([disk_key])[0]
+            return self._disk.read([row])[0] if row >= 0 else None
+
+    def _disk_put(self, disk_key: bytes, features: np.ndarray):
+        """暫存新特徵，累積足夠筆數或時間後批次寫入"""
+        with self._disk_lock:
+            self._pending[disk_key] = features
+            if not self._flush_at_exit:
+                atexit.register(self.flush)
+                self._flush_at_exit = True
+            if (len(self._pending) >= TEXT_CACHE_FLUSH_SIZE
+                    or time.time() - self._last_flush >= TEXT_CACHE_FLUSH_SECONDS):
+                self._flush_pending()
+
+    def _flush_pending(self):
+        """在跨行程鎖內重新讀取鍵表後追加暫存的特徵（呼叫端持有 _disk_lock）"""
+        if not self._pending:
+            return
+        keys = list(self._pending)
+        try:
+            with self._disk.locked():
+                self._disk.refresh()
+                self._disk.put(keys, np.stack([self._pending[k] for k in keys]))
+                self._disk.save()
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ 文字特徵快取寫入失敗: {e}")
+        self._pending.clear()
+        self._last_flush = time.time()
+
+    def flush(self):
+        """將暫存的新特徵寫入磁碟層"""
+        if self._disk is None:
+            return
+        with self._disk_lock:
+            self._flush_pending()
+
+    def stats(self) -> Dict:
+        """快取命中統計"""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'disk_entries': len(self._disk) if self._disk is not None else None,
+                'disk_pending': len(self._pending)
+            }
+
+
+def published_index_dir(root=CLIP_INDEX_ROOT) -> Path:
+    """目前發布版本的目錄（尚未發布時為舊版檔案所在的工作目錄）"""
+    return Path(current_index_dir(root))
+
+
+def artifact_exists(root=CLIP_INDEX_ROOT):
+    """是否已有發布的 CLIP 索引（或舊版工作目錄下的特徵檔）"""
+    return (published_index_dir(root) / FEATURE_FILE).exists()
+
 
 class CLIPFAISSSearch:
     """CLIP + FAISS 搜尋引擎"""
 
-    def __init__(self, feature_file: str = "clip_features.npy",
-                 label_file: str = "clip_labels.pkl",
-                 path_file: str = "clip_paths.pkl",
-                 model_name: str = "ViT-B/32"):
+    def __init__(self, feature_file: str = FEATURE_FILE,
+                 label_file: str = LABEL_FILE,
+                 path_file: str = PATH_FILE,
+                 model_name: str = "ViT-B/32",
+                 index_type: str = None,
+                 index_file: str = INDEX_FILE,
+                 mmap: bool = DEFAULT_MMAP,
+                 index_dir: str = None):
         """
         初始化搜尋引擎
 
         Args:
-            feature_file: CLIP 特徵檔案
+            feature_file: CLIP 特徵檔案（相對於 index_dir）
             label_file: 標籤檔案
             path_file: 路徑檔案
-            model_name: CLIP 模型名稱
+            model_name: CLIP 模型名稱（索引中繼資料有記錄時以記錄為準）
+            index_type: FAISS 索引類型 (flat / ivf_flat / ivf_pq / hnsw)；指定時重新建立，不沿用已儲存的索引
+            index_file: 已儲存的 FAISS 索引（比特徵檔新且數量一致時直接載入，不重新建立）
+            mmap: 以唯讀記憶體映射載入特徵與索引（多個工作行程共用同一份 page cache）
+            index_dir: 索引版本目錄（預設為 CLIP_INDEX_ROOT 目前發布的版本，尚未發布時為工作目錄下的舊版檔案）
         """
-        self.feature_file = Path(feature_file)
-        self.label_file = Path(label_file)
-        self.path_file = Path(path_file)
-
-        # 初始化 CLIP 模型
-        logger.info("🚀 初始化 CLIP 模型...")
-        self.extractor = CLIPFeatureExtractor(model_name=model_name)
+        start_time = time.time()
+        self.index_dir = Path(index_dir) if index_dir is not None else published_index_dir()
+        self.feature_file = self.index_dir / feature_file
+        self.label_file = self.index_dir / label_file
+        self.path_file = self.index_dir / path_file
+        self.index_file = self.index_dir / index_file if index_file else None
+        self.meta = self._load_meta()
+        self.model_name = self.meta.get('model_name', model_name)
+        self.index_config = (self.meta['index_config'] if index_type is None and 'index_config' in self.meta
+                             else make_index_config(index_type))
+        self.mmap = mmap
+        # 明確指定索引類型時一律重新建立，不沿用已儲存的索引
+        self._reuse_index = index_type is None
+
+        # CLIP 模型在第一次提取查詢特徵時才載入（統計與頁面載入不需要模型）
+        self._extractor = None
+        self._extractor_lock = threading.Lock()
+        # 重複的文字查詢只需 FAISS 搜尋，不重新 tokenize / encode_text（命中磁碟層時也不載入模型）
+        self.text_cache = TextEmbeddingCache(self.model_name)
+        # 類別層級矩陣（第一次類別搜尋時載入）
+        self._class_index = None
+        self._class_lock = threading.Lock()
 
         # 載入特徵和標籤
         self.features = None
@@ -54,7 +372,38 @@ class CLIPFAISSSearch:
         self.index = None
 
         self._load_features()
-        self._build_faiss_index()
+        if not self._load_saved_index():
+            self._build_faiss_index()
+        logger.info(f"✅ CLIP 搜尋引擎就緒: {self.index_dir} ({(time.time() - start_time) * 1000:.0f} ms)")
+
+    @property
+    def extractor(self) -> CLIPFeatureExtractor:
+        """CLIP 特徵提取器（延遲載入）"""
+        if self._extractor is None:
+            with self._extractor_lock:
+                if self._extractor is None:
+                    logger.info("🚀 初始化 CLIP 模型...")
+                    self._extractor = CLIPFeatureExtractor(model_name=self.model_name)
+        return self._extractor
+
+    def reuse_model(self, other: 'CLIPFAISSSearch'):
+        """沿用另一個引擎（例如切換版本前的舊引擎）已載入的 CLIP 模型與文字特徵快取（模型相同時）"""
+        if other.model_name != self.model_name:
+            return
+        self._extractor = other._extractor
+        self.text_cache = other.text_cache
+
+    def _text_features(self, text: str) -> np.ndarray:
+        """文字查詢特徵（經由 LRU 快取）"""
+        return self.text_cache.get(text, lambda key: self.extractor.extract_text_features(key))
+
+    def _load_meta(self) -> Dict:
+        """讀取版本中繼資料（舊版檔案沒有中繼資料時回傳空 dict）"""
+        meta_file = self.index_dir / META_FILE
+        if not meta_file.exists():
+            return {}
+        with open(meta_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
 
     def _load_features(self):
         """載入 CLIP 特徵和標籤"""
@@ -62,7 +411,7 @@ class CLIPFAISSSearch:
             raise FileNotFoundError(f"找不到特徵檔案: {self.feature_file}")
 
         logger.info(f"📂 載入特徵: {self.feature_file}")
-        self.features = np.load(self.feature_file)
+        self.features = np.load(self.feature_file, mmap_mode='r' if self.mmap else None)
 
         logger.info(f"📂 載入標籤: {self.label_file}")
         with open(self.label_file, 'rb') as f:
@@ -81,12 +430,45 @@ class CLIPFAISSSearch:
         # 使用 Inner Product (IP) 索引，因為 CLIP 特徵已經過 L2 正規化
         # IP 索引在正規化向量上等同於餘弦相似度
         d = self.features.shape[1]  # 特徵維度
-        self.index = faiss.IndexFlatIP(d)
+        features = np.ascontiguousarray(self.features, dtype='float32')  # 已是 float32 時不複製
+        self.index = create_index(self.index_config, d, features)
 
         # 添加特徵向量
-        self.index.add(self.features.astype('float32'))
+        self.index.add(features)
+
+        logger.info(f"✅ FAISS 索引建立完成！類型: {self.index_config['type']}, 總數: {self.index.ntotal}")
+
+    def _load_saved_index(self) -> bool:
+        """載入已儲存的索引（需比特徵檔新且向量數一致），成功回傳 True"""
+        if not self._reuse_index or self.index_file is None or not self.index_file.exists():
+            return False
+        if self.index_file.stat().st_mtime < self.feature_file.stat().st_mtime:
+            logger.info(f"🔄 特徵檔已更新，重新建立索引: {self.index_file}")
+            return False
 
-        logger.info(f"✅ FAISS 索引建立完成！總數: {self.index.ntotal}")
+        index, mmapped = read_index(str(self.index_file), self.mmap)
+        if index.ntotal != len(self.features):
+            logger.info(f"🔄 索引向量數 ({index.ntotal}) 與特徵數 ({len(self.features)}) 不一致，重新建立索引")
+            return False
+
+        self.index = index
+        logger.info(f"📂 FAISS 索引已載入: {self.index_file} ({'記憶體映射' if mmapped else '完整讀入'})")
+        return True
+
+    def _format_results(self, distances: np.ndarray, indices: np.ndarray) -> List[Dict]:
+        """整理搜尋結果；IVF / HNSW 找到的結果少於 k 個時以 -1 補位，略過這些項目"""
+        results = []
+        for dist, idx in zip(distances, indices):
+            if idx < 0:
+                continue
+            results.append({
+                'rank': len(results) + 1,
+                'class_name': self.labels[idx],
+                'image_path': self.paths[idx],
+                'similarity': float(dist),  # 餘弦相似度 (0-1)
+                'confidence': float(dist * 100)  # 百分比
+            })
+        return results
 
     def search_by_image(self, image_path: Union[str, Path], k: int = 5) -> List[Dict]:
         """
@@ -111,18 +493,7 @@ class CLIPFAISSSearch:
         query_features = query_features.reshape(1, -1).astype('float32')
         distances, indices = self.index.search(query_features, k)
 
-        # 整理結果
-        results = []
-        for i, (dist, idx) in enumerate(zip(distances[0], indices[0])):
-            results.append({
-                'rank': i + 1,
-                'class_name': self.labels[idx],
-                'image_path': self.paths[idx],
-                'similarity': float(dist),  # 餘弦相似度 (0-1)
-                'confidence': float(dist * 100)  # 百分比
-            })
-
-        return results
+        return self._format_results(distances[0], indices[0])
 
     def search_by_text(self, text: str, k: int = 5) -> List[Dict]:
         """
@@ -138,7 +509,7 @@ class CLIPFAISSSearch:
         logger.info(f"🔍 文字搜尋: {text}")
 
         # 提取文字的 CLIP 特徵
-        query_features = self.extractor.extract_text_features(text)
+        query_features = self._text_features(text)
 
         if query_features is None:
             return []
@@ -147,18 +518,7 @@ class CLIPFAISSSearch:
         query_features = query_features.reshape(1, -1).astype('float32')
         distances, indices = self.index.search(query_features, k)
 
-        # 整理結果
-        results = []
-        for i, (dist, idx) in enumerate(zip(distances[0], indices[0])):
-            results.append({
-                'rank': i + 1,
-                'class_name': self.labels[idx],
-                'image_path': self.paths[idx],
-                'similarity': float(dist),
-                'confidence': float(dist * 100)
-            })
-
-        return results
+        return self._format_results(distances[0], indices[0])
 
     def search_hybrid(self, image_path: Union[str, Path] = None,
                      text: str = None, k: int = 5,
@@ -191,7 +551,7 @@ class CLIPFAISSSearch:
 
         # 提取文字特徵
         if text is not None:
-            text_features = self.extractor.extract_text_features(text)
+            text_features = self._text_features(text)
             if text_features is not None:
                 if query_features is None:
                     query_features = text_features * (1 - image_weight)
@@ -208,47 +568,158 @@ class CLIPFAISSSearch:
         query_features = query_features.reshape(1, -1).astype('float32')
         distances, indices = self.index.search(query_features, k)
 
-        # 整理結果
+        return self._format_results(distances[0], indices[0])
+
+    def _load_class_index(self) -> Dict:
+        """
+        類別層級矩陣：讀取建立時預先計算的 clip_classes.npz；
+        舊版索引沒有此檔案時在第一次使用時計算（需載入 CLIP 模型）
+        """
+        if self._class_index is not None:
+            return self._class_index
+        with self._class_lock:
+            if self._class_index is not None:
+                return self._class_index
+
+            class_file = self.index_dir / CLASS_FILE
+            if class_file.exists():
+                with np.load(class_file) as data:
+                    classes = [str(name) for name in data['classes']]
+                    display_names = [str(name) for name in data['display_names']]
+                    text, centroids = data['text'], data['centroids']
+            else:
+                logger.info("🔨 計算類別提示文字特徵與圖片特徵中心...")
+                classes = sorted(set(self.labels))
+                names = load_display_names()
+                display_names = [names.get(name, name) for name in classes]
+                text = class_text_embeddings(self.extractor, classes, names)
+                centroids = class_centroids(self.features, self.labels, classes)
+
+            # 各類別的圖片列索引（展開類別內圖片時使用）
+            label_ids = np.unique(np.asarray(self.labels), return_inverse=True)
+            order = np.argsort(label_ids[1], kind='stable')
+            bounds = np.cumsum(np.bincount(label_ids[1], minlength=len(label_ids[0])))[:-1]
+            rows = dict(zip(label_ids[0].tolist(), np.split(order, bounds)))
+
+            self._class_index = {
+                'classes': classes,
+                'display_names': display_names,
+                'text': np.ascontiguousarray(text, dtype=np.float32),
+                'centroids': np.ascontiguousarray(centroids, dtype=np.float32),
+                'rows': rows
+            }
+            logger.info(f"✅ 類別層級矩陣就緒: {len(classes)} 個類別")
+        return self._class_index
+
+    def _rank_rows(self, query_features: np.ndarray, rows: np.ndarray, k: int) -> List[Dict]:
+        """在指定的圖片列中依相似度排序（精確內積，成本與該類別圖片數成正比）"""
+        similarities = np.asarray(self.features[rows], dtype=np.float32) @ query_features
+        top = np.argsort(-similarities)[:k]
+        return [{
+            'rank': rank + 1,
+            'class_name': self.labels[rows[i]],
+            'image_path': self.paths[rows[i]],
+            'similarity': float(similarities[i]),
+            'confidence': float(similarities[i] * 100)
+        } for rank, i in enumerate(top)]
+
+    def search_classes(self, text: str, k: int = 5, drill_down: int = 0,
+                       centroid_weight: float = CLASS_CENTROID_WEIGHT) -> List[Dict]:
+        """
+        類別層級文字搜尋（零樣本）：查詢特徵只與每個類別的提示文字特徵及圖片特徵中心比對，
+        成本與圖片總數無關
+
+        Args:
+            text: 查詢文字
+            k: 返回前 K 個類別
+            drill_down: 每個類別另外列出最相似的前 N 張圖片（0 表示不展開）
+            centroid_weight: 圖片特徵中心相似度的權重，提示文字相似度權重 = 1 - centroid_weight
+
+        Returns:
+            類別結果列表
+        """
+        logger.info(f"🔍 類別文字搜尋: {text}")
+
+        query_features = self._text_features(text)
+        if query_features is None:
+            return []
+
+        class_index = self._load_class_index()
+        text_similarities = class_index['text'] @ query_features
+        centroid_similarities = class_index['centroids'] @ query_features
+        scores = (1 - centroid_weight) * text_similarities + centroid_weight * centroid_similarities
+
         results = []
-        for i, (dist, idx) in enumerate(zip(distances[0], indices[0])):
-            results.append({
-                'rank': i + 1,
-                'class_name': self.labels[idx],
-                'image_path': self.paths[idx],
-                'similarity': float(dist),
-                'confidence': float(dist * 100)
-            })
+        for rank, i in enumerate(np.argsort(-scores)[:k]):
+            class_name = class_index['classes'][i]
+            rows = class_index['rows'].get(class_name, np.empty(0, dtype=np.int64))
+            result = {
+                'rank': rank + 1,
+                'class_name': class_name,
+                'display_name': class_index['display_names'][i],
+                'similarity': float(scores[i]),
+                'confidence': float(scores[i] * 100),
+                'text_similarity': float(text_similarities[i]),
+                'centroid_similarity': float(centroid_similarities[i]),
+                'num_images': int(len(rows))
+            }
+            if drill_down > 0:
+                result['images'] = self._rank_rows(query_features, rows, drill_down)
+            results.append(result)
 
         return results
 
+    def search_in_class(self, text: str, class_name: str, k: int = 5) -> List[Dict]:
+        """
+        在單一類別的圖片中進行文字搜尋（類別搜尋結果的展開）
+
+        Args:
+            text: 查詢文字
+            class_name: 類別名稱
+            k: 返回前 K 個結果
+
+        Returns:
+            搜尋結果列表（類別不存在時為空）
+        """
+        query_features = self._text_features(text)
+        if query_features is None:
+            return []
+        rows = self._load_class_index()['rows'].get(class_name)
+        if rows is None:
+            return []
+        return self._rank_rows(query_features, rows, k)
+
     def get_statistics(self) -> Dict:
         """取得索引統計資訊"""
-        unique_classes = set(self.labels)
-
-        class_counts = {}
-        for label in self.labels:
-            class_counts[label] = class_counts.get(label, 0) + 1
+        class_counts = self.meta.get('class_counts')
+        if class_counts is None:
+            class_counts = {}
+            for label in self.labels:
+                class_counts[label] = class_counts.get(label, 0) + 1
 
         return {
             'total_images': len(self.features),
-            'total_classes': len(unique_classes),
+            'total_classes': len(class_counts),
             'feature_dim': self.features.shape[1],
             'class_distribution': class_counts,
-            'index_type': type(self.index).__name__
+            'index_type': type(self.index).__name__,
+            'index_config': self.index_config,
+            'index_dir': str(self.index_dir),
+            'model_name': self.model_name,
+            'text_cache': self.text_cache.stats()
         }
 
     def save_index(self, output_path: str = "clip_faiss.index"):
-        """儲存 FAISS 索引"""
-        faiss.write_index(self.index, output_path)
+        """儲存 FAISS 索引（先寫暫存檔再取代，避免其他行程映射到寫到一半的檔案）"""
+        tmp_path = f"{output_path}.tmp"
+        faiss.write_index(self.index, tmp_path)
+        os.replace(tmp_path, output_path)
         logger.info(f"💾 FAISS 索引已儲存至: {output_path}")
 
     @classmethod
     def load_index(cls, index_path: str = "clip_faiss.index", **kwargs):
-        """載入已儲存的 FAISS 索引"""
-        instance = cls(**kwargs)
-        instance.index = faiss.read_index(index_path)
-        logger.info(f"📂 FAISS 索引已載入: {index_path}")
-        return instance
+        """載入已儲存的 FAISS 索引（不重新建立）"""
+        return cls(index_file=index_path, **kwargs)
 
 
 def demo_search():
@@ -268,9 +739,6 @@ def demo_search():
     print(f"  特徵維度: {stats['feature_dim']}")
     print(f"  索引類型: {stats['index_type']}")
 
-    # 儲存 FAISS 索引
-    search_engine.save_index("clip_faiss.index")
-
     print("\n" + "=" * 60)
     print("✅ 搜尋引擎初始化完成！")
     print("=" * 60)
@@ -10,19 +10,73 @@ CLIP Feature Extractor for STL Image Recognition
 """
 
 import os
+import json
+import shutil
+import hashlib
 import torch
+from torch.utils.data import Dataset, DataLoader
 import clip
 import numpy as np
 from PIL import Image
 from pathlib import Path
 from typing import List, Union, Tuple
-import pickle
 import logging
 
+from feature_cache import FeatureCache, DEFAULT_CACHE_DIR
+from model_weights import clip_weights
+from index_store import CLIP_INDEX_ROOT
+from image_batches import collate_images, init_decode_worker
+
 # 設定日誌
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 批次提取時的解碼 worker 行程數與每個 worker 預先準備的批次數（可由環境變數覆寫）
+LOADER_WORKERS = int(os.environ.get('CLIP_BUILD_WORKERS', max(0, min(4, (os.cpu_count() or 1) - 1))))
+LOADER_PREFETCH = int(os.environ.get('CLIP_BUILD_PREFETCH', 2))
+# 串流建立：每幾個批次記錄一次進度（中斷後從最後的進度繼續）
+CHECKPOINT_BATCHES = int(os.environ.get('CLIP_CHECKPOINT_BATCHES', 20))
+# 建立中的特徵檔與進度記錄（位於索引根目錄下，發布後刪除）
+BUILD_WORK_DIR = '.build'
+
+
+class _CLIPImageDataset(Dataset):
+    """在 DataLoader worker 中解碼並以 CLIP 預處理圖片"""
+
+    def __init__(self, image_paths, preprocess):
+        self.image_paths = image_paths
+        self.preprocess = preprocess
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        try:
+            image = Image.open(self.image_paths[idx]).convert('RGB')
+            return self.preprocess(image), idx
+        except Exception as e:
+            logger.warning(f"⚠️ 跳過損壞的圖片 {self.image_paths[idx]}: {e}")
+            return None, idx
+
+
+def _read_progress(path):
+    """讀取串流建立的進度記錄（不存在或損壞時回傳空 dict）"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_progress(path, progress):
+    """原子寫入進度記錄"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(progress, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
 
 class CLIPFeatureExtractor:
     """CLIP 特徵提取器"""
@@ -44,11 +98,14 @@ class CLIPFeatureExtractor:
         else:
             self.device = device
 
+        self.model_name = model_name
+
         logger.info(f"🚀 初始化 CLIP 模型: {model_name}")
         logger.info(f"💻 使用裝置: {self.device}")
 
         # 載入 CLIP 模型
-        self.model, self.preprocess = clip.load(model_name, device=self.device)
+        # 權重目錄中有檔案時直接載入，否則由 clip 下載到使用者快取
+        self.model, self.preprocess = clip.load(clip_weights(model_name), device=self.device)
         self.model.eval()  # 設定為評估模式
 
         # 取得特徵維度
@@ -108,6 +165,55 @@ class CLIPFeatureExtractor:
             logger.error(f"❌ 提取文字特徵失敗: {e}")
             return None
 
+    def extract_batch_text_features(self, texts: List[str], batch_size: int = 256) -> np.ndarray:
+        """
+        批次提取文字特徵（過長的文字截斷至 CLIP 的 77 個 token）
+
+        Args:
+            texts: 文字列表
+            batch_size: 批次大小
+
+        Returns:
+            特徵矩陣 (N, D)，已 L2 正規化
+        """
+        features_list = []
+        for i in range(0, len(texts), batch_size):
+            text_input = clip.tokenize(texts[i:i + batch_size], truncate=True).to(self.device)
+            with torch.no_grad():
+                features = self.model.encode_text(text_input)
+                features = features / features.norm(dim=-1, keepdim=True)
+            features_list.append(features.cpu().numpy().astype(np.float32))
+        return np.vstack(features_list) if features_list else np.empty((0, self.feature_dim), dtype=np.float32)
+
+    def _image_loader(self, image_paths: List[Union[str, Path]], batch_size: int,
+                      num_workers: int = None, prefetch_factor: int = None) -> DataLoader:
+        """
+        預先讀取的圖片批次：(張量或 None, 成功圖片在 image_paths 中的索引, 批次原始大小)
+
+        Args:
+            num_workers: 解碼 worker 行程數（預設 LOADER_WORKERS，0 表示在主行程解碼）
+            prefetch_factor: 每個 worker 預先準備的批次數（佇列深度，預設 LOADER_PREFETCH）
+        """
+        if num_workers is None:
+            num_workers = LOADER_WORKERS
+        if prefetch_factor is None:
+            prefetch_factor = LOADER_PREFETCH
+
+        worker_options = {}
+        if num_workers > 0:
+            worker_options = {'prefetch_factor': prefetch_factor, 'worker_init_fn': init_decode_worker}
+
+        return DataLoader(
+            _CLIPImageDataset(image_paths, self.preprocess),
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
+            collate_fn=collate_images,
+            # GPU 推論時使用鎖頁記憶體，主機到 GPU 的複製可與運算重疊
+            pin_memory=self.device == "cuda",
+            **worker_options
+        )
+
     def extract_batch_image_features(self, image_paths: List[Union[str, Path]],
                                      batch_size: int = 32) -> Tuple[np.ndarray, List[str]]:
         """
@@ -120,77 +226,187 @@ class CLIPFeatureExtractor:
         Returns:
             (特徵矩陣, 成功處理的圖片路徑列表)
         """
-        features_list = []
-        valid_paths = []
-
         total = len(image_paths)
         logger.info(f"📊 開始批次處理 {total} 張圖片...")
 
-        for i in range(0, total, batch_size):
-            batch_paths = image_paths[i:i + batch_size]
-            batch_images = []
-            batch_valid_paths = []
-
-            # 載入批次圖片
-            for path in batch_paths:
-                try:
-                    image = Image.open(path).convert('RGB')
-                    batch_images.append(self.preprocess(image))
-                    batch_valid_paths.append(str(path))
-                except Exception as e:
-                    logger.warning(f"⚠️ 跳過損壞的圖片 {path}: {e}")
-                    continue
-
-            if len(batch_images) == 0:
+        # 預先配置結果矩陣逐批寫入，不保留批次列表再合併（峰值記憶體約為最終矩陣一份）
+        all_features = np.empty((total, self.feature_dim), dtype=np.float32)
+        valid_paths = []
+
+        processed = 0
+        for batch_features, batch_indices, batch_len in self._iter_image_batches(image_paths, batch_size):
+            processed += batch_len
+            if batch_features is None:
+                continue
+
+            all_features[len(valid_paths):len(valid_paths) + len(batch_indices)] = batch_features
+            valid_paths.extend(str(image_paths[idx]) for idx in batch_indices)
+
+            # 顯示進度
+            logger.info(f"⏳ 進度: {processed}/{total} ({processed/total*100:.1f}%)")
+
+        if len(valid_paths) == 0:
+            logger.error("❌ 沒有成功提取任何特徵")
+            return None, []
+
+        logger.info(f"✅ 成功提取 {len(valid_paths)} 張圖片的特徵")
+
+        return all_features[:len(valid_paths)], valid_paths
+
+    def _iter_image_batches(self, image_paths: List[Union[str, Path]], batch_size: int):
+        """
+        批次編碼圖片（worker 行程預先解碼後續批次）
+
+        Yields:
+            (特徵矩陣或 None, 成功圖片在 image_paths 中的索引, 批次原始大小)
+        """
+        for batch_input, batch_indices, batch_len in self._image_loader(image_paths, batch_size):
+            if batch_input is None:
+                yield None, [], batch_len
                 continue
 
             # 批次處理
             try:
-                batch_input = torch.stack(batch_images).to(self.device)
+                batch_input = batch_input.to(self.device, non_blocking=True)
 
                 with torch.no_grad():
                     batch_features = self.model.encode_image(batch_input)
                     # L2 正規化
                     batch_features = batch_features / batch_features.norm(dim=-1, keepdim=True)
-
-                features_list.append(batch_features.cpu().numpy())
-                valid_paths.extend(batch_valid_paths)
-
-                # 顯示進度
-                processed = min(i + batch_size, total)
-                logger.info(f"⏳ 進度: {processed}/{total} ({processed/total*100:.1f}%)")
+                batch_features = batch_features.cpu().numpy()
 
             except Exception as e:
                 logger.error(f"❌ 批次處理失敗: {e}")
-                continue
+                batch_features, batch_indices = None, []
+
+            yield batch_features, batch_indices, batch_len
+
+    def _stream_features(self, image_paths: List[Path], batch_size: int,
+                         cache_dir: Union[str, Path, None], work_dir: Union[str, Path]) -> Tuple[str, List[str]]:
+        """
+        串流提取特徵：依 image_paths 順序直接寫入預先配置的 .npy 記憶體映射，
+        快取命中的圖片從特徵快取複製，其餘逐批編碼；每 CHECKPOINT_BATCHES 個批次記錄進度，
+        中斷後以相同的圖片列表重新執行時從上次進度繼續
+
+        Returns:
+            (特徵檔路徑, 成功處理的圖片路徑列表)；沒有任何成功的圖片時為 (None, [])
+        """
+        work_dir = Path(work_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        feature_file = work_dir / "clip_features.npy"
+        pending_file = work_dir / "pending.npy"
+        progress_file = work_dir / "progress.json"
 
-        if len(features_list) == 0:
+        total = len(image_paths)
+        # 進度記錄只適用於相同的模型與圖片（路徑、大小、修改時間）；中斷後重新渲染過的圖片會重新開始
+        signature = hashlib.blake2b(digest_size=16)
+        signature.update(self.model_name.encode('utf-8'))
+        for path in image_paths:
+            st = os.stat(path)
+            signature.update(f"\n{path}\0{st.st_size}\0{st.st_mtime_ns}".encode('utf-8'))
+        signature = signature.hexdigest()
+        cache = FeatureCache(f"clip_{self.model_name}", str(cache_dir)) if cache_dir else None
+        keys = cache.keys_for(image_paths) if cache is not None else None
+
+        features = None
+        progress = _read_progress(progress_file)
+        if progress.get('signature') == signature and feature_file.exists() and pending_file.exists():
+            features = np.load(feature_file, mmap_mode='r+')
+            if features.shape != (total, self.feature_dim):
+                features = None
+        if features is not None:
+            pending = np.load(pending_file)
+            logger.info(f"♻️ 從上次中斷處繼續: 已完成 {progress['done']}/{len(pending)} 張")
+        else:
+            features = np.lib.format.open_memmap(feature_file, mode='w+', dtype=np.float32,
+                                                 shape=(total, self.feature_dim))
+            if cache is not None:
+                rows = cache.find(keys)
+                hits = np.flatnonzero(rows >= 0)
+                for start in range(0, len(hits), 4096):
+                    chunk = hits[start:start + 4096]
+                    features[chunk] = cache.read(rows[chunk])
+                pending = np.flatnonzero(rows < 0)
+                logger.info(f"♻️ 特徵快取命中 {len(hits)} 張，需提取 {len(pending)} 張")
+            else:
+                pending = np.arange(total)
+            np.save(pending_file, pending)
+            progress = {'signature': signature, 'done': 0, 'invalid': []}
+            features.flush()
+            _write_progress(progress_file, progress)
+
+        invalid = set(progress['invalid'])
+        done = progress['done']
+        todo = pending[done:]
+
+        def checkpoint():
+            features.flush()
+            if cache is not None:
+                cache.save()
+            _write_progress(progress_file, {'signature': signature, 'done': done, 'invalid': sorted(invalid)})
+
+        position = 0
+        batches = 0
+        for batch_features, batch_indices, batch_len in self._iter_image_batches(
+                [image_paths[i] for i in todo], batch_size):
+            batch_rows = todo[position:position + batch_len]
+            written = todo[np.asarray(batch_indices, dtype=np.int64)]
+            invalid.update(int(i) for i in np.setdiff1d(batch_rows, written))
+            if batch_features is not None:
+                features[written] = batch_features
+                if cache is not None:
+                    cache.put([keys[i] for i in written], batch_features)
+            position += batch_len
+            done += batch_len
+            batches += 1
+
+            logger.info(f"⏳ 進度: {done}/{len(pending)} ({done/len(pending)*100:.1f}%)")
+            if batches % CHECKPOINT_BATCHES == 0:
+                checkpoint()
+        checkpoint()
+
+        valid = np.setdiff1d(np.arange(total), np.fromiter(invalid, dtype=np.int64, count=len(invalid)))
+        if len(valid) == 0:
             logger.error("❌ 沒有成功提取任何特徵")
             return None, []
 
-        # 合併所有批次
-        all_features = np.vstack(features_list)
-        logger.info(f"✅ 成功提取 {len(valid_paths)} 張圖片的特徵")
-
-        return all_features, valid_paths
+        if len(valid) < total:
+            # 略過的圖片留下空列，壓縮成只含成功圖片的特徵檔
+            compact_file = work_dir / "clip_features.compact.npy"
+            compact = np.lib.format.open_memmap(compact_file, mode='w+', dtype=np.float32,
+                                                shape=(len(valid), self.feature_dim))
+            for start in range(0, len(valid), 4096):
+                compact[start:start + 4096] = features[valid[start:start + 4096]]
+            compact.flush()
+            del compact
+            os.replace(compact_file, feature_file)
+        del features
+
+        logger.info(f"✅ 成功提取 {len(valid)} 張圖片的特徵")
+        return str(feature_file), [str(image_paths[i]) for i in valid]
 
     def build_dataset_index(self, dataset_dir: Union[str, Path],
-                           output_dir: Union[str, Path] = ".",
-                           batch_size: int = 32) -> bool:
+                           output_dir: Union[str, Path] = CLIP_INDEX_ROOT,
+                           batch_size: int = 32,
+                           cache_dir: Union[str, Path, None] = DEFAULT_CACHE_DIR,
+                           index_type: str = None) -> bool:
         """
         為整個資料集建立 CLIP 特徵索引
 
+        特徵、標籤、路徑與建好的 FAISS 索引一起發布為 output_dir 下的新版本，
+        搜尋引擎啟動時直接載入，不重新建立索引。
+
         Args:
             dataset_dir: 資料集目錄 (如 'dataset/')
-            output_dir: 輸出目錄
+            output_dir: 索引版本根目錄
             batch_size: 批次大小
+            cache_dir: 特徵快取目錄，已快取的圖片不重新提取（None 表示停用）
+            index_type: FAISS 索引類型（None 為 FAISS_INDEX_TYPE 預設值）
 
         Returns:
             是否成功
         """
         dataset_dir = Path(dataset_dir)
-        output_dir = Path(output_dir)
-        output_dir.mkdir(exist_ok=True)
 
         logger.info(f"🔨 開始建立資料集索引: {dataset_dir}")
 
@@ -203,7 +419,7 @@ class CLIPFeatureExtractor:
                 continue
 
             class_name = class_dir.name
-            class_images = list(class_dir.glob('*.png')) + list(class_dir.glob('*.jpg'))
+            class_images = sorted(list(class_dir.glob('*.png')) + list(class_dir.glob('*.jpg')))
 
             logger.info(f"📁 類別: {class_name} - {len(class_images)} 張圖片")
 
@@ -217,10 +433,11 @@ class CLIPFeatureExtractor:
 
         logger.info(f"📊 總計: {len(image_paths)} 張圖片, {len(set(labels))} 個類別")
 
-        # 批次提取特徵
-        features, valid_paths = self.extract_batch_image_features(image_paths, batch_size)
+        # 串流提取特徵到暫存目錄的記憶體映射（只計算快取中沒有的圖片，中斷後可繼續）
+        work_dir = Path(output_dir) / BUILD_WORK_DIR
+        feature_file, valid_paths = self._stream_features(image_paths, batch_size, cache_dir, work_dir)
 
-        if features is None:
+        if feature_file is None:
             return False
 
         # 更新標籤（只保留成功處理的）
@@ -229,22 +446,13 @@ class CLIPFeatureExtractor:
         for path in valid_paths:
             valid_labels.append(path_to_label[path])
 
-        # 儲存特徵和標籤
-        feature_file = output_dir / "clip_features.npy"
-        label_file = output_dir / "clip_labels.pkl"
-        path_file = output_dir / "clip_paths.pkl"
-
-        np.save(feature_file, features)
-
-        with open(label_file, 'wb') as f:
-            pickle.dump(valid_labels, f)
-
-        with open(path_file, 'wb') as f:
-            pickle.dump(valid_paths, f)
+        # 建立 FAISS 索引與類別層級提示文字特徵，連同特徵、標籤與路徑發布為新版本
+        from clip_faiss_search import publish_artifact
+        version_dir = publish_artifact(feature_file, valid_labels, valid_paths, self.model_name,
+                                       index_type=index_type, root=str(output_dir), extractor=self)
+        shutil.rmtree(work_dir, ignore_errors=True)
 
-        logger.info(f"💾 特徵已儲存至: {feature_file}")
-        logger.info(f"💾 標籤已儲存至: {label_file}")
-        logger.info(f"💾 路徑已儲存至: {path_file}")
+        logger.info(f"💾 特徵、標籤、路徑與 FAISS 索引已儲存至: {version_dir}")
         logger.info(f"✅ 索引建立完成！")
 
         return True
@@ -269,7 +477,6 @@ def main():
 
     success = extractor.build_dataset_index(
         dataset_dir=dataset_dir,
-        output_dir=".",
         batch_size=32
     )
 
@@ -277,11 +484,14 @@ def main():
         print("\n" + "=" * 60)
         print("✅ CLIP 特徵索引建立成功！")
         print("=" * 60)
-        print("\n生成的檔案：")
+        print(f"\n生成的檔案（{CLIP_INDEX_ROOT}/<版本>/）：")
         print("  📄 clip_features.npy - CLIP 特徵向量")
         print("  📄 clip_labels.pkl - 類別標籤")
         print("  📄 clip_paths.pkl - 圖片路徑")
-        print("\n下一步：執行 clip_faiss_search.py 建立 FAISS 索引")
+        print("  📄 clip_faiss.index - FAISS 索引")
+        print("  📄 clip_meta.json - 模型與索引設定")
+        print("  📄 clip_classes.npz - 類別提示文字特徵與圖片特徵中心")
+        print("\n搜尋頁面啟動時直接載入此版本，不需重新建立索引")
     else:
         print("\n" + "=" * 60)
         print("❌ 索引建立失敗")
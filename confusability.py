@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Class Confusability Report
+以已建立的索引分析容易混淆的類別與評估準確率
+
+以索引自身的向量做一次批次 kNN（排除自身，不重新提取特徵），統計：
+    - 各類別的留一法 top-1 準確率與最常被誤判成的類別
+    - 類別 × 類別混淆/相似度矩陣（稀疏：只列出非零格，依混淆程度排序）
+
+loo_evaluation() 以同樣方式評估整個資料集（/api/batch_test 使用），可另外排除同類別中
+相鄰的渲染視角（相鄰檔名為相鄰方位角，幾乎相同），得到較接近實際拍照查詢的準確率。
+
+報告以 JSON 儲存於索引根目錄，訓練頁面與 /api/confusability 讀取：
+    python confusability.py
+    python confusability.py --k 20 --json report.json
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+from faiss_recognition import FAISSRecognitionEngine, _log
+from index_store import DEFAULT_INDEX_ROOT, current_index_dir
+
+# 每個向量統計的鄰居數
+CONFUSION_NEIGHBOURS = int(os.environ.get('FAISS_CONFUSION_K', 10))
+# 留一法評估：排除同類別前後各 N 個相鄰視角；排名類別時搜尋的鄰居數
+EVAL_EXCLUDE_VIEWS = int(os.environ.get('FAISS_EVAL_EXCLUDE_VIEWS', 0))
+EVAL_NEIGHBOURS = 50
+EVAL_TOP_K = (1, 3, 5)
+# 報告中保留的類別配對數與每個類別列出的混淆類別數
+TOP_PAIRS = 100
+TOP_CONFUSERS = 3
+SEARCH_BATCH = 4096
+
+REPORT_FILE = 'confusability.json'
+
+
+def report_path(index_root=DEFAULT_INDEX_ROOT):
+    """報告檔路徑（位於索引根目錄，不隨版本目錄刪除）"""
+    return os.path.join(index_root, REPORT_FILE)
+
+
+def view_positions(class_ids):
+    """每個向量在所屬類別中的視角序號（標籤列依檔名順序加入，即渲染順序）"""
+    class_ids = np.asarray(class_ids)
+    order = np.argsort(class_ids, kind='stable')
+    starts = np.searchsorted(class_ids[order], class_ids[order])
+    positions = np.empty(len(class_ids), dtype=np.int64)
+    positions[order] = np.arange(len(class_ids)) - starts
+    return positions
+
+
+def index_self_knn(engine, k, exclude_views=0):
+    """
+    以引擎的索引搜尋每個已索引向量的 k 個鄰居，排除自身與同類別前後 exclude_views 個視角
+
+    Returns:
+        (相似度 N×k, 鄰居 class_id N×k；不足 k 個時以 -1 補齊)
+    """
+    vectors = engine.get_stored_vectors()
+    query_classes = np.asarray(engine.labels.class_ids)
+    positions = view_positions(query_classes)
+    fetch = min(k + 2 * exclude_views + 1, engine.index.ntotal)
+    k = min(k, fetch - 1)
+    similarities = np.empty((len(query_classes), k), dtype=np.float32)
+    neighbour_classes = np.empty((len(query_classes), k), dtype=np.int64)
+    for start in range(0, len(query_classes), SEARCH_BATCH):
+        end = min(start + SEARCH_BATCH, len(query_classes))
+        batch = np.ascontiguousarray(vectors[start:end], dtype=np.float32)
+        sims, ids = engine.index.search(batch, fetch)
+        classes = engine._class_ids_of(ids)
+        rows = engine._row_of_id[np.clip(ids, 0, len(engine._row_of_id) - 1)]
+        excluded = (classes < 0) | ((classes == query_classes[start:end, None]) &
+                                    (np.abs(positions[rows] - positions[start:end, None]) <= exclude_views))
+        # 保留順序取前 k 個未排除的鄰居
+        keep = np.argsort(excluded, axis=1, kind='stable')[:, :k]
+        similarities[start:end] = np.take_along_axis(sims, keep, axis=1)
+        neighbour_classes[start:end] = np.where(np.take_along_axis(excluded, keep, axis=1), -1,
+                                                np.take_along_axis(classes, keep, axis=1))
+    return similarities, neighbour_classes
+
+
+def confusability_report(engine, k=CONFUSION_NEIGHBOURS, top_pairs=TOP_PAIRS):
+    """
+    計算類別混淆報告（引擎需已載入索引）
+
+    Returns:
+        {'version', 'k', 'num_vectors', 'num_classes', 'loo_top1', 'elapsed_ms',
+         'classes': [{'class_name', 'count', 'loo_top1', 'confused_with'}],
+         'pairs': [{'class_a', 'class_b', 'a_as_b', 'b_as_a', 'confusion_rate',
+                    'neighbour_share', 'max_similarity'}]}
+    """
+    start_time = time.time()
+    with engine._state_lock.read_lock():
+        similarities, neighbour_classes = index_self_knn(engine, k)
+        query_classes = np.asarray(engine.labels.class_ids, dtype=np.int64)
+        classes = list(engine.classes)
+        version = engine.version
+    n_classes = len(classes)
+    k = neighbour_classes.shape[1]
+    counts = np.bincount(query_classes, minlength=n_classes)
+
+    # 留一法 top-1
+    top1 = neighbour_classes[:, 0]
+    correct = top1 == query_classes
+    class_accuracy = np.bincount(query_classes, weights=correct, minlength=n_classes) / np.maximum(counts, 1)
+
+    # 有向稀疏矩陣 a -> b：a 的向量在 k 個鄰居中出現 b 的次數、最高相似度、top-1 誤判成 b 的次數
+    cross = (neighbour_classes >= 0) & (neighbour_classes != query_classes[:, None])
+    codes = np.broadcast_to(query_classes[:, None], cross.shape)[cross] * n_classes + neighbour_classes[cross]
+    cells, inverse, cell_neighbours = np.unique(codes, return_inverse=True, return_counts=True)
+    cell_max = np.full(len(cells), -np.inf, dtype=np.float32)
+    np.maximum.at(cell_max, inverse, similarities[cross])
+    wrong = ~correct & (top1 >= 0)
+    cell_top1 = np.zeros(len(cells), dtype=np.int64)
+    wrong_cells, wrong_counts = np.unique(query_classes[wrong] * n_classes + top1[wrong], return_counts=True)
+    cell_top1[np.searchsorted(cells, wrong_cells)] = wrong_counts  # top-1 誤判必為跨類別鄰居
+    source, target = cells // n_classes, cells % n_classes
+    share = cell_neighbours / (counts[source] * k)
+
+    # 各類別最常混淆的類別（cells 依來源類別排序）
+    bounds = np.searchsorted(source, np.arange(n_classes + 1))
+    class_rows = []
+    for class_id, class_name in enumerate(classes):
+        group = np.arange(bounds[class_id], bounds[class_id + 1])
+        group = group[np.lexsort((-share[group], -cell_top1[group]))][:TOP_CONFUSERS]
+        class_rows.append({
+            'class_name': class_name,
+            'count': int(counts[class_id]),
+            'loo_top1': float(class_accuracy[class_id]),
+            'confused_with': [{
+                'class_name': classes[target[c]],
+                'top1_rate': float(cell_top1[c] / counts[class_id]),
+                'neighbour_share': float(share[c])
+            } for c in group]
+        })
+
+    # 無向配對：合併 a -> b 與 b -> a
+    low, high = np.minimum(source, target), np.maximum(source, target)
+    pair_codes, pair_inverse = np.unique(low * n_classes + high, return_inverse=True)
+    forward = source == low
+    a_as_b = np.bincount(pair_inverse, weights=np.where(forward, cell_top1, 0), minlength=len(pair_codes))
+    b_as_a = np.bincount(pair_inverse, weights=np.where(forward, 0, cell_top1), minlength=len(pair_codes))
+    pair_neighbours = np.bincount(pair_inverse, weights=cell_neighbours, minlength=len(pair_codes))
+    pair_max = np.full(len(pair_codes), -np.inf, dtype=np.float32)
+    np.maximum.at(pair_max, pair_inverse, cell_max)
+    class_a, class_b = pair_codes // n_classes, pair_codes % n_classes
+    pair_size = counts[class_a] + counts[class_b]
+    confusion_rate = (a_as_b + b_as_a) / pair_size
+    pair_share = pair_neighbours / (pair_size * k)
+    order = np.lexsort((-pair_max, -pair_share, -confusion_rate))[:top_pairs]
+    pairs = [{
+        'class_a': classes[class_a[p]],
+        'class_b': classes[class_b[p]],
+        'a_as_b': int(a_as_b[p]),
+        'b_as_a': int(b_as_a[p]),
+        'confusion_rate': float(confusion_rate[p]),
+        'neighbour_share': float(pair_share[p]),
+        'max_similarity': float(pair_max[p])
+    } for p in order]
+
+    return {
+        'version': version,
+        'generated_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'k': int(k),
+        'num_vectors': int(len(query_classes)),
+        'num_classes': n_classes,
+        'loo_top1': float(np.mean(correct)) if len(correct) else 0.0,
+        'elapsed_ms': round((time.time() - start_time) * 1000, 1),
+        'classes': class_rows,
+        'pairs': pairs
+    }
+
+
+def loo_evaluation(engine, exclude_views=EVAL_EXCLUDE_VIEWS, top_k=EVAL_TOP_K):
+    """
+    以已索引向量做留一法評估（全部向量，一次批次搜尋）
+
+    類別依最近鄰出現順序排名（即各類別的最高相似度），top-k 準確率為正確類別落在前 k 個不同類別內的比例。
+
+    Returns:
+        {'results': {類別: {'correct', 'total', 'accuracy'}}, 'top_k_accuracy': {k: 準確率},
+         'confusion_matrix': {'classes', 'entries': [[真實, 預測, 數量], ...]}（稀疏）, ...}
+    """
+    start_time = time.time()
+    with engine._state_lock.read_lock():
+        _, neighbour_classes = index_self_knn(engine, EVAL_NEIGHBOURS, exclude_views)
+        query_classes = np.asarray(engine.labels.class_ids, dtype=np.int64)
+        classes = list(engine.classes)
+    n_classes = len(classes)
+    valid = neighbour_classes >= 0
+
+    # 每列中各類別第一次出現的位置：依 (類別, 欄位) 排序後取每組第一個
+    columns = np.arange(neighbour_classes.shape[1])
+    masked = np.where(valid, neighbour_classes, n_classes)
+    order = np.argsort(masked * len(columns) + columns, axis=1, kind='stable')
+    sorted_classes = np.take_along_axis(masked, order, axis=1)
+    first_sorted = np.ones(sorted_classes.shape, dtype=bool)
+    first_sorted[:, 1:] = sorted_classes[:, 1:] != sorted_classes[:, :-1]
+    is_first = np.empty_like(first_sorted)
+    np.put_along_axis(is_first, order, first_sorted, axis=1)
+    is_first &= valid
+
+    # 正確類別的名次（0 起算），找不到時為無限大
+    is_true = neighbour_classes == query_classes[:, None]
+    found = is_true.any(axis=1)
+    true_rank = np.cumsum(is_first, axis=1)[np.arange(len(query_classes)), is_true.argmax(axis=1)] - 1
+    true_rank = np.where(found, true_rank, np.iinfo(np.int64).max)
+
+    predicted = np.where(valid[:, 0], neighbour_classes[:, 0], -1)
+    correct = predicted == query_classes
+    counts = np.bincount(query_classes, minlength=n_classes)
+    class_correct = np.bincount(query_classes, weights=correct, minlength=n_classes).astype(np.int64)
+
+    cells, cell_counts = np.unique(query_classes * (n_classes + 1) + (predicted + 1), return_counts=True)
+    total = len(query_classes)
+    return {
+        'mode': 'loo',
+        'exclude_views': exclude_views,
+        'results': {
+            classes[c]: {'correct': int(class_correct[c]), 'total': int(counts[c]),
+                         'accuracy': round(float(class_correct[c] / counts[c]) * 100, 1)}
+            for c in range(n_classes) if counts[c] > 0
+        },
+        'total_correct': int(correct.sum()),
+        'total_tested': total,
+        'overall_accuracy': round(float(correct.mean()) * 100, 1) if total else 0,
+        'top_k_accuracy': {str(k): round(float(np.mean(true_rank < k)) * 100, 1) if total else 0 for k in top_k},
+        # 預測為 -1 表示排除後沒有任何鄰居
+        'confusion_matrix': {
+            'classes': classes,
+            'entries': [[int(cell // (n_classes + 1)), int(cell % (n_classes + 1)) - 1, int(n)]
+                        for cell, n in zip(cells, cell_counts)]
+        },
+        'elapsed_ms': round((time.time() - start_time) * 1000, 1)
+    }
+
+
+def save_report(report, path=None):
+    """原子寫入報告 JSON"""
+    path = path or report_path()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_report(path=None):
+    """讀取報告，不存在時回傳 None"""
+    path = path or report_path()
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def generate_report(engine=None, k=CONFUSION_NEIGHBOURS, path=None):
+    """
+    計算並儲存報告；未提供引擎時只載入目前版本的索引（不載入特徵提取器）
+
+    Returns:
+        報告 dict，索引不存在時回傳 None
+    """
+    if engine is None or not engine.loaded:
+        engine = FAISSRecognitionEngine()
+        if not engine._read_index_state(current_index_dir(engine.index_root)):
+            return None
+    report = confusability_report(engine, k)
+    path = save_report(report, path or report_path(engine.index_root))
+    _log(f"🧩 類別混淆報告: {report['num_classes']} 個類別, {report['num_vectors']} 個向量, "
+         f"LOO top-1 {report['loo_top1']:.1%} ({report['elapsed_ms']:.0f} ms) -> {path}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="以現有索引計算類別混淆報告")
+    parser.add_argument('--k', type=int, default=CONFUSION_NEIGHBOURS, help='每個向量統計的鄰居數')
+    parser.add_argument('--json', default=None, help=f'報告輸出路徑（預設 索引根目錄/{REPORT_FILE}）')
+    parser.add_argument('--top', type=int, default=20, help='顯示的類別配對數')
+    args = parser.parse_args()
+
+    report = generate_report(k=args.k, path=args.json)
+    if report is None:
+        print("❌ 索引不存在，請先建立索引")
+        raise SystemExit(1)
+
+    print(f"\n{'類別 A':<32}{'類別 B':<32}{'A→B':>6}{'B→A':>6}{'混淆率':>9}{'鄰居占比':>10}{'最高相似度':>12}")
+    for pair in report['pairs'][:args.top]:
+        print(f"{pair['class_a']:<32}{pair['class_b']:<32}{pair['a_as_b']:>6}{pair['b_as_a']:>6}"
+              f"{pair['confusion_rate']:>9.1%}{pair['neighbour_share']:>10.1%}{pair['max_similarity']:>12.3f}")
+
+    worst = sorted(report['classes'], key=lambda row: row['loo_top1'])[:args.top]
+    print(f"\n{'類別':<32}{'向量數':>8}{'LOO top-1':>12}  最常誤判為")
+    for row in worst:
+        confused = ', '.join(f"{c['class_name']} ({c['top1_rate']:.0%})" for c in row['confused_with'] if c['top1_rate'] > 0)
+        print(f"{row['class_name']:<32}{row['count']:>8}{row['loo_top1']:>12.1%}  {confused or '-'}")
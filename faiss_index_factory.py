@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+FAISS Index Factory
+可選擇的 FAISS 索引類型與召回率/延遲基準測試
+
+支援的索引類型（皆使用內積相似度，向量須先 L2 正規化）：
+- flat:     IndexFlatIP，暴力搜尋，結果精確
+- ivf_flat: IndexIVFFlat，倒排索引，只搜尋 nprobe 個分群
+- ivf_pq:   IndexIVFPQ，倒排索引 + 乘積量化，記憶體最小
+- hnsw:     IndexHNSWFlat，圖搜尋，延遲最低（不支援刪除）
+
+降維（可與任一類型組合）：
+- pca_dim:  建立時擬合 PCA 白化（例如 2048 → 256 維）並隨索引儲存，查詢自動投影；
+            降維後向量重新 L2 正規化，原始向量保留於磁碟
+
+壓縮類型（記憶體受限時使用，搜尋後以原始向量對候選結果精確重排序）：
+- fp16:     IndexScalarQuantizer fp16，記憶體 1/2
+- sq8:      IndexScalarQuantizer 8-bit，記憶體 1/4
+- pq:       IndexPQ 乘積量化，記憶體約 1/128（2048 維 → 64 bytes）
+- ivf_pq:   同上並加上倒排索引
+
+基準測試：
+    python faiss_index_factory.py --source faiss --types flat ivf_flat ivf_pq hnsw
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import faiss
+
+INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw', 'fp16', 'sq8', 'pq')
+COMPRESSED_TYPES = ('fp16', 'sq8', 'pq', 'ivf_pq')
+DEFAULT_INDEX_TYPE = os.environ.get('FAISS_INDEX_TYPE', 'flat')
+
+# PCA 白化降維的目標維度（0 表示不降維）
+DEFAULT_PCA_DIM = int(os.environ.get('FAISS_PCA_DIM', 0))
+
+# 以唯讀記憶體映射載入索引（冷啟動不複製向量資料，多個工作行程共用同一份 page cache）
+DEFAULT_MMAP = os.environ.get('FAISS_MMAP', '1') != '0'
+
+# 各類型的預設參數（None 表示依資料量自動決定）
+DEFAULT_PARAMS = {
+    'flat': {},
+    'ivf_flat': {'nlist': None, 'nprobe': 16},
+    'ivf_pq': {'nlist': None, 'nprobe': 16, 'm': None, 'nbits': 8, 'rerank': 10},
+    'hnsw': {'M': 32, 'efConstruction': 80, 'efSearch': 64},
+    'fp16': {'rerank': 4},
+    'sq8': {'rerank': 10},
+    'pq': {'m': None, 'nbits': 8, 'rerank': 10},
+}
+
+
+def make_index_config(index_type=None, pca_dim=None, **params):
+    """建立索引設定 {'type': ..., 'params': {...}, 'pca_dim': ...}，未指定的參數使用預設值"""
+    index_type = index_type or DEFAULT_INDEX_TYPE
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"不支援的索引類型: {index_type}（可用: {', '.join(INDEX_TYPES)}）")
+    merged = dict(DEFAULT_PARAMS[index_type])
+    merged.update({k: v for k, v in params.items() if v is not None})
+    return {'type': index_type, 'params': merged, 'pca_dim': DEFAULT_PCA_DIM if pca_dim is None else pca_dim}
+
+
+def config_label(config):
+    """索引設定的簡短描述，例如 'flat' 或 'PCAW256 + flat'"""
+    if config.get('pca_dim'):
+        return f"PCAW{config['pca_dim']} + {config['type']}"
+    return config['type']
+
+
+def _unwrap(index):
+    """取出 IndexIDMap / IndexPreTransform 包裝內的實際索引"""
+    inner = faiss.downcast_index(index)
+    while isinstance(inner, (faiss.IndexIDMap, faiss.IndexIDMap2, faiss.IndexPreTransform)):
+        inner = faiss.downcast_index(inner.index)
+    return inner
+
+
+def reduce_vectors(index, vectors):
+    """將向量套用索引的前處理轉換（PCA 白化 + L2 正規化）；索引沒有降維時原樣回傳"""
+    inner = faiss.downcast_index(index)
+    while isinstance(inner, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        inner = faiss.downcast_index(inner.index)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if not isinstance(inner, faiss.IndexPreTransform):
+        return vectors
+    for i in range(inner.chain.size()):
+        vectors = faiss.downcast_VectorTransform(inner.chain.at(i)).apply(vectors)
+    return vectors
+
+
+def _auto_nlist(n_vectors):
+    """分群數：約 4√N，且每個分群至少 39 個訓練向量"""
+    return int(max(1, min(4 * np.sqrt(max(n_vectors, 1)), n_vectors // 39)))
+
+
+def _auto_pq_m(dimension):
+    """PQ 子量化器數量：不超過 64 且能整除維度"""
+    for m in (64, 48, 32, 16, 8, 4, 2, 1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def create_index(config, dimension, train_vectors=None):
+    """
+    依設定建立（並訓練）索引
+
+    Args:
+        config: make_index_config() 產生的設定，會補上自動決定的參數
+        dimension: 向量維度
+        train_vectors: 訓練向量（IVF 類型與 PCA 降維需要）
+
+    Returns:
+        faiss.Index（尚未加入向量）；降維時為 IndexPreTransform(PCA 白化 → L2 正規化 → 索引)
+    """
+    if not config.get('pca_dim'):
+        return _create_base_index(config, dimension, train_vectors)
+
+    if train_vectors is None or len(train_vectors) < 2:
+        raise ValueError("PCA 降維需要訓練向量")
+    train_vectors = np.ascontiguousarray(train_vectors, dtype=np.float32)
+    # 白化會放大接近零的特徵值，輸出維度不超過訓練向量數 - 1
+    config['pca_dim'] = int(min(config['pca_dim'], dimension, len(train_vectors) - 1))
+    pca = faiss.PCAMatrix(dimension, config['pca_dim'], -0.5)
+    pca.train(train_vectors)
+    reduced = pca.apply(train_vectors)
+    faiss.normalize_L2(reduced)
+
+    index = faiss.IndexPreTransform(faiss.NormalizationTransform(config['pca_dim'], 2.0),
+                                    _create_base_index(config, config['pca_dim'], reduced))
+    index.prepend_transform(pca)
+    return index
+
+
+def _create_base_index(config, dimension, train_vectors=None):
+    """建立（並訓練）不含降維的索引"""
+    index_type = config['type']
+    params = config['params']
+
+    if index_type == 'flat':
+        return faiss.IndexFlatIP(dimension)
+
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, params['M'], faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = params['efConstruction']
+        index.hnsw.efSearch = params['efSearch']
+        return index
+
+    # 其餘類型需要訓練資料
+    if train_vectors is None or len(train_vectors) == 0:
+        raise ValueError(f"{index_type} 索引需要訓練向量")
+    n_train = len(train_vectors)
+    if index_type in ('pq', 'ivf_pq'):
+        if params.get('m') is None:
+            params['m'] = _auto_pq_m(dimension)
+        # PQ 每個子空間需要至少 2^nbits 個訓練向量
+        while params['nbits'] > 4 and n_train < (1 << params['nbits']):
+            params['nbits'] -= 1
+
+    if index_type == 'fp16':
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == 'sq8':
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == 'pq':
+        index = faiss.IndexPQ(dimension, params['m'], params['nbits'], faiss.METRIC_INNER_PRODUCT)
+    else:
+        if params.get('nlist') is None:
+            params['nlist'] = _auto_nlist(n_train)
+        quantizer = faiss.IndexFlatIP(dimension)
+        if index_type == 'ivf_flat':
+            index = faiss.IndexIVFFlat(quantizer, dimension, params['nlist'], faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dimension, params['nlist'], params['m'],
+                                     params['nbits'], faiss.METRIC_INNER_PRODUCT)
+
+    index.train(np.ascontiguousarray(train_vectors, dtype=np.float32))
+    apply_search_params(index, config)
+    return index
+
+
+def apply_search_params(index, config):
+    """套用搜尋參數（nprobe / efSearch）；可傳入 IndexIDMap 包裝的索引"""
+    params = config['params']
+    inner = _unwrap(index)
+
+    if isinstance(inner, faiss.IndexIVF) and params.get('nprobe'):
+        inner.nprobe = min(params['nprobe'], inner.nlist)
+    elif isinstance(inner, faiss.IndexHNSW) and params.get('efSearch'):
+        inner.hnsw.efSearch = params['efSearch']
+
+
+def is_compressed(config):
+    """是否為有損索引（壓縮或降維；保留原始向量供重排序與重建）"""
+    return config['type'] in COMPRESSED_TYPES or bool(config.get('pca_dim'))
+
+
+def make_search_params(index, config, selector=None):
+    """
+    建立含 ID 篩選器的搜尋參數（依索引類型使用對應的參數類別）
+
+    Returns:
+        SearchParameters；索引不支援搜尋參數（IndexPQ）時回傳 None
+    """
+    inner = _unwrap(index)
+
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=inner.nprobe)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+    if isinstance(inner, faiss.IndexPQ):
+        return None
+    return faiss.SearchParameters(sel=selector)
+
+
+def read_index(path, mmap=DEFAULT_MMAP):
+    """
+    讀取索引檔
+
+    mmap=True 時向量資料直接映射檔案（唯讀）；不支援映射的索引結構會自動完整讀入。
+    映射載入的索引不可再加入或刪除向量，修改前需以 to_owned() 轉為記憶體內副本。
+
+    Returns:
+        (index, 是否為記憶體映射)
+    """
+    if mmap and hasattr(faiss, 'IO_FLAG_MMAP_IFC'):
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY), True
+        except RuntimeError:
+            pass
+    return faiss.read_index(path), False
+
+
+def to_owned(index):
+    """將記憶體映射的索引複製為可修改的記憶體內索引（clone_index 仍會共用映射資料）"""
+    return faiss.deserialize_index(faiss.serialize_index(index))
+
+
+def supports_remove(config):
+    """
+    索引是否支援直接刪除向量
+
+    HNSW 不支援刪除；IVF 的 remove_ids 不會壓縮內部編號，外層 IndexIDMap2 的 ID 對照會錯位，
+    兩者皆以剩餘向量重建。
+    """
+    return config['type'] not in ('hnsw', 'ivf_flat', 'ivf_pq')
+
+
+def reconstruct_all(index):
+    """
+    取出索引中所有向量（依內部順序）；壓縮類型為近似值，降維索引為降維後的向量
+
+    不修改傳入的索引：IVF 需要的直接對照表建立在私有副本上，持有讀鎖的查詢可同時搜尋共用索引。
+    """
+    inner = _unwrap(index)
+    if isinstance(inner, faiss.IndexIVF) and inner.direct_map.no():
+        inner = faiss.clone_index(inner)
+        inner.make_direct_map()
+    return inner.reconstruct_n(0, inner.ntotal)
+
+
+def search_reranked(index, config, queries, k, vectors=None, rows_of_ids=None, params=None):
+    """
+    搜尋並（壓縮索引時）以原始向量精確重排序
+
+    Args:
+        index: FAISS 索引
+        config: 索引設定
+        queries: 查詢向量 (N×D)
+        k: 回傳數量
+        vectors: 原始向量矩陣（可為 memmap）；None 時不重排序
+        rows_of_ids: 向量 ID -> vectors 列索引的對照陣列；None 表示 ID 即列索引
+        params: FAISS 搜尋參數（例如 make_search_params() 建立的 ID 篩選）
+
+    Returns:
+        (相似度 N×k, ID N×k)，不足 k 筆時以 -1 補齊
+    """
+    rerank = config['params'].get('rerank') if is_compressed(config) else None
+    if not rerank or vectors is None:
+        return index.search(queries, k, params=params)
+
+    _, candidates = index.search(queries, k * rerank, params=params)
+    similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    ids = np.full((len(queries), k), -1, dtype=np.int64)
+    for i, row_ids in enumerate(candidates):
+        row_ids = row_ids[row_ids >= 0]
+        if len(row_ids) == 0:
+            continue
+        rows = row_ids if rows_of_ids is None else rows_of_ids[row_ids]
+        exact = np.asarray(vectors[rows], dtype=np.float32) @ queries[i]
+        top = np.argsort(-exact)[:k]
+        similarities[i, :len(top)] = exact[top]
+        ids[i, :len(top)] = row_ids[top]
+    return similarities, ids
+
+
+def index_nbytes(index):
+    """序列化後的索引大小（位元組）"""
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def benchmark(vectors, index_types=INDEX_TYPES, k=10, n_queries=200, seed=0):
+    """
+    以資料集向量比較各索引類型的 recall@k 與單筆查詢延遲
+
+    隨機取出 n_queries 個向量作為查詢（不放入資料庫），以 flat 結果為標準答案。
+
+    Returns:
+        每個類型一筆結果的列表
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    n_queries = min(n_queries, len(vectors) // 2)
+    perm = rng.permutation(len(vectors))
+    queries = vectors[perm[:n_queries]]
+    database = vectors[perm[n_queries:]]
+    dimension = vectors.shape[1]
+    k = min(k, len(database))
+
+    ground_truth = None
+    results = []
+    for index_type in index_types:
+        config = make_index_config(index_type)
+        start = time.time()
+        index = create_index(config, dimension, database)
+        index.add(database)
+        build_time = time.time() - start
+
+        latencies = []
+        found = np.empty((n_queries, k), dtype=np.int64)
+        for i in range(n_queries):
+            t0 = time.perf_counter()
+            _, ids = search_reranked(index, config, queries[i:i + 1], k, database)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            found[i] = ids[0]
+
+        if ground_truth is None:
+            exact = faiss.IndexFlatIP(dimension)
+            exact.add(database)
+            _, ground_truth = exact.search(queries, k)
+        recall = np.mean([len(np.intersect1d(found[i], ground_truth[i])) / k for i in range(n_queries)])
+
+        results.append({
+            'type': index_type,
+            'params': config['params'],
+            'recall_at_k': float(recall),
+            'k': k,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'build_sec': float(build_time),
+            'size_mb': index_nbytes(index) / (1024 * 1024),
+        })
+        print(f"📊 {index_type:9s} recall@{k}: {recall:.4f} | p50: {results[-1]['p50_ms']:.3f} ms | "
+              f"p99: {results[-1]['p99_ms']:.3f} ms | 建立: {build_time:.1f} 秒 | 大小: {results[-1]['size_mb']:.1f} MB")
+    return results
+
+
+def _load_vectors(source):
+    """
+    讀取資料集的原始向量：faiss（辨識索引）或 clip（clip_features.npy）
+
+    辨識索引依序使用版本目錄中的 faiss_vectors.npy、特徵快取；壓縮或降維索引重建出的向量已是近似值，
+    以其為標準答案會高估召回率，只有 flat 且未降維的索引才退回從索引取回向量。
+    """
+    from index_store import current_index_dir, CLIP_INDEX_ROOT
+    if source == 'clip':
+        return np.load(os.path.join(current_index_dir(CLIP_INDEX_ROOT), 'clip_features.npy'))
+
+    from faiss_recognition import FAISSRecognitionEngine
+    engine = FAISSRecognitionEngine()
+    index_dir = current_index_dir(engine.index_root)
+    if not engine._read_index_state(index_dir):
+        return None
+
+    vectors_path = os.path.join(index_dir, engine.vectors_file)
+    if os.path.exists(vectors_path):
+        return np.load(vectors_path)
+
+    cache = engine._open_feature_cache()
+    if cache is not None:
+        try:
+            rows = cache.find(cache.keys_for([engine.labels.image_path(i) for i in range(len(engine.labels))]))
+        except OSError:
+            rows = np.empty(0, dtype=np.int64)
+        if len(rows) == len(engine.labels) and np.all(rows >= 0):
+            print(f"📂 使用特徵快取中的原始向量 ({engine.feature_namespace})")
+            return cache.read(rows)
+
+    if engine.index_config['type'] == 'flat' and not engine.index_config.get('pca_dim'):
+        print("⚠️  找不到原始向量（faiss_vectors.npy 或完整的特徵快取），改從 flat 索引取回向量")
+        return reconstruct_all(engine.index)
+
+    print(f"❌ 找不到原始向量，{config_label(engine.index_config)} 索引取回的向量為近似值，"
+          f"不能作為標準答案；請先以 flat 索引或啟用特徵快取重新建立索引")
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FAISS 索引類型基準測試（recall@k 與查詢延遲）")
+    parser.add_argument('--source', choices=['faiss', 'clip'], default='faiss', help='向量來源')
+    parser.add_argument('--types', nargs='+', choices=INDEX_TYPES, default=list(INDEX_TYPES), help='要比較的索引類型')
+    parser.add_argument('--k', type=int, default=10, help='recall@k 的 k')
+    parser.add_argument('--queries', type=int, default=200, help='查詢數量')
+    parser.add_argument('--output', default=None, help='結果輸出 JSON 檔')
+    args = parser.parse_args()
+
+    vectors = _load_vectors(args.source)
+    if vectors is None:
+        raise SystemExit(1)
+    print(f"📂 載入 {len(vectors)} 個 {vectors.shape[1]} 維向量 ({args.source})")
+    results = benchmark(vectors, args.types, k=args.k, n_queries=args.queries)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"💾 結果已儲存至 {args.output}")
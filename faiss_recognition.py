@@ -4,315 +4,1454 @@ FAISS-based Image Recognition System
 使用 FAISS 相似度搜索進行圖片識別
 """
 import os
+import io
+import copy
+import threading
 import numpy as np
 import cv2
 import faiss
 import pickle
 from PIL import Image
 import time
-from sklearn.preprocessing import normalize
-from torchvision import transforms, models
+import queue
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import torch
-import torch.nn as nn
+from torch.utils.data import Dataset, DataLoader
+
+from feature_cache import FeatureCache, DEFAULT_CACHE_DIR
+from faiss_index_factory import (INDEX_TYPES, make_index_config, create_index, apply_search_params,
+                                 supports_remove, reconstruct_all, is_compressed, search_reranked,
+                                 index_nbytes, make_search_params, read_index, to_owned, DEFAULT_MMAP,
+                                 config_label, reduce_vectors)
+from inference_backends import DEFAULT_BACKEND, QUANTIZED_BACKENDS, create_backend
+from backbones import (BACKBONES, backbone_spec, make_transform, feature_namespace, build_backbone,
+                       LEGACY_BACKBONE)
+from model_weights import WEIGHTS_ERRORS
+from inference_batcher import InferenceBatcher
+from image_batches import collate_images, init_decode_worker
+from label_store import LabelStore, LABELS_FILE, LEGACY_LABELS_FILE
+from index_store import (DEFAULT_INDEX_ROOT, RWLock, current_version, current_index_dir, begin_version,
+                         abort_version, publish)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# 建立索引時的批次大小與解碼 worker 數（可由環境變數覆寫）
+DEFAULT_BATCH_SIZE = int(os.environ.get('FAISS_BUILD_BATCH_SIZE', 32))
+DEFAULT_NUM_WORKERS = int(os.environ.get('FAISS_BUILD_WORKERS', max(0, min(4, (os.cpu_count() or 1) - 1))))
+# 分片建立：依類別切成多個分片由行程池平行解碼與前向傳播（1 表示單一行程）
+DEFAULT_BUILD_SHARDS = int(os.environ.get('FAISS_BUILD_SHARDS', 1))
+
+# 批次預測時的圖片預處理執行緒數
+PREDICT_PREPROCESS_THREADS = int(os.environ.get('FAISS_PREDICT_THREADS', min(8, os.cpu_count() or 1)))
+
+# 兩階段搜尋：先以類別原型挑出前 N 個候選類別，再只搜尋這些類別的視角（0 表示停用）
+DEFAULT_COARSE_CLASSES = int(os.environ.get('FAISS_COARSE_CLASSES', 10))
+# 每個類別除平均向量外的 k-means 子中心數
+DEFAULT_PROTOTYPE_SUBCENTROIDS = 4
+
+# 預測結果保證的不同類別數；鄰近視角幾乎相同，前 k 個鄰居常全屬同一類別，因此依需要加量搜尋
+DEFAULT_TOP_CLASSES = int(os.environ.get('FAISS_TOP_CLASSES', 5))
+DISTINCT_OVERFETCH = 4  # 初次搜尋數 = 類別數 × 此倍數，不足時每輪再乘以此倍數
+MAX_FETCH = 4096
+
+# 建立報告中留一法（leave-one-out）評估最多使用的查詢數，資料集較大時隨機抽樣
+LOO_EVAL_SAMPLES = int(os.environ.get('FAISS_EVAL_SAMPLES', 2000))
+
+# 開放集合拒識：查詢與每個類別都不夠相似時直接回傳「無相符模型」（FAISS_OPEN_SET=0 停用）
+OPEN_SET_ENABLED = os.environ.get('FAISS_OPEN_SET', '1') != '0'
+# 各類別門檻 = 同類別最近鄰相似度的低分位數 - 邊際；最近異類別明顯較遠時提高到兩者的中點
+REJECT_MARGIN = float(os.environ.get('FAISS_REJECT_MARGIN', 0.05))
+REJECT_GENUINE_QUANTILE = 0.01
+REJECT_IMPOSTOR_QUANTILE = 0.99
+REJECT_CALIBRATION_PER_CLASS = 16  # 每個類別抽樣的校準查詢數
+REJECT_NEIGHBOURS = 10  # 拒識判斷搜尋的鄰居數
+
+# 索引版本監看間隔（秒）：偵測到新發布的版本時於背景載入並熱切換
+DEFAULT_RELOAD_INTERVAL = float(os.environ.get('FAISS_RELOAD_INTERVAL', 5))
+
+# 熱切換時整組替換的索引狀態屬性
+INDEX_STATE_ATTRS = ('index', 'labels', 'classes', 'next_id', 'class_signatures', 'index_config',
+                     '_row_of_id', '_ids_of_class', 'vectors', 'prototypes', 'prototype_class_ids',
+                     'prototype_index', 'index_dir', 'version', 'index_mmapped', 'build_report',
+                     'backbone', 'transform', 'feature_namespace', 'feature_extractor', 'backend',
+                     'class_thresholds', 'dataset_dir')
+
+
+def _log(message):
+    """輸出帶時間戳記的訊息（訓練介面依此格式解析進度）"""
+    print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+
+def list_class_images(class_dir):
+    """列出類別目錄中的圖片檔名（排序後）"""
+    return sorted(f for f in os.listdir(class_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def compute_class_prototypes(vectors, n_subcentroids=DEFAULT_PROTOTYPE_SUBCENTROIDS, seed=1234):
+    """
+    計算單一類別的原型：正規化平均向量 + k-means 子中心
+
+    Returns:
+        原型矩陣 (1 + 子中心數) × D
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    mean = vectors.mean(axis=0, keepdims=True)
+    prototypes = [mean]
+    n_sub = min(n_subcentroids, len(vectors) // 2)
+    if n_sub >= 2:
+        kmeans = faiss.Kmeans(vectors.shape[1], n_sub, niter=20, spherical=True, seed=seed,
+                              min_points_per_centroid=1, verbose=False)
+        kmeans.train(vectors)
+        prototypes.append(kmeans.centroids)
+    prototypes = np.vstack(prototypes).astype(np.float32)
+    faiss.normalize_L2(prototypes)
+    return prototypes
+
+
+def self_knn(vectors, k, queries=None):
+    """
+    以精確內積搜尋資料集內每個查詢向量的 k 個最近鄰（排除查詢自身）
+
+    Args:
+        vectors: 資料向量 N×D（已 L2 正規化）
+        k: 鄰居數
+        queries: 作為查詢的列索引（預設全部）
+
+    Returns:
+        (相似度 Q×k, 鄰居列索引 Q×k)
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.arange(len(vectors)) if queries is None else np.asarray(queries)
+    index = faiss.IndexFlatIP(vectors.shape[1])
+    index.add(vectors)
+    k = min(k, len(vectors) - 1)
+    similarities, rows = index.search(vectors[queries], k + 1)
+    return drop_self_matches(similarities, rows, queries)
+
+
+def drop_self_matches(similarities, ids, self_ids):
+    """
+    從 k+1 個鄰居中去掉查詢自身，回傳 k 個鄰居
+
+    完全相同的圖片可能排在自身之前，因此依 ID 比對；結果中找不到自身時去掉最後一個。
+    """
+    k = ids.shape[1] - 1
+    is_self = ids == np.asarray(self_ids)[:, None]
+    drop = np.where(is_self.any(axis=1), is_self.argmax(axis=1), k)
+    keep = np.ones(ids.shape, dtype=bool)
+    keep[np.arange(len(ids)), drop] = False
+    return similarities[keep].reshape(-1, k), ids[keep].reshape(-1, k)
+
+
+def loo_top1_accuracy(vectors, class_ids, n_samples=LOO_EVAL_SAMPLES, seed=0):
+    """留一法 top-1 準確率：每個（抽樣的）向量以其餘向量中最相似者的類別作為預測"""
+    class_ids = np.asarray(class_ids)
+    queries = np.arange(len(class_ids))
+    if len(queries) > n_samples:
+        queries = np.sort(np.random.default_rng(seed).choice(queries, n_samples, replace=False))
+    _, rows = self_knn(vectors, 1, queries)
+    return float(np.mean(class_ids[rows[:, 0]] == class_ids[queries]))
+
+
+def _class_threshold(genuine, impostor, margin=REJECT_MARGIN):
+    """
+    由單一類別的同類別/異類別相似度計算拒識門檻
+
+    門檻以同類別相似度為準，最近的異類別只能提高門檻（低於同類別時取兩者中點），不能降低，
+    否則相鄰類別越近門檻越低，未知物件都會被接受。沒有同類別資料（單張圖片的類別）時退回
+    異類別相似度；兩者皆無資料時回傳 -inf（不拒識）。
+    """
+    genuine, impostor = np.asarray(genuine), np.asarray(impostor)
+    genuine, impostor = genuine[np.isfinite(genuine)], impostor[np.isfinite(impostor)]
+    if len(genuine) == 0:
+        return float(np.quantile(impostor, REJECT_IMPOSTOR_QUANTILE) - margin) if len(impostor) > 0 else float('-inf')
+    genuine_bound = np.quantile(genuine, REJECT_GENUINE_QUANTILE)
+    threshold = genuine_bound - margin
+    if len(impostor) > 0:
+        impostor_bound = np.quantile(impostor, REJECT_IMPOSTOR_QUANTILE)
+        if impostor_bound < genuine_bound:
+            threshold = max(threshold, (impostor_bound + genuine_bound) / 2)
+    return float(threshold)
+
+
+def calibrate_thresholds(vectors, class_ids, n_classes, per_class=REJECT_CALIBRATION_PER_CLASS, seed=0,
+                         classes=None):
+    """
+    以留一法統計校準各類別的開放集合拒識門檻
+
+    每個類別抽樣 per_class 個向量作為查詢（排除自身）：同類別最近鄰的相似度為真實匹配分數，
+    最近的異類別鄰居相似度為冒名分數。
+
+    Args:
+        classes: 只校準這些 class_id（其餘類別的門檻為 NaN），預設全部
+
+    Returns:
+        (各類別門檻 float32 陣列, 統計 dict)
+    """
+    class_ids = np.asarray(class_ids)
+    counts = np.bincount(class_ids, minlength=n_classes)
+    calibrated = range(n_classes) if classes is None else classes
+    rng = np.random.default_rng(seed)
+    queries = np.concatenate([
+        rng.choice(np.flatnonzero(class_ids == c), min(per_class, counts[c]), replace=False)
+        for c in calibrated if counts[c] > 0
+    ] or [np.empty(0, dtype=np.int64)])
+    # 鄰居數需涵蓋整個同類別才保證找得到異類別鄰居
+    similarities, rows = self_knn(vectors, int(counts.max()) + REJECT_NEIGHBOURS, queries)
+    query_classes = class_ids[queries]
+    same = class_ids[rows] == query_classes[:, None]
+    first_same, first_other = same.argmax(axis=1), (~same).argmax(axis=1)
+    picked = np.arange(len(queries))
+    genuine = np.where(same.any(axis=1), similarities[picked, first_same], np.nan)
+    impostor = np.where((~same).any(axis=1), similarities[picked, first_other], np.nan)
+
+    thresholds = np.full(n_classes, np.nan, dtype=np.float32)
+    for c in calibrated:
+        thresholds[c] = _class_threshold(genuine[query_classes == c], impostor[query_classes == c])
+    # 估計：已知類別被誤拒的比例；以及把查詢類別當作未知物件時（最近的異類別被視為最佳匹配）被拒識的比例
+    has_genuine, has_impostor = np.isfinite(genuine), np.isfinite(impostor)
+    impostor_classes = class_ids[rows[picked, first_other]]
+    stats = {
+        'margin': REJECT_MARGIN,
+        'mean_threshold': float(np.mean(thresholds[np.isfinite(thresholds)])) if np.isfinite(thresholds).any() else None,
+        'known_accept_rate': float(np.mean(genuine[has_genuine] >= thresholds[query_classes[has_genuine]]))
+        if has_genuine.any() else None,
+        'unknown_reject_rate': float(np.mean(impostor[has_impostor] < thresholds[impostor_classes[has_impostor]]))
+        if has_impostor.any() else None
+    }
+    return thresholds, stats
+
+
+def open_image(image):
+    """開啟圖片：支援檔案路徑、bytes、檔案物件或 PIL Image"""
+    if isinstance(image, Image.Image):
+        return image.convert('RGB')
+    if isinstance(image, (bytes, bytearray)):
+        image = io.BytesIO(image)
+    return Image.open(image).convert('RGB')
+
+
+def _class_signature(class_dir):
+    """類別目錄簽章：[圖片數, 最新修改時間(ns)]"""
+    if not os.path.isdir(class_dir):
+        return [0, 0]
+    images = list_class_images(class_dir)
+    latest = max((os.stat(os.path.join(class_dir, f)).st_mtime_ns for f in images), default=0)
+    return [len(images), latest]
+
+
+class _ImageFileDataset(Dataset):
+    """在 DataLoader worker 中解碼並預處理圖片"""
+
+    def __init__(self, image_paths, transform):
+        self.image_paths = image_paths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        try:
+            image = Image.open(self.image_paths[idx]).convert('RGB')
+            return self.transform(image), idx
+        except Exception as e:
+            print(f"❌ 特徵提取失敗 {self.image_paths[idx]}: {e}", flush=True)
+            return None, idx
+
+
+def _split_shards(group_bounds, shards):
+    """
+    將連續的類別群組切成最多 shards 個連續分片，各分片圖片數盡量相近
+
+    Args:
+        group_bounds: 各類別在序列中的結束位置（遞增）
+
+    Returns:
+        [(起點, 終點), ...]，分片邊界必落在類別邊界上
+    """
+    group_bounds = np.asarray(group_bounds, dtype=np.int64)
+    total = int(group_bounds[-1]) if len(group_bounds) else 0
+    targets = total * np.arange(1, shards) / shards
+    cuts = np.unique(group_bounds[np.minimum(np.searchsorted(group_bounds, targets), len(group_bounds) - 1)])
+    edges = [0] + [int(c) for c in cuts if 0 < c < total] + [total]
+    return [(start, end) for start, end in zip(edges[:-1], edges[1:]) if end > start]
+
+
+def _extract_shard(image_paths, offset, backbone, backend, batch_size, torch_threads, results):
+    """
+    分片 worker：提取一個分片的特徵，每個批次以 (特徵, 全域索引, 批次起點, 批次大小) 送回主行程
+
+    torch 執行緒數固定為 torch_threads，所有分片合計不超過 CPU 核心數。
+    """
+    torch.set_num_threads(torch_threads)
+    try:
+        engine = FAISSRecognitionEngine(feature_cache_dir=None, backend=backend, backbone=backbone)
+        for batch_features, batch_indices, batch_start, batch_len in engine._iter_feature_batches(
+                image_paths, batch_size, num_workers=0):
+            results.put((batch_features, [offset + i for i in batch_indices], offset + batch_start, batch_len))
+    finally:
+        results.put(None)
+
 
 class FAISSRecognitionEngine:
-    def __init__(self):
+    def __init__(self, feature_cache_dir=DEFAULT_CACHE_DIR, index_type=None, index_params=None,
+                 coarse_classes=None, backend=None, index_root=None, backbone=None):
         self.index = None
         self.labels = None
         self.feature_extractor = None
+        # 推論後端（torch / torchscript / onnx / onnx_int8），None 表示直接使用 PyTorch 模型
+        self.backend_name = backend or DEFAULT_BACKEND
+        self.backend = None
         self.classes = []
+        self.next_id = 0  # 下一個可用的向量 ID（ID 永不重複使用）
+        self.class_signatures = {}  # 類別 -> [圖片數, 最新修改時間]，用於偵測資料集變更
+        self.build_report = {}  # 建立時的評估結果（例如降維前後準確率），隨索引儲存
+        self.class_thresholds = None  # 各類別的開放集合拒識門檻（None 表示不拒識，例如舊版索引）
+        self.dataset_dir = "dataset"  # 建立索引的資料集目錄（隨索引儲存，int8 後端以其中的圖片校正）
+        self.open_set = OPEN_SET_ENABLED
+        self._row_of_id = np.empty(0, dtype=np.int64)  # 向量 ID -> self.labels 的列索引
+        self.vectors = None  # 壓縮索引的原始向量（與 self.labels 列對齊，載入時為唯讀 memmap）
+        self._ids_of_class = []  # class_id -> 該類別的向量 ID 陣列
+
+        # 類別原型（兩階段搜尋的粗篩階段）
+        self.prototypes_file = "faiss_prototypes.npz"
+        self.prototypes = None  # P × D
+        self.prototype_class_ids = np.empty(0, dtype=np.int32)  # 每個原型所屬的 class_id
+        self.prototype_index = None
+        self.coarse_classes = DEFAULT_COARSE_CLASSES if coarse_classes is None else coarse_classes
+        # 索引檔名（位於版本目錄內）
         self.index_file = "faiss_features.index"
-        self.labels_file = "faiss_labels.pkl"
+        self.labels_file = LABELS_FILE  # 欄位式標籤檔（LabelStore）
+        self.legacy_labels_file = LEGACY_LABELS_FILE  # 舊版 pickle 標籤檔，載入時自動轉換
+        self.vectors_file = "faiss_vectors.npy"
         self.loaded = False
 
-        # 預處理轉換
-        self.transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                               std=[0.229, 0.224, 0.225])
-        ])
+        # 版本化索引目錄：每次儲存發布新版本，讀取端監看 CURRENT 並熱切換
+        self.index_root = index_root or DEFAULT_INDEX_ROOT
+        self.index_dir = None  # 目前載入的版本目錄
+        self.version = None
+        self._state_lock = RWLock()  # 查詢持有讀鎖，熱切換持有寫鎖
+        self._watcher = None
+        self._stop_watcher = threading.Event()
+
+        # 記憶體映射載入：索引與原始向量直接映射版本目錄內的檔案（唯讀，修改前轉為記憶體內副本）
+        self.use_mmap = DEFAULT_MMAP
+        self.index_mmapped = False
+
+        # 特徵快取：以圖片內容雜湊 + 特徵版本為鍵，重建索引時只提取新圖片
+        self.feature_cache_dir = feature_cache_dir
+
+        # 骨幹網路與預處理（建立時決定並隨索引儲存，載入索引時切換為建立時的設定）
+        self._set_backbone(backbone_spec(backbone))
+
+        # 索引類型（flat / ivf_flat / ivf_pq / hnsw），建立時決定並隨索引儲存
+        self.index_config = make_index_config(index_type, **(index_params or {}))
+
+    def _set_backbone(self, spec):
+        """設定骨幹網路、預處理與特徵快取命名空間（特徵提取器於下次使用時載入）"""
+        self.backbone = spec
+        self.transform = make_transform(spec)
+        # 特徵版本：骨幹網路 + 權重 + 預處理，量化後端的特徵略有差異，使用獨立命名空間
+        self.feature_namespace = feature_namespace(spec)
+        if self.backend_name in QUANTIZED_BACKENDS:
+            self.feature_namespace = f"{self.feature_namespace}_{self.backend_name}"
+        self.feature_extractor = None
+        self.backend = None
 
     def load_feature_extractor(self):
         """載入特徵提取模型"""
         import time
         current_time = time.strftime('%H:%M:%S')
-        print(f"[{current_time}] 📦 載入 ResNet50 特徵提取器...")
+        print(f"[{current_time}] 📦 載入 {self.backbone['name']} 特徵提取器...")
 
-        # 使用預訓練的 ResNet50 (新版 API)
         import warnings
         warnings.filterwarnings('ignore', category=UserWarning)
+        self.feature_extractor = build_backbone(self.backbone['name'])
 
-        try:
-            # 嘗試使用新版 API (torchvision >= 0.13)
-            from torchvision.models import ResNet50_Weights
-            self.feature_extractor = models.resnet50(weights=ResNet50_Weights.IMAGENET1K_V1)
-        except (ImportError, AttributeError):
-            # 降級到舊版 API
-            self.feature_extractor = models.resnet50(pretrained=True)
-
-        self.feature_extractor = nn.Sequential(*list(self.feature_extractor.children())[:-1])
-        self.feature_extractor.eval()
+        # 匯出/載入 CPU 推論後端
+        self.backend = create_backend(self.backend_name, self.feature_extractor, self.transform,
+                                      dataset_dir=self.dataset_dir, backbone=self.backbone)
+        current_time = time.strftime('%H:%M:%S')
+        if self.backend is not None:
+            print(f"[{current_time}] ⚡ 使用 {self.backend.name} 推論後端")
+            return
 
         # 移動到 GPU（如果可用）
-        current_time = time.strftime('%H:%M:%S')
         if torch.cuda.is_available():
             self.feature_extractor = self.feature_extractor.cuda()
             print(f"[{current_time}] 🚀 使用 GPU 加速")
         else:
             print(f"[{current_time}] 💻 使用 CPU 運算")
 
+    def extract_features_batch(self, input_tensor):
+        """批次提取特徵向量（輸入為已預處理的 N×3×H×W 張量）"""
+        if self.feature_extractor is None:
+            self.load_feature_extractor()
+
+        if self.backend is not None:
+            features = self.backend(input_tensor)
+        else:
+            if torch.cuda.is_available():
+                input_tensor = input_tensor.cuda(non_blocking=True)
+
+            with torch.no_grad():
+                features = self.feature_extractor(input_tensor)
+                features = features.flatten(1).cpu().numpy().astype(np.float32)
+
+        # 正規化特徵向量
+        faiss.normalize_L2(features)
+        return features
+
     def extract_features(self, image_path):
         """從圖片提取特徵向量"""
         try:
             # 載入和預處理圖片
             image = Image.open(image_path).convert('RGB')
             input_tensor = self.transform(image).unsqueeze(0)
+            return self.extract_features_batch(input_tensor)[0]
 
-            if torch.cuda.is_available():
-                input_tensor = input_tensor.cuda()
+        except Exception as e:
+            print(f"❌ 特徵提取失敗 {image_path}: {e}")
+            return None
 
-            with torch.no_grad():
-                features = self.feature_extractor(input_tensor)
-                features = features.flatten().cpu().numpy()
+    def _iter_feature_batches(self, image_paths, batch_size=None, num_workers=None):
+        """
+        以 DataLoader 批次提取特徵
 
-            # 正規化特徵向量
-            features = normalize([features])[0]
-            return features
+        Yields:
+            (特徵矩陣或 None, 成功圖片在 image_paths 中的索引, 批次起點, 批次原始大小)
+        """
+        if batch_size is None:
+            batch_size = DEFAULT_BATCH_SIZE
+        if num_workers is None:
+            num_workers = DEFAULT_NUM_WORKERS
 
-        except Exception as e:
-            print(f"❌ 特徵提取失敗 {image_path}: {e}")
+        loader = DataLoader(
+            _ImageFileDataset(image_paths, self.transform),
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
+            collate_fn=collate_images,
+            pin_memory=torch.cuda.is_available(),
+            worker_init_fn=init_decode_worker if num_workers > 0 else None
+        )
+
+        batch_start = 0
+        for batch_tensor, batch_indices, batch_len in loader:
+            if batch_tensor is None:
+                yield None, [], batch_start, batch_len
+            else:
+                yield self.extract_features_batch(batch_tensor), batch_indices, batch_start, batch_len
+            batch_start += batch_len
+
+    def _iter_sharded_feature_batches(self, image_paths, group_bounds, shards, batch_size=None):
+        """
+        以行程池分片提取特徵（分片依類別邊界切分），批次依完成順序回傳
+
+        Args:
+            group_bounds: 各類別在 image_paths 中的結束位置
+            shards: 分片數（同時也是行程數）
+
+        Yields:
+            與 _iter_feature_batches 相同
+        """
+        if batch_size is None:
+            batch_size = DEFAULT_BATCH_SIZE
+        ranges = _split_shards(group_bounds, shards)
+        torch_threads = max(1, (os.cpu_count() or 1) // len(ranges))
+        _log(f"🧩 分片建立: {len(ranges)} 個分片 | 每個分片 {torch_threads} 個 torch 執行緒 | "
+             f"分片大小: {', '.join(str(end - start) for start, end in ranges)}")
+
+        # 先在主行程準備推論後端（匯出模型檔），避免各分片同時匯出
+        if self.backend_name != 'torch' and self.feature_extractor is None:
+            self.load_feature_extractor()
+
+        # spawn：避免 fork 已初始化的 torch/OpenMP 執行緒造成死結
+        context = multiprocessing.get_context('spawn')
+        with context.Manager() as manager, \
+                ProcessPoolExecutor(max_workers=len(ranges), mp_context=context) as pool:
+            results = manager.Queue()
+            futures = [pool.submit(_extract_shard, image_paths[start:end], start, self.backbone['name'], self.backend_name,
+                                   batch_size, torch_threads, results)
+                       for start, end in ranges]
+            running = len(futures)
+            while running:
+                try:
+                    message = results.get(timeout=1)
+                except queue.Empty:
+                    # worker 異常結束（例如記憶體不足被終止）時不會送出結束訊息
+                    for future in futures:
+                        if future.done() and future.exception() is not None:
+                            raise future.exception()
+                    continue
+                if message is None:
+                    running -= 1
+                else:
+                    yield message
+            for future in futures:
+                future.result()
+
+    def _open_feature_cache(self):
+        """開啟目前骨幹網路版本的特徵快取（停用時回傳 None）"""
+        if not self.feature_cache_dir:
             return None
+        return FeatureCache(self.feature_namespace, self.feature_cache_dir)
+
+    def _extract_paths(self, image_paths, batch_size=None, num_workers=None, progress=None,
+                       group_bounds=None, shards=1):
+        """
+        提取多張圖片的特徵，已快取的圖片直接讀取不重新計算
+
+        Args:
+            image_paths: 圖片路徑列表
+            progress: 進度回呼 progress(快取命中數, 已提取數, 待提取索引陣列, 本批在待提取序列中的 (起點, 終點))
+            group_bounds: 各類別在 image_paths 中的結束位置（分片建立時使用）
+            shards: 分片數；大於 1 時以行程池依類別分片提取（快取讀寫仍只在主行程）
+
+        Returns:
+            (特徵矩陣, 成功圖片在 image_paths 中的索引)，特徵列與索引一一對應
+        """
+        total = len(image_paths)
+        cache = self._open_feature_cache()
+        hit_rows = np.full(total, -1, dtype=np.int64)
+        keys = None
+        if cache is not None:
+            keys = cache.keys_for(image_paths)
+            hit_rows = cache.find(keys)
+
+        miss_indices = np.flatnonzero(hit_rows < 0)
+        hit_count = total - len(miss_indices)
+        if cache is not None:
+            _log(f"♻️  特徵快取命中 {hit_count} 張，需提取 {len(miss_indices)} 張")
+        if progress:
+            progress(hit_count, 0, miss_indices, (0, 0))
+
+        computed_indices = []
+        computed_features = []
+        miss_done = 0
+        miss_paths = [image_paths[i] for i in miss_indices]
+        if miss_paths:
+            if shards > 1 and group_bounds is not None and len(group_bounds) > 1:
+                miss_bounds = np.searchsorted(miss_indices, group_bounds)
+                batches = self._iter_sharded_feature_batches(miss_paths, miss_bounds, shards, batch_size)
+            else:
+                batches = self._iter_feature_batches(miss_paths, batch_size, num_workers)
+            # 各批次依索引放回原位置，分片的完成順序不影響結果
+            for batch_features, batch_indices, batch_start, batch_len in batches:
+                if batch_features is not None:
+                    computed_features.append(batch_features)
+                    computed_indices.extend(int(miss_indices[i]) for i in batch_indices)
+                miss_done += batch_len
+                if progress:
+                    progress(hit_count, miss_done, miss_indices, (batch_start, batch_start + batch_len))
+
+        if computed_features:
+            computed = np.vstack(computed_features)
+            if cache is not None:
+                cache.put([keys[i] for i in computed_indices], computed)
+        else:
+            computed = None
+        if cache is not None:
+            cache.save()
 
-    def build_index(self, dataset_dir=None):
-        """建立 FAISS 索引"""
+        dimension = computed.shape[1] if computed is not None else cache.dim if hit_count else None
+        if dimension is None:
+            return np.empty((0, 0), dtype=np.float32), []
+
+        features_array = np.zeros((total, dimension), dtype=np.float32)
+        valid = hit_rows >= 0
+        if hit_count:
+            features_array[valid] = cache.read(hit_rows[valid])
+        if computed is not None:
+            features_array[computed_indices] = computed
+            valid[computed_indices] = True
+
+        valid_indices = np.flatnonzero(valid)
+        return features_array[valid_indices], valid_indices.tolist()
+
+    def build_index(self, dataset_dir=None, batch_size=None, num_workers=None, shards=None):
+        """
+        建立 FAISS 索引
+
+        圖片由多個 worker 進程解碼與預處理，組成批次後一次送入骨幹網路。
+        shards 大於 1 時依類別切成分片，由行程池各自解碼與前向傳播，再依 self.classes 順序合併。
+
+        Args:
+            dataset_dir: 資料集目錄（預設 dataset）
+            batch_size: 每批次圖片數（預設 DEFAULT_BATCH_SIZE）
+            num_workers: 解碼 worker 進程數（預設 DEFAULT_NUM_WORKERS，0 表示在主進程解碼）
+            shards: 分片行程數（預設 DEFAULT_BUILD_SHARDS）
+        """
         if dataset_dir is None:
             # 使用標準資料集目錄
             dataset_dir = "dataset"
+        if batch_size is None:
+            batch_size = DEFAULT_BATCH_SIZE
+        if num_workers is None:
+            num_workers = DEFAULT_NUM_WORKERS
+        if shards is None:
+            shards = DEFAULT_BUILD_SHARDS
+        shards = max(1, min(shards, os.cpu_count() or 1))
 
         if not os.path.exists(dataset_dir):
             print("❌ 找不到資料集目錄")
             return False
+        self.dataset_dir = dataset_dir
 
         print(f"🏗️  建立 FAISS 索引從 {dataset_dir}")
 
-        # 載入特徵提取器
-        if self.feature_extractor is None:
-            self.load_feature_extractor()
-
-        features_list = []
-        labels_list = []
-
         # 掃描所有類別
         classes = [d for d in os.listdir(dataset_dir) if os.path.isdir(os.path.join(dataset_dir, d))]
         self.classes = sorted(classes)
 
-        import time
-        start_time = time.time()
-        current_time = time.strftime('%H:%M:%S')
+        if not self.classes:
+            _log("❌ 資料集中沒有找到任何類別")
+            return False
 
-        print(f"[{current_time}] 📂 找到 {len(self.classes)} 個類別: {', '.join(self.classes[:5])}{'...' if len(self.classes) > 5 else ''}")
+        start_time = time.time()
+        _log(f"📂 找到 {len(self.classes)} 個類別: {', '.join(self.classes[:5])}{'...' if len(self.classes) > 5 else ''}")
 
-        # 計算總圖片數
-        total_images = 0
-        for class_name in self.classes:
+        # 收集所有圖片（依類別順序排列，class_bounds 記錄每個類別的結束位置）
+        image_paths = []
+        image_class_ids = []
+        class_bounds = []
+        for class_id, class_name in enumerate(self.classes):
             class_dir = os.path.join(dataset_dir, class_name)
-            images = [f for f in os.listdir(class_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-            total_images += len(images)
+            images = list_class_images(class_dir)
+            image_paths.extend(os.path.join(class_dir, img_name) for img_name in images)
+            image_class_ids.extend([class_id] * len(images))
+            class_bounds.append(len(image_paths))
 
-        current_time = time.strftime('%H:%M:%S')
-        print(f"[{current_time}] 📊 總共需要處理 {total_images} 張圖片 (來自 {len(self.classes)} 個類別)")
-        print(f"[{current_time}] ⚡ 平均每個類別: {total_images // len(self.classes)} 張圖片")
+        total_images = len(image_paths)
+        _log(f"📊 總共需要處理 {total_images} 張圖片 (來自 {len(self.classes)} 個類別)")
+        _log(f"⚡ 平均每個類別: {total_images // len(self.classes)} 張圖片")
+        if shards > 1:
+            _log(f"⚙️  批次大小: {batch_size} | 分片行程: {shards}")
+        else:
+            _log(f"⚙️  批次大小: {batch_size} | 解碼 worker: {num_workers}")
+
+        if total_images == 0:
+            _log("❌ 沒有成功提取任何特徵")
+            return False
 
         processed_count = 0
+        miss_bounds = None
+        class_remaining = None  # 各類別尚未提取的圖片數
+        class_started = {}  # class_id -> 開始時間
+        class_done = np.zeros(len(self.classes), dtype=bool)
 
-        for class_id, class_name in enumerate(self.classes):
-            class_start_time = time.time()
-            class_dir = os.path.join(dataset_dir, class_name)
-            images = [f for f in os.listdir(class_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-
-            current_time = time.strftime('%H:%M:%S')
-            print(f"[{current_time}] 🔍 處理類別 [{class_id+1}/{len(self.classes)}] {class_name}: {len(images)} 張圖片")
-
-            for img_idx, img_name in enumerate(images):
-                img_path = os.path.join(class_dir, img_name)
-                features = self.extract_features(img_path)
-
-                if features is not None:
-                    features_list.append(features)
-                    labels_list.append({
-                        'class_id': class_id,
-                        'class_name': class_name,
-                        'image_path': img_path
-                    })
-
-                processed_count += 1
-
-                # 每處理10張圖片輸出一次進度
-                if processed_count % 10 == 0 or processed_count == total_images:
-                    progress_percent = (processed_count / total_images * 100)
-                    elapsed = time.time() - start_time
-                    if processed_count > 0:
-                        avg_time_per_image = elapsed / processed_count
-                        remaining_images = total_images - processed_count
-                        estimated_remaining = avg_time_per_image * remaining_images
-                        current_time = time.strftime('%H:%M:%S')
-                        print(f"[{current_time}] ⏳ 進度: {processed_count}/{total_images} 張圖片 ({progress_percent:.1f}%) | 預估剩餘: {estimated_remaining/60:.1f} 分鐘")
-
-            # 每個類別完成後輸出進度
-            class_elapsed = time.time() - class_start_time
-            class_progress = ((class_id + 1) / len(self.classes) * 100)
-            current_time = time.strftime('%H:%M:%S')
-            print(f"[{current_time}] ✅ 類別 {class_name} 處理完成 ({len(images)} 張, {class_elapsed:.1f}秒) | 總進度: {class_progress:.1f}%")
-
-        if len(features_list) == 0:
-            current_time = time.strftime('%H:%M:%S')
-            print(f"[{current_time}] ❌ 沒有成功提取任何特徵")
+        def report_progress(hit_count, miss_done, miss_indices, batch_range):
+            """輸出整體進度與類別開始/完成訊息（分片建立時批次可能不依順序完成）"""
+            nonlocal processed_count, miss_bounds, class_remaining
+            if miss_bounds is None:
+                # 每個類別在待提取序列中的結束位置
+                miss_bounds = np.searchsorted(miss_indices, class_bounds)
+                class_remaining = np.diff(miss_bounds, prepend=0)
+            processed_count = hit_count + miss_done
+
+            if miss_done > 0 or len(miss_indices) == 0:
+                progress_percent = (processed_count / total_images * 100)
+                elapsed = time.time() - start_time
+                images_per_sec = (miss_done or processed_count) / elapsed if elapsed > 0 else 0.0
+                remaining = len(miss_indices) - miss_done
+                estimated_remaining = remaining / images_per_sec if images_per_sec > 0 else 0.0
+                _log(f"⏳ 進度: {processed_count}/{total_images} 張圖片 ({progress_percent:.1f}%) | 預估剩餘: {estimated_remaining/60:.1f} 分鐘 | 速度: {images_per_sec:.1f} 張/秒")
+
+            # 本批次涵蓋的類別（含已全部快取、不需提取的類別）
+            batch_start, batch_end = batch_range
+            first = np.searchsorted(miss_bounds, batch_start, side='right')
+            last = np.searchsorted(miss_bounds, batch_end, side='left') if batch_end > batch_start else first - 1
+            if batch_end > batch_start:
+                counts = np.minimum(miss_bounds[first:last + 1], batch_end) - \
+                    np.maximum(np.concatenate([[0], miss_bounds])[first:last + 1], batch_start)
+                class_remaining[first:last + 1] -= counts
+
+            touched = np.zeros(len(self.classes), dtype=bool)
+            touched[first:last + 1] = True
+            for class_id in np.flatnonzero(~class_done & (touched | (class_remaining == 0))):
+                class_size = class_bounds[class_id] - (class_bounds[class_id - 1] if class_id > 0 else 0)
+                if class_id not in class_started:
+                    class_started[class_id] = time.time()
+                    _log(f"🔍 處理類別 [{class_id+1}/{len(self.classes)}] {self.classes[class_id]}: {class_size} 張圖片")
+                if class_remaining[class_id] == 0:
+                    class_done[class_id] = True
+                    class_elapsed = time.time() - class_started[class_id]
+                    class_progress = (class_done.sum() / len(self.classes) * 100)
+                    _log(f"✅ 類別 {self.classes[class_id]} 處理完成 ({class_size} 張, {class_elapsed:.1f}秒) | 總進度: {class_progress:.1f}%")
+
+        features_array, valid_indices = self._extract_paths(image_paths, batch_size, num_workers,
+                                                            progress=report_progress,
+                                                            group_bounds=class_bounds, shards=shards)
+
+        if len(valid_indices) == 0:
+            _log("❌ 沒有成功提取任何特徵")
             return False
 
-        # 轉換為 numpy 陣列
-        current_time = time.strftime('%H:%M:%S')
-        print(f"[{current_time}] 🔄 轉換特徵為 numpy 陣列...")
-        features_array = np.array(features_list, dtype=np.float32)
+        labels = LabelStore.from_columns(self.classes,
+                                         [image_class_ids[i] for i in valid_indices],
+                                         np.arange(len(valid_indices)),
+                                         [image_paths[i] for i in valid_indices])
 
-        current_time = time.strftime('%H:%M:%S')
-        print(f"[{current_time}] 📊 特徵維度: {features_array.shape}")
-        print(f"[{current_time}] 📊 特徵向量數: {features_array.shape[0]} 個")
-        print(f"[{current_time}] 📊 特徵維度大小: {features_array.shape[1]} 維")
+        _log(f"📊 特徵維度: {features_array.shape}")
+        _log(f"📊 特徵向量數: {features_array.shape[0]} 個")
+        _log(f"📊 特徵維度大小: {features_array.shape[1]} 維")
 
         # 建立 FAISS 索引
-        current_time = time.strftime('%H:%M:%S')
-        print(f"[{current_time}] 🏗️  建立 FAISS 索引 (IndexFlatIP)...")
+        _log(f"🏗️  建立 FAISS 索引 ({config_label(self.index_config)})...")
         dimension = features_array.shape[1]
-        self.index = faiss.IndexFlatIP(dimension)  # 使用內積相似度
-        self.index.add(features_array)
-        self.labels = labels_list
+        self.index = self._create_index(dimension, features_array)
+        self.index.add_with_ids(features_array, np.arange(len(labels), dtype=np.int64))
+        self.index_mmapped = False
+        self.labels = labels
+        self.vectors = features_array if is_compressed(self.index_config) else None
+        if self.vectors is not None:
+            index_mb = index_nbytes(self.index) / (1024 * 1024)
+            raw_mb = features_array.nbytes / (1024 * 1024)
+            _log(f"🗜️  壓縮索引 {index_mb:.1f} MB（原始向量 {raw_mb:.1f} MB，壓縮 {raw_mb / max(index_mb, 1e-6):.1f} 倍，原始向量存於磁碟供重排序）")
+        self.next_id = len(labels)
+        self.build_report = {}
+        if self.index_config.get('pca_dim'):
+            self.build_report['pca'] = self._evaluate_reduction(features_array)
+        self.class_signatures = {
+            class_name: _class_signature(os.path.join(dataset_dir, class_name))
+            for class_name in self.classes
+        }
+        self._rebuild_id_lookup()
+        self._calibrate_thresholds(features_array)
+
+        _log("🎯 計算類別原型...")
+        label_class_ids = self.labels.class_ids
+        self.prototypes = None
+        self.prototype_class_ids = np.empty(0, dtype=np.int32)
+        for class_id in range(len(self.classes)):
+            class_vectors = features_array[label_class_ids == class_id]
+            if len(class_vectors) > 0:
+                self._append_prototypes(class_id, class_vectors)
+        _log(f"🎯 類別原型: {len(self.prototype_class_ids)} 個 (每類別平均向量 + 最多 {DEFAULT_PROTOTYPE_SUBCENTROIDS} 個子中心)")
 
         # 儲存索引
-        current_time = time.strftime('%H:%M:%S')
-        print(f"[{current_time}] 💾 儲存 FAISS 索引...")
+        _log("💾 儲存 FAISS 索引...")
         self.save_index()
 
         total_elapsed = time.time() - start_time
-        current_time = time.strftime('%H:%M:%S')
-        print(f"[{current_time}] ✅ FAISS 索引建立完成！")
-        print(f"[{current_time}] 📊 特徵向量總數: {self.index.ntotal} 個")
-        print(f"[{current_time}] 📂 類別總數: {len(self.classes)} 個")
-        print(f"[{current_time}] ⏱️  總耗時: {total_elapsed:.1f} 秒 ({total_elapsed/60:.1f} 分鐘)")
-        print(f"[{current_time}] ⚡ 平均處理速度: {processed_count/total_elapsed:.1f} 張圖片/秒")
+        _log("✅ FAISS 索引建立完成！")
+        _log(f"📊 特徵向量總數: {self.index.ntotal} 個")
+        _log(f"📂 類別總數: {len(self.classes)} 個")
+        _log(f"⏱️  總耗時: {total_elapsed:.1f} 秒 ({total_elapsed/60:.1f} 分鐘)")
+        _log(f"⚡ 平均處理速度: {processed_count/total_elapsed:.1f} 張圖片/秒")
+        return True
+
+    def _create_index(self, dimension, train_vectors=None):
+        """依 index_config 建立空的 ID 對應索引（內積相似度）"""
+        return faiss.IndexIDMap2(create_index(self.index_config, dimension, train_vectors))
+
+    def _ensure_id_map(self):
+        """將舊版（無 ID）索引轉換為 ID 對應索引，向量 ID 等於原列索引"""
+        if self.index is None or isinstance(self.index, faiss.IndexIDMap2):
+            return
+        vectors = self.index.reconstruct_n(0, self.index.ntotal)
+        ids = np.asarray(self.labels.vector_ids, dtype=np.int64)
+        self.index_config = make_index_config('flat', pca_dim=0)
+        self.index = self._create_index(vectors.shape[1])
+        self.index.add_with_ids(vectors, ids)
+        self.index_mmapped = False
+
+    def _evaluate_reduction(self, features):
+        """比較降維前後的留一法 top-1 準確率"""
+        class_ids = np.asarray(self.labels.class_ids)
+        before = loo_top1_accuracy(features, class_ids)
+        after = loo_top1_accuracy(reduce_vectors(self.index, features), class_ids)
+        pca_dim = self.index_config['pca_dim']
+        _log(f"📉 PCA 白化降維 {features.shape[1]} → {pca_dim} 維 | "
+             f"LOO top-1 準確率: 降維前 {before:.1%} → 降維後 {after:.1%} ({(after - before) * 100:+.1f} 個百分點)")
+        return {'input_dim': int(features.shape[1]), 'output_dim': int(pca_dim),
+                'loo_top1_before': before, 'loo_top1_after': after}
+
+    def _similarity_space(self, vectors):
+        """轉換到查詢相似度所在的向量空間：以原始向量重排序時不變，否則套用索引的降維轉換"""
+        if self.vectors is not None and self.index_config['params'].get('rerank'):
+            return np.ascontiguousarray(vectors, dtype=np.float32)
+        return reduce_vectors(self.index, vectors)
+
+    def _calibrate_thresholds(self, features):
+        """校準各類別的開放集合拒識門檻（結果摘要記錄於建立報告）"""
+        self.class_thresholds, stats = calibrate_thresholds(self._similarity_space(features),
+                                                            self.labels.class_ids, len(self.classes))
+        self.build_report['open_set'] = stats
+        rate = lambda value: '-' if value is None else f"{value:.1%}"
+        _log(f"🚫 開放集合拒識門檻: 平均 {stats['mean_threshold'] or 0:.3f} | "
+             f"已知類別接受率 {rate(stats['known_accept_rate'])} | 未知物件拒識率 {rate(stats['unknown_reject_rate'])}")
+
+    def _neighbour_classes(self, features):
+        """與這些特徵最相近的其他類別（其異類別分數會因加入/移除這些特徵而改變）"""
+        if self.index is None or self.index.ntotal == 0 or len(features) == 0:
+            return []
+        queries = features
+        if len(queries) > REJECT_CALIBRATION_PER_CLASS:
+            queries = features[np.random.default_rng(0).choice(len(features), REJECT_CALIBRATION_PER_CLASS,
+                                                               replace=False)]
+        _, indices = self._search(np.ascontiguousarray(queries, dtype=np.float32), REJECT_NEIGHBOURS)
+        class_ids = self._class_ids_of(indices)
+        return sorted(set(class_ids[class_ids >= 0].tolist()))
+
+    def _calibrate_new_class(self, class_ids, seed=0):
+        """
+        增量加入/移除類別後重新校準受影響類別的門檻（新類別與最近的相鄰類別，須在索引更新後呼叫）
+
+        其餘類別的門檻於完整重建時更新。
+        """
+        if self.class_thresholds is None or not class_ids:
+            return
+        thresholds, _ = calibrate_thresholds(self._similarity_space(self.get_stored_vectors()),
+                                             self.labels.class_ids, len(self.classes), seed=seed,
+                                             classes=class_ids)
+        self.class_thresholds[class_ids] = thresholds[class_ids]
+
+    def _ensure_writable(self):
+        """記憶體映射載入的索引在加入/刪除向量前轉為可修改的記憶體內副本"""
+        if self.index is not None and self.index_mmapped:
+            self.index = to_owned(self.index)
+            apply_search_params(self.index, self.index_config)
+            self.index_mmapped = False
+
+    def _remove_vectors(self, ids):
+        """刪除向量；不支援直接刪除的索引類型（HNSW、IVF）以剩餘向量重建"""
+        if supports_remove(self.index_config):
+            self.index.remove_ids(ids)
+            return
+        if self.vectors is not None:
+            # 有原始向量時以原始向量重建（降維索引只能取回降維後的向量）
+            vectors, all_ids = np.asarray(self.vectors), np.asarray(self.labels.vector_ids)
+        else:
+            vectors, all_ids = reconstruct_all(self.index), faiss.vector_to_array(self.index.id_map)
+        keep = ~np.isin(all_ids, ids)
+        self.index = self._create_index(vectors.shape[1], vectors[keep])
+        self.index.add_with_ids(vectors[keep], all_ids[keep])
+
+    def _rebuild_id_lookup(self):
+        """重建向量 ID -> 標籤列索引對照表與各類別的向量 ID 清單"""
+        lookup = np.full(self.next_id, -1, dtype=np.int64)
+        lookup[self.labels.vector_ids] = np.arange(len(self.labels))
+        order = np.argsort(self.labels.class_ids, kind='stable')
+        bounds = np.cumsum(self.labels.class_counts())[:-1]
+        self._row_of_id = lookup
+        self._ids_of_class = np.split(np.asarray(self.labels.vector_ids)[order], bounds)
+
+    def _label_row(self, vector_id):
+        """取得向量 ID 對應的標籤列索引，不存在時回傳 None"""
+        if vector_id < 0 or vector_id >= len(self._row_of_id):
+            return None
+        row = self._row_of_id[vector_id]
+        return int(row) if row >= 0 else None
+
+    def _append_prototypes(self, class_id, class_vectors):
+        """加入一個類別的原型"""
+        prototypes = compute_class_prototypes(class_vectors)
+        class_ids = np.full(len(prototypes), class_id, dtype=np.int32)
+        if self.prototypes is None:
+            self.prototypes = prototypes
+            self.prototype_class_ids = class_ids
+        else:
+            self.prototypes = np.vstack([self.prototypes, prototypes])
+            self.prototype_class_ids = np.concatenate([self.prototype_class_ids, class_ids])
+        self._build_prototype_index()
+
+    def _build_prototype_index(self):
+        """以原型矩陣建立粗篩用的小型 Flat 索引"""
+        if self.prototypes is None or len(self.prototypes) == 0:
+            self.prototype_index = None
+            return
+        self.prototype_index = faiss.IndexFlatIP(self.prototypes.shape[1])
+        self.prototype_index.add(np.ascontiguousarray(self.prototypes, dtype=np.float32))
+
+    def _rebuild_prototypes(self):
+        """由已索引向量重新計算所有類別原型（舊版索引沒有原型檔時使用）"""
+        vectors = self.get_stored_vectors()
+        label_class_ids = np.asarray(self.labels.class_ids)
+        self.prototypes = None
+        self.prototype_class_ids = np.empty(0, dtype=np.int32)
+        for class_id in range(len(self.classes)):
+            class_vectors = np.asarray(vectors[label_class_ids == class_id])
+            if len(class_vectors) > 0:
+                self._append_prototypes(class_id, class_vectors)
+
+    def _candidate_classes(self, query_features, n_classes):
+        """粗篩：以類別原型找出每張查詢圖片的前 n_classes 個候選類別（批次時取聯集）"""
+        k = min(len(self.prototype_class_ids), n_classes * (DEFAULT_PROTOTYPE_SUBCENTROIDS + 1))
+        _, proto_idx = self.prototype_index.search(query_features, k)
+        candidates = set()
+        for row in proto_idx:
+            found = []
+            for idx in row:
+                if idx < 0:
+                    continue
+                class_id = int(self.prototype_class_ids[idx])
+                if class_id not in found:
+                    found.append(class_id)
+                    if len(found) == n_classes:
+                        break
+            candidates.update(found)
+        return sorted(candidates)
+
+    def _search(self, query_features, k, min_classes=0):
+        """
+        搜尋最相似的 k 個向量
+
+        類別數超過 coarse_classes 時使用兩階段搜尋：先比對類別原型挑出候選類別（至少 min_classes 個），
+        再只搜尋候選類別的向量（IndexPQ 不支援篩選，維持單階段）。批次查詢時使用各查詢候選類別的聯集，
+        仍只呼叫一次 index.search。壓縮索引會以原始向量精確重排序。
+        """
+        params = None
+        n_candidates = max(self.coarse_classes, min_classes)
+        if (self.coarse_classes and self.prototype_index is not None
+                and len(self.classes) > n_candidates):
+            candidates = self._candidate_classes(query_features, n_candidates)
+            candidate_ids = np.concatenate([self._ids_of_class[c] for c in candidates])
+            selector = faiss.IDSelectorBatch(candidate_ids)
+            params = make_search_params(self.index, self.index_config, selector)
+        if params is not None:
+            similarities, indices = search_reranked(self.index, self.index_config, query_features, k,
+                                                    self.vectors, self._row_of_id, params=params)
+            if (indices[:, 0] >= 0).all():
+                return similarities, indices
+        return search_reranked(self.index, self.index_config, query_features, k,
+                               self.vectors, self._row_of_id)
+
+    def _class_ids_of(self, indices):
+        """向量 ID 陣列 -> class_id 陣列（無效 ID 為 -1）"""
+        valid = (indices >= 0) & (indices < len(self._row_of_id))
+        rows = np.where(valid, self._row_of_id[np.where(valid, indices, 0)], -1)
+        return np.where(rows >= 0, np.asarray(self.labels.class_ids)[np.maximum(rows, 0)], -1)
+
+    def _search_distinct(self, query_features, k, top_classes):
+        """
+        搜尋直到每張查詢圖片的結果涵蓋 top_classes 個不同類別
+
+        先取 max(k, top_classes × DISTINCT_OVERFETCH) 個鄰居，類別數不足的查詢再加量搜尋，
+        成本只與 top_classes 相關，不隨索引類別總數增加。
+
+        Returns:
+            每張查詢圖片的 (相似度陣列, 向量 ID 陣列) 列表
+        """
+        target = min(top_classes, len(self.classes))
+        fetch = min(self.index.ntotal, max(k, top_classes * DISTINCT_OVERFETCH))
+        results = [None] * len(query_features)
+        pending = np.arange(len(query_features))
+
+        while len(pending) > 0:
+            similarities, indices = self._search(query_features[pending], fetch, min_classes=top_classes)
+            class_ids = self._class_ids_of(indices)
+            final = fetch >= min(self.index.ntotal, MAX_FETCH)
+            still_pending = []
+            for row, query in enumerate(pending):
+                found = class_ids[row]
+                if final or len(np.unique(found[found >= 0])) >= target:
+                    results[query] = (similarities[row], indices[row])
+                else:
+                    still_pending.append(query)
+            pending = np.array(still_pending, dtype=np.int64)
+            fetch = min(self.index.ntotal, MAX_FETCH, fetch * DISTINCT_OVERFETCH)
+        return results
+
+    def get_stored_vectors(self):
+        """取得與 self.labels 列對齊的已索引向量"""
+        if self.vectors is not None:
+            return self.vectors
+        vectors = reconstruct_all(self.index)
+        rows = self._row_of_id[faiss.vector_to_array(self.index.id_map)]
+        aligned = np.empty_like(vectors)
+        aligned[rows] = vectors
+        return aligned
+
+    def add_class(self, class_name, dataset_dir=None, save=True):
+        """
+        增量加入一個類別，只提取該類別的圖片特徵
+
+        Args:
+            class_name: 類別名稱（dataset 下的子目錄名稱）
+            dataset_dir: 資料集目錄（預設 dataset）
+            save: 完成後是否儲存索引
+        """
+        if dataset_dir is None:
+            dataset_dir = "dataset"
+
+        if class_name in self.classes:
+            print(f"❌ 類別已存在於索引中: {class_name}")
+            return False
+
+        class_dir = os.path.join(dataset_dir, class_name)
+        if not os.path.isdir(class_dir):
+            print(f"❌ 找不到類別目錄: {class_dir}")
+            return False
+
+        image_paths = [os.path.join(class_dir, f) for f in list_class_images(class_dir)]
+        if not image_paths:
+            print(f"❌ 類別 {class_name} 沒有圖片")
+            return False
+
+        start_time = time.time()
+        _log(f"➕ 加入類別 {class_name}: {len(image_paths)} 張圖片")
+
+        features_array, valid_indices = self._extract_paths(image_paths)
+        if len(valid_indices) == 0:
+            _log(f"❌ 類別 {class_name} 沒有成功提取任何特徵")
+            return False
+
+        valid_paths = [image_paths[i] for i in valid_indices]
+        self._ensure_writable()
+        if self.index is None:
+            self.index = self._create_index(features_array.shape[1], features_array)
+            self.labels = LabelStore(self.classes)
+
+        class_id = len(self.classes)
+        neighbours = self._neighbour_classes(features_array) if self.class_thresholds is not None else []
+        ids = np.arange(self.next_id, self.next_id + len(valid_paths), dtype=np.int64)
+        self.index.add_with_ids(features_array, ids)
+        if is_compressed(self.index_config):
+            self.vectors = features_array if self.vectors is None else np.vstack([self.vectors, features_array])
+        self.classes.append(class_name)
+        self.labels.extend(class_id, ids, valid_paths)
+        self.next_id += len(valid_paths)
+        self.class_signatures[class_name] = _class_signature(class_dir)
+        self._rebuild_id_lookup()
+        self._append_prototypes(class_id, features_array)
+        if self.class_thresholds is not None:
+            self.class_thresholds = np.append(self.class_thresholds, np.float32(np.nan))
+            self._calibrate_new_class([class_id] + neighbours)
+        self.loaded = True
+
+        _log(f"✅ 類別 {class_name} 已加入 ({len(valid_paths)} 個特徵向量, {time.time() - start_time:.1f}秒)")
+        if save:
+            self.save_index()
+        return True
+
+    def remove_class(self, class_name, save=True):
+        """從索引移除一個類別，其餘類別的 class_id 依序遞補"""
+        if class_name not in self.classes:
+            print(f"❌ 類別不存在於索引中: {class_name}")
+            return False
+
+        removed_id = self.classes.index(class_name)
+        keep = np.asarray(self.labels.class_ids) != removed_id
+        remove_ids = np.asarray(self.labels.vector_ids)[~keep]
+        # 相鄰類別失去一個異類別，移除後以被移除的向量找出並重新校準
+        removed_vectors = (np.asarray(self.get_stored_vectors())[~keep]
+                           if self.class_thresholds is not None else np.empty((0, 0), dtype=np.float32))
+        if len(remove_ids) > 0:
+            self._ensure_writable()
+            self._remove_vectors(remove_ids)
+
+        if self.vectors is not None:
+            self.vectors = np.asarray(self.vectors)[keep]
+        self.labels.remove_class(removed_id)  # 同時從共用的 self.classes 移除
+        self.class_signatures.pop(class_name, None)
+        if self.class_thresholds is not None:
+            self.class_thresholds = np.delete(self.class_thresholds, removed_id)
+        self._rebuild_id_lookup()
+
+        if self.prototypes is not None:
+            keep = self.prototype_class_ids != removed_id
+            self.prototypes = self.prototypes[keep]
+            self.prototype_class_ids = self.prototype_class_ids[keep]
+            self.prototype_class_ids[self.prototype_class_ids > removed_id] -= 1
+            self._build_prototype_index()
+        self._calibrate_new_class(self._neighbour_classes(removed_vectors))
+
+        _log(f"➖ 類別 {class_name} 已移除 ({len(remove_ids)} 個特徵向量)")
+        if save:
+            self.save_index()
+        return True
+
+    def replace_class(self, class_name, dataset_dir=None, save=True):
+        """重新提取一個類別的特徵（STL 被覆蓋或圖片重新生成時使用）"""
+        if class_name in self.classes:
+            self.remove_class(class_name, save=False)
+        return self.add_class(class_name, dataset_dir, save=save)
+
+    def sync_with_dataset(self, dataset_dir=None):
+        """
+        比對資料集與索引，只處理有變更的類別
+
+        新類別加入、已刪除的類別移除、圖片數量或修改時間改變的類別重新提取。
+        """
+        if dataset_dir is None:
+            dataset_dir = "dataset"
+
+        if not os.path.exists(dataset_dir):
+            print("❌ 找不到資料集目錄")
+            return False
+        self.dataset_dir = dataset_dir
+
+        dataset_classes = sorted(d for d in os.listdir(dataset_dir)
+                                 if os.path.isdir(os.path.join(dataset_dir, d)))
+        counts = dict(zip(self.classes, self.labels.class_counts().tolist())) if self.labels is not None else {}
+
+        added, removed, replaced = [], [], []
+        for class_name in list(self.classes):
+            if class_name not in dataset_classes:
+                self.remove_class(class_name, save=False)
+                removed.append(class_name)
+
+        for class_name in dataset_classes:
+            signature = _class_signature(os.path.join(dataset_dir, class_name))
+            if signature[0] == 0:
+                continue
+            if class_name not in self.classes:
+                if self.add_class(class_name, dataset_dir, save=False):
+                    added.append(class_name)
+            elif class_name not in self.class_signatures:
+                # 舊版索引沒有簽章：圖片數一致則視為最新
+                if counts.get(class_name, 0) == signature[0]:
+                    self.class_signatures[class_name] = signature
+                elif self.replace_class(class_name, dataset_dir, save=False):
+                    replaced.append(class_name)
+            elif list(self.class_signatures[class_name]) != list(signature):
+                if self.replace_class(class_name, dataset_dir, save=False):
+                    replaced.append(class_name)
+
+        _log(f"🔄 索引同步完成: 新增 {len(added)} 個, 移除 {len(removed)} 個, 更新 {len(replaced)} 個類別")
+        if added or removed or replaced:
+            self.save_index()
         return True
 
     def save_index(self):
-        """儲存 FAISS 索引和標籤"""
+        """將索引、標籤、原始向量與原型寫入新版本目錄並原子發布"""
+        staging = None
         try:
-            faiss.write_index(self.index, self.index_file)
-            with open(self.labels_file, 'wb') as f:
-                pickle.dump({
-                    'labels': self.labels,
-                    'classes': self.classes
-                }, f)
-            print(f"💾 索引已儲存至 {self.index_file} 和 {self.labels_file}")
+            staging = begin_version(self.index_root)
+            faiss.write_index(self.index, os.path.join(staging, self.index_file))
+            if self.vectors is not None:
+                np.save(os.path.join(staging, self.vectors_file), np.asarray(self.vectors, dtype=np.float32))
+            if self.prototypes is not None:
+                np.savez(os.path.join(staging, self.prototypes_file), prototypes=self.prototypes,
+                         class_ids=self.prototype_class_ids)
+            self.labels.save(os.path.join(staging, self.labels_file),
+                             next_id=self.next_id,
+                             class_signatures=self.class_signatures,
+                             build_report=self.build_report,
+                             class_thresholds=None if self.class_thresholds is None else self.class_thresholds.tolist(),
+                             backbone=self.backbone,
+                             dataset_dir=self.dataset_dir,
+                             index_config=self.index_config)
+            self.version = publish(staging, self.index_root)
+            self.index_dir = os.path.join(self.index_root, self.version)
+            self._remove_legacy_files()
+            print(f"💾 索引已發布為版本 {self.version} ({self.index_dir})")
         except Exception as e:
+            if staging is not None:
+                abort_version(staging)
             print(f"❌ 儲存索引失敗: {e}")
 
-    def load_index(self):
-        """載入 FAISS 索引和標籤"""
-        try:
-            if not os.path.exists(self.index_file) or not os.path.exists(self.labels_file):
-                print("⚠️  索引檔案不存在，需要先建立索引")
-                return False
+    def _remove_legacy_files(self):
+        """發布版本後移除工作目錄下的舊版（未版本化）索引檔"""
+        legacy = [name for name in (self.index_file, self.labels_file, self.legacy_labels_file,
+                                    self.vectors_file, self.prototypes_file) if os.path.exists(name)]
+        for name in legacy:
+            os.remove(name)
+        if legacy:
+            print(f"🔄 舊版索引檔已轉換為版本化目錄: {', '.join(legacy)}")
 
-            self.index = faiss.read_index(self.index_file)
-            with open(self.labels_file, 'rb') as f:
-                data = pickle.load(f)
-                self.labels = data['labels']
-                self.classes = data['classes']
+    def _read_index_state(self, index_dir):
+        """從索引目錄讀取索引狀態到 self（由 load_index 在暫存副本上呼叫）"""
+        path = lambda name: os.path.join(index_dir, name)
+        has_labels = os.path.exists(path(self.labels_file)) or os.path.exists(path(self.legacy_labels_file))
+        if not os.path.exists(path(self.index_file)) or not has_labels:
+            print("⚠️  索引檔案不存在，需要先建立索引")
+            return False
 
-            # 載入特徵提取器
-            if self.feature_extractor is None:
-                self.load_feature_extractor()
+        self.index, self.index_mmapped = read_index(path(self.index_file), self.use_mmap)
+        if os.path.exists(path(self.labels_file)):
+            self.labels, meta = LabelStore.load(path(self.labels_file))
+        else:
+            # 舊版 pickle 標籤檔（下次儲存時轉換為欄位式格式）
+            with open(path(self.legacy_labels_file), 'rb') as f:
+                meta = pickle.load(f)
+            self.labels = LabelStore.from_records(meta['labels'], meta['classes'])
+        self.classes = self.labels.classes
+        self.class_signatures = meta.get('class_signatures', {})
+        self.build_report = meta.get('build_report', {})
+        self.dataset_dir = meta.get('dataset_dir', self.dataset_dir)
+        thresholds = meta.get('class_thresholds')
+        self.class_thresholds = (np.asarray(thresholds, dtype=np.float32)
+                                 if thresholds is not None and len(thresholds) == len(self.classes) else None)
+        spec = meta.get('backbone') or backbone_spec(LEGACY_BACKBONE)
+        if spec != self.backbone:
+            # 查詢必須使用與建立索引時相同的骨幹網路與預處理
+            _log(f"🔀 索引使用 {spec['name']} 骨幹網路，切換特徵提取器")
+            self._set_backbone(spec)
+        self.index_config = meta.get('index_config', make_index_config('flat', pca_dim=0))
+        self.next_id = meta.get('next_id', len(self.labels))
+        self._ensure_id_map()
+        apply_search_params(self.index, self.index_config)
+        self.vectors = None
+        if is_compressed(self.index_config) and os.path.exists(path(self.vectors_file)):
+            self.vectors = np.load(path(self.vectors_file), mmap_mode='r')
+
+        self._rebuild_id_lookup()
+
+        # 類別原型：檔案不存在或與類別不一致時重新計算
+        self.prototypes = None
+        if os.path.exists(path(self.prototypes_file)):
+            with np.load(path(self.prototypes_file)) as proto_data:
+                self.prototypes = proto_data['prototypes']
+                self.prototype_class_ids = proto_data['class_ids']
+        if (self.prototypes is None or self.index.ntotal == 0 or
+                set(np.unique(self.prototype_class_ids)) != set(range(len(self.classes)))):
+            self._rebuild_prototypes()
+        else:
+            self._build_prototype_index()
+
+        self.index_dir = index_dir
+        self.version = os.path.basename(index_dir) if index_dir != '.' else None
+        return True
+
+    def load_index(self, index_dir=None):
+        """
+        載入 FAISS 索引和標籤（預設為目前發布的版本）
+
+        新狀態（含特徵提取器）先在暫存副本上完整載入，再於寫鎖內一次替換；進行中的查詢會在舊索引上完成。
+        索引不存在或無法讀取時回傳 False；模型權重無法使用時拋出 WEIGHTS_ERRORS（重建索引無法修復），
+        目前的狀態維持不變。
+        """
+        start_time = time.time()
+        try:
+            if index_dir is None:
+                index_dir = current_index_dir(self.index_root)
+
+            staged = copy.copy(self)
+            if not staged._read_index_state(index_dir):
+                return False
+            if staged.feature_extractor is None:
+                # 首次載入或新版本換了骨幹網路：切換前先載入，權重有問題時不會換入無法查詢的狀態
+                staged.load_feature_extractor()
+            with self._state_lock.write_lock():
+                for attr in INDEX_STATE_ATTRS:
+                    setattr(self, attr, getattr(staged, attr))
+            load_ms = (time.time() - start_time) * 1000
 
             self.loaded = True
-            print(f"✅ FAISS 索引載入成功，包含 {self.index.ntotal} 個特徵向量")
+            version = f"版本 {self.version}, " if self.version else ""
+            mmap = ", 記憶體映射" if self.index_mmapped else ""
+            print(f"✅ FAISS 索引載入成功，包含 {self.index.ntotal} 個特徵向量 "
+                  f"({version}{config_label(self.index_config)}{mmap}, {load_ms:.0f} ms)")
             print(f"📋 類別: {', '.join(self.classes)}")
             return True
 
+        except WEIGHTS_ERRORS as e:
+            print(f"❌ 模型權重無法使用: {e}")
+            raise
         except Exception as e:
             print(f"❌ 載入索引失敗: {e}")
             return False
 
-    def predict(self, image_path, k=5):
-        """使用 FAISS 進行圖片識別"""
-        if not self.loaded:
-            print("❌ FAISS 索引未載入")
-            return None
+    def start_watcher(self, interval=DEFAULT_RELOAD_INTERVAL):
+        """啟動背景執行緒，偵測到新發布的索引版本時自動熱切換"""
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+        self._stop_watcher.clear()
 
-        start_time = time.time()
+        def watch():
+            failed_version = None
+            while not self._stop_watcher.wait(interval):
+                version = current_version(self.index_root)
+                if version is None or version == self.version or version == failed_version:
+                    continue
+                _log(f"🔄 偵測到新索引版本 {version}，載入並熱切換...")
+                try:
+                    loaded = self.load_index(os.path.join(self.index_root, version))
+                except WEIGHTS_ERRORS:
+                    loaded = False
+                failed_version = None if loaded else version
+
+        self._watcher = threading.Thread(target=watch, name='faiss-index-watcher', daemon=True)
+        self._watcher.start()
 
-        # 提取查詢圖片的特徵
-        query_features = self.extract_features(image_path)
-        if query_features is None:
+    def stop_watcher(self):
+        """停止版本監看"""
+        self._stop_watcher.set()
+
+    def _preprocess(self, image):
+        """讀取並預處理單張圖片，失敗時回傳 None"""
+        try:
+            return self.transform(open_image(image))
+        except Exception as e:
+            name = image if isinstance(image, (str, os.PathLike)) else type(image).__name__
+            print(f"❌ 特徵提取失敗 {name}: {e}")
             return None
 
-        # 搜索最相似的特徵
-        query_features = query_features.reshape(1, -1).astype(np.float32)
-        similarities, indices = self.index.search(query_features, k)
+    def _format_result(self, similarities, indices, inference_time, k=5, top_classes=None):
+        """
+        將單張圖片的搜尋結果整理為預測輸出格式（以 NumPy 彙整各類別投票）
+
+        predictions 依類別信心度排序，最多 top_classes 個：信心度為該類別最相似的 k 個向量的平均相似度，
+        vote_count 為前 k 個鄰居中屬於該類別的數量。detailed_results 包含各預測類別最相似的 k 個參考向量。
+        """
+        if top_classes is None:
+            top_classes = DEFAULT_TOP_CLASSES
+        similarities = np.asarray(similarities, dtype=np.float32)
+        class_ids = self._class_ids_of(np.asarray(indices))
+        valid = np.flatnonzero(class_ids >= 0)  # 搜尋結果已依相似度遞減排序
+
+        # 各類別在結果中的名次：依類別穩定排序後扣除群組起點
+        unique_classes, inverse = np.unique(class_ids[valid], return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        group_start = np.searchsorted(inverse[order], np.arange(len(unique_classes)))
+        rank_in_class = np.empty(len(valid), dtype=np.int64)
+        rank_in_class[order] = np.arange(len(valid)) - group_start[inverse[order]]
+
+        best = rank_in_class < k
+        counts = np.bincount(inverse[best], minlength=len(unique_classes))
+        confidence = np.bincount(inverse[best], weights=similarities[valid][best],
+                                 minlength=len(unique_classes)) / np.maximum(counts, 1)
+        votes = np.bincount(inverse[:k], minlength=len(unique_classes))
 
-        inference_time = (time.time() - start_time) * 1000
+        top = np.argsort(-confidence, kind='stable')[:top_classes]
+        final_predictions = [{
+            'class_id': int(unique_classes[c]),
+            'class_name': self.classes[unique_classes[c]],
+            'confidence': float(confidence[c]),
+            'vote_count': int(votes[c])
+        } for c in top]
 
-        # 整理結果
+        selected = np.zeros(len(unique_classes), dtype=bool)
+        selected[top] = True
         predictions = []
-        for i, (similarity, idx) in enumerate(zip(similarities[0], indices[0])):
-            if idx < len(self.labels):
-                label = self.labels[idx]
-                predictions.append({
-                    'class_id': label['class_id'],
-                    'class_name': label['class_name'],
-                    'confidence': float(similarity),
-                    'rank': i + 1,
-                    'reference_image': label['image_path']
-                })
-
-        # 按類別統計投票
-        class_votes = {}
-        for pred in predictions:
-            class_name = pred['class_name']
-            if class_name not in class_votes:
-                class_votes[class_name] = {'count': 0, 'total_confidence': 0}
-            class_votes[class_name]['count'] += 1
-            class_votes[class_name]['total_confidence'] += pred['confidence']
-
-        # 計算最終結果
-        final_predictions = []
-        for class_name, vote_data in class_votes.items():
-            avg_confidence = vote_data['total_confidence'] / vote_data['count']
-            final_predictions.append({
-                'class_id': self.classes.index(class_name),
-                'class_name': class_name,
-                'confidence': avg_confidence,
-                'vote_count': vote_data['count']
+        for i in np.flatnonzero(best & selected[inverse]):
+            position = valid[i]
+            label = self.labels[self._row_of_id[indices[position]]]
+            predictions.append({
+                'class_id': label['class_id'],
+                'class_name': label['class_name'],
+                'confidence': float(similarities[position]),
+                'rank': int(position) + 1,
+                'reference_image': label['image_path']
             })
 
-        # 按置信度排序
-        final_predictions.sort(key=lambda x: x['confidence'], reverse=True)
-
         return {
             'predictions': final_predictions,
             'detailed_results': predictions,
+            'no_match': False,
             'inference_time': inference_time,
             'method': 'FAISS',
             'success': True
         }
 
+    def _open_set_check(self, query_features):
+        """
+        快速拒識：搜尋少量鄰居，任一鄰居的相似度達到其類別門檻即接受
+
+        Returns:
+            (接受遮罩, (最佳匹配 class_id 陣列, 相似度陣列))；停用或沒有門檻時全部接受
+        """
+        accepted = np.ones(len(query_features), dtype=bool)
+        if not self.open_set or self.class_thresholds is None or self.index.ntotal == 0:
+            return accepted, None
+        similarities, indices = self._search(query_features, min(REJECT_NEIGHBOURS, self.index.ntotal))
+        class_ids = self._class_ids_of(indices)
+        margins = np.where(class_ids >= 0, similarities - self.class_thresholds[np.maximum(class_ids, 0)], -np.inf)
+        best = margins.argmax(axis=1)
+        rows = np.arange(len(query_features))
+        return margins[rows, best] >= 0, (class_ids[rows, best], similarities[rows, best])
+
+    def _no_match_result(self, class_id, similarity, inference_time):
+        """查詢不屬於任何已建模類別時的結果（不含參考圖片）"""
+        best_match = None
+        if class_id >= 0:
+            best_match = {
+                'class_id': int(class_id),
+                'class_name': self.classes[class_id],
+                'similarity': float(similarity),
+                'threshold': float(self.class_thresholds[class_id])
+            }
+        return {
+            'predictions': [],
+            'detailed_results': [],
+            'no_match': True,
+            'best_match': best_match,
+            'inference_time': inference_time,
+            'method': 'FAISS',
+            'success': True
+        }
+
+    def predict(self, image_path, k=5, top_classes=None):
+        """使用 FAISS 進行圖片識別"""
+        return self.predict_batch([image_path], k, top_classes=top_classes)[0]
+
+    def predict_batch(self, images, k=5, batch_size=None, top_classes=None):
+        """
+        批次識別多張圖片：平行預處理、批次骨幹網路前向傳播、一次 index.search
+
+        Args:
+            images: 圖片列表（檔案路徑、bytes、檔案物件或 PIL Image）
+            k: 每張圖片搜尋的鄰居數
+            batch_size: 每次前向傳播的最大圖片數（預設 FAISS_BUILD_BATCH_SIZE），限制記憶體用量
+            top_classes: 結果保證涵蓋的不同類別數（預設 FAISS_TOP_CLASSES）
+
+        Returns:
+            與 images 對應的結果列表（格式同 predict），讀取失敗的圖片為 None；
+            inference_time 為批次總耗時平均到每張圖片。與所有類別都不夠相似的圖片提前回傳
+            no_match 為 True、predictions 為空的結果（best_match 為最接近的類別）
+        """
+        if not self.loaded:
+            print("❌ FAISS 索引未載入")
+            return [None] * len(images)
+        if not images:
+            return []
+
+        start_time = time.time()
+        if batch_size is None:
+            batch_size = DEFAULT_BATCH_SIZE
+        if top_classes is None:
+            top_classes = DEFAULT_TOP_CLASSES
+
+        # 整個查詢期間持有讀鎖（預處理與骨幹網路須與索引版本一致），熱切換會等待進行中的查詢完成
+        with self._state_lock.read_lock():
+            # 平行讀取與預處理
+            if len(images) > 1:
+                with ThreadPoolExecutor(max_workers=min(PREDICT_PREPROCESS_THREADS, len(images))) as pool:
+                    tensors = list(pool.map(self._preprocess, images))
+            else:
+                tensors = [self._preprocess(images[0])]
+            valid = [i for i, tensor in enumerate(tensors) if tensor is not None]
+            if not valid:
+                return [None] * len(images)
+
+            # 批次提取特徵並搜尋
+            query_features = np.vstack([
+                self.extract_features_batch(torch.stack([tensors[i] for i in valid[start:start + batch_size]]))
+                for start in range(0, len(valid), batch_size)
+            ])
+            accepted, best = self._open_set_check(query_features)
+            neighbours = iter(self._search_distinct(query_features[accepted], k, top_classes))
+            inference_time = (time.time() - start_time) * 1000 / len(valid)
+
+            results = [None] * len(images)
+            for row, i in enumerate(valid):
+                if accepted[row]:
+                    similarities, indices = next(neighbours)
+                    results[i] = self._format_result(similarities, indices, inference_time, k, top_classes)
+                else:
+                    results[i] = self._no_match_result(best[0][row], best[1][row], inference_time)
+        return results
+
 # 全域 FAISS 引擎實例
 faiss_engine = FAISSRecognitionEngine()
 
+# 合併並行請求的批次處理器：所有預測都經由單一工作執行緒存取 faiss_engine
+faiss_batcher = InferenceBatcher(lambda images: faiss_engine.predict_batch(images), name='faiss-batcher')
+
 def initialize_faiss():
     """初始化 FAISS 引擎"""
     print("🚀 初始化 FAISS 識別引擎")
 
-    # 嘗試載入現有索引
-    if not faiss_engine.load_index():
+    # 嘗試載入現有索引；模型權重無法使用時重建索引也無濟於事
+    try:
+        loaded = faiss_engine.load_index()
+    except WEIGHTS_ERRORS:
+        print("❌ FAISS 初始化失敗：請先修復模型權重（python model_weights.py --fetch）")
+        return False
+    if not loaded:
         print("📚 索引不存在，開始建立新索引...")
         if faiss_engine.build_index():
             print("✅ FAISS 初始化成功")
@@ -325,32 +1464,92 @@ def initialize_faiss():
         return True
 
 def predict_with_faiss(image_path):
-    """使用 FAISS 進行預測"""
+    """使用 FAISS 進行預測（經由批次處理器與其他並行請求合併）"""
     if not faiss_engine.loaded:
         print("⚠️  FAISS 未初始化，嘗試初始化...")
         if not initialize_faiss():
             return None
 
-    return faiss_engine.predict(image_path)
+    return faiss_batcher.predict(image_path)
+
+def predict_with_faiss_batch(images):
+    """使用 FAISS 批次預測（回傳與 images 對應的結果列表）"""
+    if not faiss_engine.loaded:
+        print("⚠️  FAISS 未初始化，嘗試初始化...")
+        if not initialize_faiss():
+            return [None] * len(images)
+
+    return [future.result() for future in faiss_batcher.submit_many(images)]
+
+def start_index_watcher():
+    """網頁服務使用：訓練發布新索引版本後自動熱切換，不需重新啟動"""
+    faiss_engine.start_watcher()
+
+def update_faiss_index(dataset_dir=None):
+    """載入現有索引並只同步有變更的類別；索引不存在時完整建立"""
+    try:
+        loaded = faiss_engine.load_index()
+    except WEIGHTS_ERRORS:
+        return False
+    if loaded:
+        return faiss_engine.sync_with_dataset(dataset_dir)
+    print("📚 索引不存在，開始建立新索引...")
+    return faiss_engine.build_index(dataset_dir)
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="FAISS 識別引擎：建立或增量更新索引")
+    parser.add_argument('--dataset', default=None, help='資料集目錄（預設 dataset）')
+    parser.add_argument('--rebuild', action='store_true', help='忽略現有索引，完整重建')
+    parser.add_argument('--index-type', choices=INDEX_TYPES, default=None,
+                        help='重建時使用的索引類型（預設 FAISS_INDEX_TYPE 或 flat）')
+    parser.add_argument('--backbone', choices=list(BACKBONES), default=None,
+                        help='重建時使用的骨幹網路（預設 FAISS_BACKBONE 或 resnet50）')
+    parser.add_argument('--pca-dim', type=int, default=None,
+                        help='重建時以 PCA 白化降到指定維度，例如 256（預設 FAISS_PCA_DIM，0 表示不降維）')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='重建時的分片行程數（預設 FAISS_BUILD_SHARDS 或 1）')
+    parser.add_argument('--add', nargs='+', default=[], metavar='CLASS', help='加入類別')
+    parser.add_argument('--remove', nargs='+', default=[], metavar='CLASS', help='移除類別')
+    parser.add_argument('--replace', nargs='+', default=[], metavar='CLASS', help='重新提取類別特徵')
+    args = parser.parse_args()
+
+    if args.index_type or args.pca_dim is not None:
+        faiss_engine.index_config = make_index_config(args.index_type, pca_dim=args.pca_dim)
+    if args.backbone:
+        faiss_engine._set_backbone(backbone_spec(args.backbone))
+
+    if args.rebuild:
+        ok = faiss_engine.build_index(args.dataset, shards=args.shards)
+    elif args.add or args.remove or args.replace:
+        faiss_engine.load_index()
+        ok = all([faiss_engine.remove_class(name, save=False) for name in args.remove] +
+                 [faiss_engine.replace_class(name, args.dataset, save=False) for name in args.replace] +
+                 [faiss_engine.add_class(name, args.dataset, save=False) for name in args.add])
+        faiss_engine.save_index()
+    else:
+        ok = update_faiss_index(args.dataset)
+
+    if not ok:
+        print("❌ FAISS 索引更新失敗")
+        raise SystemExit(1)
+
     # 測試 FAISS 引擎
     print("🧪 測試 FAISS 識別引擎")
+    faiss_engine.loaded = True
+    test_images = []
+    for root, dirs, files in os.walk(args.dataset or "dataset"):
+        for file in files[:1]:  # 每個目錄測試一張圖片
+            if file.lower().endswith(('.png', '.jpg')):
+                test_images.append(os.path.join(root, file))
 
-    if initialize_faiss():
-        # 測試預測
-        test_images = []
-        for root, dirs, files in os.walk("dataset"):
-            for file in files[:1]:  # 每個目錄測試一張圖片
-                if file.lower().endswith(('.png', '.jpg')):
-                    test_images.append(os.path.join(root, file))
-
-        for img_path in test_images[:3]:  # 測試前3張
-            print(f"\n🔍 測試圖片: {img_path}")
-            result = predict_with_faiss(img_path)
-            if result:
-                print(f"⏱️  推論時間: {result['inference_time']:.1f}ms")
-                for pred in result['predictions'][:3]:
-                    print(f"  📊 {pred['class_name']}: {pred['confidence']:.3f} (投票: {pred['vote_count']})")
-    else:
-        print("❌ FAISS 引擎測試失敗")
\ No newline at end of file
+    for img_path in test_images[:3]:  # 測試前3張
+        print(f"\n🔍 測試圖片: {img_path}")
+        result = predict_with_faiss(img_path)
+        if result:
+            print(f"⏱️  推論時間: {result['inference_time']:.1f}ms")
+            if result['no_match']:
+                print("  🚫 無相符模型")
+            for pred in result['predictions'][:3]:
+                print(f"  📊 {pred['class_name']}: {pred['confidence']:.3f} (投票: {pred['vote_count']})")
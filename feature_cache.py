@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Content-addressed Feature Cache
+以圖片內容雜湊為鍵的持久化特徵快取
+
+同一張圖片（內容相同）在相同骨幹網路/預處理版本下只需提取一次特徵。
+
+儲存格式（每個命名空間一個目錄）：
+- vectors.bin: 特徵矩陣（float32 或 float16，以 np.memmap 讀寫）
+- keys.pkl:    鍵表 {內容雜湊: 列索引} 與檔案狀態表 {絕對路徑: (大小, 修改時間, 雜湊)}
+- lock:        跨行程寫入鎖（多個行程寫入同一命名空間時，在 locked() 內 refresh → put → save）
+"""
+
+import os
+import re
+import hashlib
+import pickle
+import argparse
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows：沒有跨行程鎖，僅適用單一寫入行程
+    fcntl = None
+
+DEFAULT_CACHE_DIR = os.environ.get('FEATURE_CACHE_DIR', 'feature_cache')
+
+VECTORS_FILE = 'vectors.bin'
+KEYS_FILE = 'keys.pkl'
+LOCK_FILE = 'lock'
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """計算檔案內容雜湊（blake2b-128）"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.digest()
+
+
+class FeatureCache:
+    """單一命名空間（骨幹網路 + 預處理版本）的特徵快取"""
+
+    def __init__(self, namespace, cache_dir=DEFAULT_CACHE_DIR, dtype='float32'):
+        """
+        Args:
+            namespace: 特徵版本識別，例如 'resnet50_imagenet1k_v1_r224'
+            cache_dir: 快取根目錄
+            dtype: 儲存精度 ('float32' 或 'float16')
+        """
+        self.namespace = namespace
+        self.dir = os.path.join(cache_dir, re.sub(r'[^\w.-]', '_', namespace))
+        self.vectors_path = os.path.join(self.dir, VECTORS_FILE)
+        self.keys_path = os.path.join(self.dir, KEYS_FILE)
+
+        self.dtype = np.dtype(dtype)
+        self.dim = None
+        self.count = 0
+        self.rows = {}   # 內容雜湊 -> 列索引
+        self.stats = {}  # 絕對路徑 -> (大小, 修改時間 ns, 內容雜湊)
+        self._keys_signature = None  # 最後讀取/寫入的鍵表檔狀態，用於偵測其他行程的更新
+        self._load()
+
+    @staticmethod
+    def _file_signature(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns, st.st_ino
+
+    def _load(self):
+        if not os.path.exists(self.keys_path):
+            return
+        with open(self.keys_path, 'rb') as f:
+            self._keys_signature = self._file_signature(f.fileno())
+            data = pickle.load(f)
+        self.dim = data['dim']
+        self.dtype = np.dtype(data['dtype'])
+        self.count = data['count']
+        self.rows = data['rows']
+        self.stats = data['stats']
+
+    def refresh(self):
+        """
+        鍵表已被其他行程更新時重新讀取（本行程尚未 save 的寫入會被捨棄）
+
+        Returns:
+            是否重新讀取
+        """
+        try:
+            signature = self._file_signature(self.keys_path)
+        except FileNotFoundError:
+            return False
+        if signature == self._keys_signature:
+            return False
+        self._load()
+        return True
+
+    @contextmanager
+    def locked(self):
+        """跨行程獨占寫入鎖：鎖內先 refresh() 取得其他行程已追加的列，再 put() 與 save()"""
+        os.makedirs(self.dir, exist_ok=True)
+        with open(os.path.join(self.dir, LOCK_FILE), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield self
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _vectors(self, mode='r'):
+        """以 memmap 開啟特徵矩陣"""
+        return np.memmap(self.vectors_path, dtype=self.dtype, mode=mode, shape=(self.count, self.dim))
+
+    def __len__(self):
+        return self.count
+
+    def keys_for(self, paths):
+        """取得圖片的內容雜湊；檔案大小與修改時間未變時沿用記錄，不重新讀檔"""
+        keys = []
+        for path in paths:
+            abs_path = os.path.abspath(path)
+            st = os.stat(abs_path)
+            cached = self.stats.get(abs_path)
+            if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+                keys.append(cached[2])
+                continue
+            digest = file_digest(abs_path)
+            self.stats[abs_path] = (st.st_size, st.st_mtime_ns, digest)
+            keys.append(digest)
+        return keys
+
+    def find(self, keys):
+        """回傳每個鍵的列索引，不存在時為 -1"""
+        return np.array([self.rows.get(key, -1) for key in keys], dtype=np.int64)
+
+    def read(self, rows):
+        """讀取指定列的特徵（float32）"""
+        if len(rows) == 0 or self.count == 0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.asarray(self._vectors()[np.asarray(rows)], dtype=np.float32)
+
+    def put(self, keys, features):
+        """寫入新特徵（已存在的鍵會略過）"""
+        features = np.asarray(features)
+        if len(keys) == 0:
+            return
+        if self.dim is None:
+            self.dim = features.shape[1]
+        elif features.shape[1] != self.dim:
+            raise ValueError(f"特徵維度不符: 快取為 {self.dim}，寫入為 {features.shape[1]}")
+
+        new_rows = []
+        seen = set()
+        for i, key in enumerate(keys):
+            if key not in self.rows and key not in seen:
+                seen.add(key)
+                new_rows.append(i)
+        if not new_rows:
+            return
+
+        os.makedirs(self.dir, exist_ok=True)
+        start = self.count
+        self.count += len(new_rows)
+        with open(self.vectors_path, 'ab') as f:
+            f.truncate(self.count * self.dim * self.dtype.itemsize)
+        vectors = self._vectors(mode='r+')
+        vectors[start:self.count] = features[new_rows].astype(self.dtype)
+        vectors.flush()
+        del vectors
+
+        for offset, i in enumerate(new_rows):
+            self.rows[keys[i]] = start + offset
+
+    def save(self):
+        """原子寫入鍵表"""
+        if self.dim is None:
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = self.keys_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({
+                'namespace': self.namespace,
+                'dim': self.dim,
+                'dtype': self.dtype.name,
+                'count': self.count,
+                'rows': self.rows,
+                'stats': self.stats
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+            signature = self._file_signature(f.fileno())
+        os.replace(tmp_path, self.keys_path)
+        self._keys_signature = signature
+
+    def gc(self):
+        """
+        清除來源圖片已不存在的項目並壓縮特徵矩陣
+
+        Returns:
+            移除的特徵數
+        """
+        self.stats = {path: stat for path, stat in self.stats.items() if os.path.exists(path)}
+        live = {stat[2] for stat in self.stats.values()}
+        keep = sorted((row, key) for key, row in self.rows.items() if key in live)
+        removed = self.count - len(keep)
+        if removed == 0:
+            self.save()
+            return 0
+
+        tmp_path = self.vectors_path + '.tmp'
+        if keep:
+            old_vectors = self._vectors()
+            new_vectors = np.memmap(tmp_path, dtype=self.dtype, mode='w+', shape=(len(keep), self.dim))
+            for start in range(0, len(keep), 4096):
+                chunk = keep[start:start + 4096]
+                new_vectors[start:start + len(chunk)] = old_vectors[[row for row, _ in chunk]]
+            new_vectors.flush()
+            del new_vectors, old_vectors
+            os.replace(tmp_path, self.vectors_path)
+        else:
+            os.remove(self.vectors_path)
+
+        self.rows = {key: new_row for new_row, (_, key) in enumerate(keep)}
+        self.count = len(keep)
+        self.save()
+        return removed
+
+
+def gc_all(cache_dir=DEFAULT_CACHE_DIR):
+    """對快取目錄下所有命名空間執行垃圾回收"""
+    if not os.path.isdir(cache_dir):
+        print(f"⚠️  快取目錄不存在: {cache_dir}")
+        return 0
+
+    total_removed = 0
+    for name in sorted(os.listdir(cache_dir)):
+        keys_path = os.path.join(cache_dir, name, KEYS_FILE)
+        if not os.path.exists(keys_path):
+            continue
+        with open(keys_path, 'rb') as f:
+            namespace = pickle.load(f)['namespace']
+        cache = FeatureCache(namespace, cache_dir)
+        removed = cache.gc()
+        total_removed += removed
+        print(f"🧹 {namespace}: 移除 {removed} 個特徵，保留 {len(cache)} 個")
+    return total_removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="特徵快取管理")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='快取根目錄')
+    parser.add_argument('--gc', action='store_true', help='清除來源圖片已不存在的項目')
+    args = parser.parse_args()
+
+    if args.gc:
+        gc_all(args.cache_dir)
+    else:
+        parser.print_help()
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+Image Batch Loading Helpers
+建立索引時 DataLoader 共用的批次組合與解碼 worker 設定
+
+FAISS 識別引擎與 CLIP 特徵提取器的圖片資料集都回傳 (張量或 None, 索引)，
+無法讀取的圖片為 None，由 collate_images 在組合批次時略過。
+"""
+
+import torch
+
+
+def collate_images(batch):
+    """組合批次，略過無法讀取的圖片；回傳 (張量, 有效索引, 批次原始大小)"""
+    valid = [(tensor, idx) for tensor, idx in batch if tensor is not None]
+    if not valid:
+        return None, [], len(batch)
+    tensors, indices = zip(*valid)
+    return torch.stack(tensors), list(indices), len(batch)
+
+
+def init_decode_worker(worker_id):
+    """解碼 worker 只做 I/O 與預處理，限制為單執行緒避免與主行程搶 CPU"""
+    torch.set_num_threads(1)
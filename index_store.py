@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Versioned Index Store
+版本化的 FAISS 索引目錄與原子發布
+
+目錄結構：
+    faiss_index/
+        CURRENT                 目前版本名稱（原子取代）
+        v20250101-120000-000001/ 各版本的索引檔案
+        .staging-*/             寫入中的暫存目錄
+
+發布流程：寫入暫存目錄 → fsync 檔案與目錄 → 重新命名為版本目錄 → 以暫存檔 + os.replace 更新 CURRENT。
+讀取端只看 CURRENT 指向的完整版本，不會讀到寫到一半的檔案。
+"""
+
+import os
+import time
+import shutil
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+DEFAULT_INDEX_ROOT = os.environ.get('FAISS_INDEX_ROOT', 'faiss_index')
+# CLIP 以文搜圖索引（特徵、標籤、路徑與 FAISS 索引同一版本發布）
+CLIP_INDEX_ROOT = os.environ.get('CLIP_INDEX_ROOT', 'clip_index')
+DEFAULT_KEEP_VERSIONS = int(os.environ.get('FAISS_INDEX_KEEP', 3))
+CURRENT_FILE = 'CURRENT'
+STAGING_PREFIX = '.staging-'
+STALE_STAGING_SECONDS = 6 * 3600
+
+
+def _fsync_dir(path):
+    """fsync 目錄，確保重新命名已寫入磁碟（不支援的平台略過）"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def current_version(root=DEFAULT_INDEX_ROOT):
+    """目前發布的版本名稱，尚未發布時回傳 None"""
+    try:
+        with open(os.path.join(root, CURRENT_FILE), 'r', encoding='utf-8') as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return version if version and os.path.isdir(os.path.join(root, version)) else None
+
+
+def current_index_dir(root=DEFAULT_INDEX_ROOT, legacy_dir='.'):
+    """目前版本的目錄；尚未發布任何版本時回傳舊版索引所在目錄"""
+    version = current_version(root)
+    return os.path.join(root, version) if version else legacy_dir
+
+
+def list_versions(root=DEFAULT_INDEX_ROOT):
+    """所有已發布版本（由舊到新）"""
+    if not os.path.isdir(root):
+        return []
+    return sorted(d for d in os.listdir(root)
+                  if d.startswith('v') and os.path.isdir(os.path.join(root, d)))
+
+
+def begin_version(root=DEFAULT_INDEX_ROOT):
+    """建立新的暫存目錄，寫完後以 publish() 發布"""
+    os.makedirs(root, exist_ok=True)
+    staging = os.path.join(root, f"{STAGING_PREFIX}{os.getpid()}-{time.time_ns()}")
+    os.makedirs(staging)
+    return staging
+
+
+def abort_version(staging_dir):
+    """放棄暫存目錄"""
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def publish(staging_dir, root=DEFAULT_INDEX_ROOT, keep=DEFAULT_KEEP_VERSIONS):
+    """
+    原子發布暫存目錄為新版本
+
+    Returns:
+        新版本名稱
+    """
+    for name in os.listdir(staging_dir):
+        with open(os.path.join(staging_dir, name), 'rb') as f:
+            os.fsync(f.fileno())
+    _fsync_dir(staging_dir)
+
+    version = 'v' + datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    while os.path.exists(os.path.join(root, version)):
+        version += '_'
+    os.rename(staging_dir, os.path.join(root, version))
+    _fsync_dir(root)
+
+    tmp_pointer = os.path.join(root, CURRENT_FILE + '.tmp')
+    with open(tmp_pointer, 'w', encoding='utf-8') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_pointer, os.path.join(root, CURRENT_FILE))
+    _fsync_dir(root)
+
+    gc_versions(root, keep)
+    return version
+
+
+def gc_versions(root=DEFAULT_INDEX_ROOT, keep=DEFAULT_KEEP_VERSIONS):
+    """
+    刪除舊版本（保留最新 keep 個與目前版本）與過期的暫存目錄
+
+    仍在使用舊版本 memmap 的行程不受影響（已開啟的檔案在關閉前不會被釋放）。
+    """
+    current = current_version(root)
+    versions = list_versions(root)
+    for version in versions[:-keep] if keep > 0 else versions:
+        if version != current:
+            shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+
+    now = time.time()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.startswith(STAGING_PREFIX) and now - os.path.getmtime(path) > STALE_STAGING_SECONDS:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class RWLock:
+    """讀寫鎖：多個讀取者可同時持有；寫入者等待中時新的讀取者需等待，避免寫入者飢餓"""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read_lock(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write_lock(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
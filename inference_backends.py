@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+CPU Inference Backends
+特徵提取骨幹網路的推論後端
+
+- torch:        PyTorch eager 模式（預設，fp32）
+- torchscript:  追蹤並凍結的 TorchScript 模型（融合 Conv+BN，fp32）
+- onnx:         匯出為 ONNX 並以 ONNX Runtime 執行（fp32）
+- onnx_int8:    ONNX Runtime + 靜態 int8 量化（以資料集圖片校正）
+
+匯出後的模型存放於 FAISS_MODEL_DIR（預設 models/），之後直接載入，不需重新匯出。
+以 FAISS_INFERENCE_BACKEND 環境變數選擇後端；可用 --check 比對與 fp32 模型的特徵與 top-1 一致性。
+"""
+
+import os
+import time
+import random
+import argparse
+import numpy as np
+import torch
+
+from backbones import backbone_spec, export_key
+
+try:
+    import onnxruntime as ort
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
+BACKENDS = ('torch', 'torchscript', 'onnx', 'onnx_int8')
+DEFAULT_BACKEND = os.environ.get('FAISS_INFERENCE_BACKEND', 'torch')
+MODEL_DIR = os.environ.get('FAISS_MODEL_DIR', 'models')
+
+# 量化後端的特徵與 fp32 略有差異，特徵快取須使用獨立命名空間
+QUANTIZED_BACKENDS = ('onnx_int8',)
+
+# 一致性檢查門檻：fp32 匯出應幾乎相同，int8 允許較大誤差
+PARITY_MIN_COSINE = {'torchscript': 0.9999, 'onnx': 0.9999, 'onnx_int8': 0.98}
+PARITY_MIN_TOP1_AGREEMENT = 0.97
+
+CALIBRATION_IMAGES = 64
+INPUT_SIZE = (3, 224, 224)
+
+
+def _log(message):
+    print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+
+class TorchScriptBackend:
+    """凍結的 TorchScript 模型"""
+
+    name = 'torchscript'
+
+    def __init__(self, model_path):
+        self.model = torch.jit.load(model_path, map_location='cpu')
+        self.model.eval()
+
+    def __call__(self, input_tensor):
+        with torch.no_grad():
+            return self.model(input_tensor.cpu()).flatten(1).numpy().astype(np.float32)
+
+
+class ONNXBackend:
+    """ONNX Runtime CPU 推論"""
+
+    def __init__(self, model_path, name='onnx', num_threads=None):
+        self.name = name
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, input_tensor):
+        inputs = np.ascontiguousarray(input_tensor.cpu().numpy(), dtype=np.float32)
+        features = self.session.run(None, {self.input_name: inputs})[0]
+        return features.reshape(len(features), -1).astype(np.float32)
+
+
+def model_path(backend, model_name='resnet50'):
+    """後端模型檔路徑（model_name 為 backbones.export_key()，含特徵命名空間與權重雜湊）"""
+    suffix = {'torchscript': '.pt', 'onnx': '.onnx', 'onnx_int8': '_int8.onnx'}[backend]
+    return os.path.join(MODEL_DIR, f"{model_name}_backbone{suffix}")
+
+
+def export_torchscript(torch_model, output_path):
+    """追蹤並凍結 TorchScript 模型"""
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    example = torch.randn(1, *INPUT_SIZE)
+    with torch.no_grad():
+        traced = torch.jit.trace(torch_model.cpu().eval(), example)
+        # freeze 會摺疊 Conv+BN；optimize_for_inference 產生的 MKLDNN 常數無法正確儲存，故不使用
+        frozen = torch.jit.freeze(traced)
+    frozen.save(output_path)
+    return output_path
+
+
+def export_onnx(torch_model, output_path):
+    """匯出 ONNX 模型（批次維度可變）"""
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    example = torch.randn(1, *INPUT_SIZE)
+    kwargs = dict(input_names=['input'], output_names=['features'],
+                  dynamic_axes={'input': {0: 'batch'}, 'features': {0: 'batch'}}, opset_version=17)
+    tmp_path = output_path + '.tmp'
+    with torch.no_grad():
+        try:
+            # 新版 PyTorch 預設使用 dynamo 匯出器，這裡固定使用 TorchScript 匯出器
+            torch.onnx.export(torch_model.cpu().eval(), example, tmp_path, dynamo=False, **kwargs)
+        except TypeError:
+            torch.onnx.export(torch_model.cpu().eval(), example, tmp_path, **kwargs)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def quantize_onnx_int8(fp32_path, output_path, calibration_batches):
+    """
+    靜態 int8 量化（每通道權重 + 校正後的激活值範圍）
+
+    Args:
+        fp32_path: fp32 ONNX 模型
+        output_path: 量化後模型路徑
+        calibration_batches: 已預處理的 N×3×H×W float32 陣列列表；為空時改用動態量化
+    """
+    from onnxruntime.quantization import (quantize_static, quantize_dynamic, CalibrationDataReader,
+                                          QuantFormat, QuantType)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    # 量化前處理：圖優化 + 形狀推論（將 BN 摺疊進 Conv 的 bias）
+    prep_path = output_path + '.prep.onnx'
+    try:
+        quant_pre_process(fp32_path, prep_path)
+        fp32_path = prep_path
+    except Exception as e:
+        _log(f"⚠️  量化前處理失敗，直接量化: {e}")
+
+    class _Reader(CalibrationDataReader):
+        def __init__(self, batches):
+            self.batches = iter(batches)
+
+        def get_next(self):
+            batch = next(self.batches, None)
+            return None if batch is None else {'input': batch}
+
+    try:
+        if calibration_batches:
+            quantize_static(fp32_path, output_path, _Reader(calibration_batches),
+                            quant_format=QuantFormat.QDQ, per_channel=True,
+                            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+        else:
+            _log("⚠️  沒有校正圖片，改用動態 int8 量化")
+            quantize_dynamic(fp32_path, output_path, weight_type=QuantType.QInt8)
+    finally:
+        if os.path.exists(prep_path):
+            os.remove(prep_path)
+    return output_path
+
+
+def sample_dataset_images(dataset_dir='dataset', n_images=CALIBRATION_IMAGES, seed=0):
+    """從資料集各類別平均抽樣圖片"""
+    if not os.path.isdir(dataset_dir):
+        return []
+    per_class = {}
+    for class_name in sorted(os.listdir(dataset_dir)):
+        class_dir = os.path.join(dataset_dir, class_name)
+        if os.path.isdir(class_dir):
+            per_class[class_name] = sorted(os.path.join(class_dir, f) for f in os.listdir(class_dir)
+                                           if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+    rng = random.Random(seed)
+    samples = []
+    while len(samples) < n_images and any(per_class.values()):
+        for images in per_class.values():
+            if images and len(samples) < n_images:
+                samples.append(images.pop(rng.randrange(len(images))))
+    return samples
+
+
+def _calibration_batches(image_paths, transform, batch_size=8):
+    from PIL import Image
+
+    tensors = []
+    for path in image_paths:
+        try:
+            tensors.append(transform(Image.open(path).convert('RGB')).numpy())
+        except Exception as e:
+            print(f"⚠️  校正圖片讀取失敗 {path}: {e}")
+    return [np.stack(tensors[i:i + batch_size]) for i in range(0, len(tensors), batch_size)]
+
+
+def create_backend(backend, torch_model, transform=None, dataset_dir='dataset', backbone=None):
+    """
+    建立推論後端；模型檔不存在時從 torch_model 匯出
+
+    Args:
+        dataset_dir: int8 量化的校正圖片來源（應為建立索引的資料集）
+        backbone: 骨幹網路 spec（預設 FAISS_BACKBONE），匯出檔名以 export_key(backbone) 區分，只在需要匯出/載入後端時計算
+
+    Returns:
+        可呼叫物件 (N×3×H×W 張量 -> N×D float32 陣列)；backend 為 'torch' 或
+        相依套件不可用時回傳 None，呼叫端應沿用 PyTorch 模型
+    """
+    if backend == 'torch':
+        return None
+    if backend not in BACKENDS:
+        print(f"⚠️  未知的推論後端 {backend}，使用 PyTorch")
+        return None
+    if backend.startswith('onnx') and not ONNX_AVAILABLE:
+        print(f"⚠️  onnxruntime 未安裝，{backend} 後端不可用，使用 PyTorch")
+        return None
+
+    try:
+        model_name = export_key(backbone or backbone_spec())
+        path = model_path(backend, model_name)
+        if backend == 'torchscript':
+            if not os.path.exists(path):
+                _log(f"📦 匯出 TorchScript 模型: {path}")
+                export_torchscript(torch_model, path)
+            return TorchScriptBackend(path)
+
+        fp32_path = model_path('onnx', model_name)
+        if not os.path.exists(fp32_path):
+            _log(f"📦 匯出 ONNX 模型: {fp32_path}")
+            export_onnx(torch_model, fp32_path)
+        if backend == 'onnx_int8' and not os.path.exists(path):
+            _log(f"🗜️  int8 量化 ONNX 模型: {path}")
+            images = sample_dataset_images(dataset_dir) if transform is not None else []
+            quantize_onnx_int8(fp32_path, path, _calibration_batches(images, transform))
+        return ONNXBackend(path, name=backend)
+    except Exception as e:
+        print(f"❌ 建立 {backend} 後端失敗，使用 PyTorch: {e}")
+        return None
+
+
+def check_parity(backend, image_paths=None, dataset_dir='dataset', n_images=CALIBRATION_IMAGES, k=5):
+    """
+    比對後端與 fp32 PyTorch 模型的特徵與 top-1 預測
+
+    已有 FAISS 索引時，以兩組特徵分別搜尋索引並比較 top-1 類別。
+
+    Returns:
+        報告字典，'passed' 表示是否符合門檻
+    """
+    from faiss_recognition import FAISSRecognitionEngine
+
+    if image_paths is None:
+        image_paths = sample_dataset_images(dataset_dir, n_images, seed=1)
+    if not image_paths:
+        print("❌ 沒有可用於比對的圖片")
+        return None
+
+    reference = FAISSRecognitionEngine(backend='torch')
+    candidate = FAISSRecognitionEngine(backend=backend)
+    has_index = reference.load_index() and candidate.load_index()
+    reference.load_feature_extractor()
+    candidate.load_feature_extractor()
+    if candidate.backend is None:
+        print(f"❌ 後端 {backend} 不可用")
+        return None
+
+    tensors = torch.stack([t for t in map(reference._preprocess, image_paths) if t is not None])
+
+    def timed(engine):
+        engine.extract_features_batch(tensors[:1])  # 預熱
+        start = time.time()
+        features = np.vstack([engine.extract_features_batch(tensors[i:i + 16]) for i in range(0, len(tensors), 16)])
+        return features, (time.time() - start) * 1000 / len(tensors)
+
+    ref_features, ref_ms = timed(reference)
+    cand_features, cand_ms = timed(candidate)
+    cosine = np.sum(ref_features * cand_features, axis=1)
+
+    report = {
+        'backend': backend,
+        'images': len(tensors),
+        'min_cosine': float(cosine.min()),
+        'mean_cosine': float(cosine.mean()),
+        'torch_ms_per_image': round(ref_ms, 2),
+        'backend_ms_per_image': round(cand_ms, 2),
+        'speedup': round(ref_ms / cand_ms, 2) if cand_ms > 0 else None,
+        'top1_agreement': None
+    }
+    passed = report['min_cosine'] >= PARITY_MIN_COSINE[backend]
+
+    if has_index:
+        ref_top1 = [reference._format_result(s, i, 0, k, 1)['predictions'][0]['class_name']
+                    for s, i in reference._search_distinct(ref_features, k, 1)]
+        cand_top1 = [reference._format_result(s, i, 0, k, 1)['predictions'][0]['class_name']
+                     for s, i in reference._search_distinct(cand_features, k, 1)]
+        report['top1_agreement'] = float(np.mean([a == b for a, b in zip(ref_top1, cand_top1)]))
+        passed = passed and report['top1_agreement'] >= PARITY_MIN_TOP1_AGREEMENT
+
+    report['passed'] = bool(passed)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="匯出 CPU 推論後端並檢查與 fp32 模型的一致性")
+    parser.add_argument('--backend', choices=BACKENDS[1:], default='onnx_int8', help='推論後端')
+    parser.add_argument('--dataset', default='dataset', help='校正與比對用的資料集目錄')
+    parser.add_argument('--export', action='store_true', help='匯出模型（已存在則略過）')
+    parser.add_argument('--check', action='store_true', help='比對特徵與 top-1 預測')
+    parser.add_argument('--images', type=int, default=CALIBRATION_IMAGES, help='比對圖片數')
+    args = parser.parse_args()
+
+    if args.export:
+        from faiss_recognition import FAISSRecognitionEngine
+        engine = FAISSRecognitionEngine(backend=args.backend)
+        engine.dataset_dir = args.dataset
+        engine.load_feature_extractor()
+        print(f"✅ {args.backend} 模型: {model_path(args.backend, export_key(engine.backbone))}" if engine.backend else "❌ 匯出失敗")
+
+    if args.check:
+        result = check_parity(args.backend, dataset_dir=args.dataset, n_images=args.images)
+        if result:
+            for key, value in result.items():
+                print(f"  {key}: {value}")
+            print("✅ 一致性檢查通過" if result['passed'] else "❌ 一致性檢查未通過")
+            raise SystemExit(0 if result['passed'] else 1)
+        raise SystemExit(1)
+
+    if not (args.export or args.check):
+        parser.print_help()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Inference Micro-batcher
+合併同時到達的推論請求
+
+多個 Flask 執行緒同時呼叫預測時，各自以批次大小 1 執行前向傳播並互相搶 CPU。
+此元件將請求放入佇列，由單一工作執行緒收集成批次（達到最大批次大小或等待時間上限即送出），
+以一次批次預測處理，再將結果分別交回各呼叫端。
+"""
+
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+DEFAULT_MAX_BATCH_SIZE = int(os.environ.get('FAISS_BATCH_MAX_SIZE', 16))
+DEFAULT_MAX_WAIT_MS = float(os.environ.get('FAISS_BATCH_MAX_WAIT_MS', 10))
+
+
+class InferenceBatcher:
+    """
+    請求合併批次處理器
+
+    predict_fn 接收項目列表並回傳等長的結果列表；呼叫端以 submit() 取得 Future，
+    或以 predict() 同步等待結果。
+    """
+
+    def __init__(self, predict_fn, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS,
+                 name='inference-batcher'):
+        """
+        Args:
+            predict_fn: 批次預測函數 (items) -> results
+            max_batch_size: 每批最多項目數
+            max_wait_ms: 第一個請求到達後最多等待多久湊批次（毫秒），限制尾端延遲
+            name: 工作執行緒名稱
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.name = name
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # 統計
+        self.batches = 0
+        self.requests = 0
+        self.max_observed_batch = 0
+
+    def start(self):
+        """啟動工作執行緒（已啟動時不重複建立）"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """停止工作執行緒（佇列中已送出的請求會先處理完）"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join(timeout)
+
+    def submit(self, item):
+        """送出單一請求，回傳 Future"""
+        self.start()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def submit_many(self, items):
+        """送出多個請求，回傳與 items 對應的 Future 列表"""
+        return [self.submit(item) for item in items]
+
+    def predict(self, item, timeout=None):
+        """同步預測單一項目"""
+        return self.submit(item).result(timeout)
+
+    def stats(self):
+        """批次統計"""
+        return {
+            'batches': self.batches,
+            'requests': self.requests,
+            'avg_batch_size': round(self.requests / self.batches, 2) if self.batches else 0,
+            'max_batch_size': self.max_observed_batch,
+            'queue_size': self._queue.qsize()
+        }
+
+    def _collect(self, first):
+        """從第一個請求開始收集批次，直到達到大小上限或等待逾時"""
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        stop = False
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:
+                stop = True
+                break
+            batch.append(entry)
+        return batch, stop
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch, stop = self._collect(first)
+
+            # 略過已被呼叫端取消的請求
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if batch:
+                self._process(batch)
+            if stop:
+                return
+
+    def _process(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = self.predict_fn(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"批次預測結果數量不符: {len(results)} != {len(items)}")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+        self.batches += 1
+        self.requests += len(batch)
+        self.max_observed_batch = max(self.max_observed_batch, len(batch))
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Columnar Label Store
+以欄位式、可記憶體映射的格式儲存 FAISS 向量標籤
+
+取代每個向量一個 dict 的 faiss_labels.pkl。檔案格式（單一檔案，little-endian）：
+
+    magic 'FLBL' | version u32 | header_len u32 | header (UTF-8 JSON) | 對齊 8 bytes
+    class_ids    int32[N]       | 對齊 8 bytes
+    vector_ids   int64[N]
+    path_offsets int64[N + 1]
+    path_blob    uint8[...]     (UTF-8 圖片路徑串接)
+
+header 包含類別名稱、各類別向量數與索引中繼資料，只讀 header 即可取得統計資訊；
+欄位資料以 np.memmap 映射，載入時間與常駐記憶體幾乎與向量數無關。
+"""
+
+import os
+import json
+import pickle
+import struct
+import numpy as np
+
+MAGIC = b'FLBL'
+VERSION = 1
+_PREFIX = struct.Struct('<4sII')
+
+LABELS_FILE = 'faiss_labels.bin'
+LEGACY_LABELS_FILE = 'faiss_labels.pkl'
+
+
+def _align8(n):
+    return (n + 7) & ~7
+
+
+def _section_offsets(data_start, count):
+    """依向量數計算各欄位在檔案中的起點"""
+    class_ids = data_start
+    vector_ids = _align8(class_ids + 4 * count)
+    path_offsets = vector_ids + 8 * count
+    path_blob = path_offsets + 8 * (count + 1)
+    return class_ids, vector_ids, path_offsets, path_blob
+
+
+def read_header(path=LABELS_FILE):
+    """只讀取檔案 header（類別、數量與中繼資料），不映射欄位資料"""
+    with open(path, 'rb') as f:
+        magic, version, header_len = _PREFIX.unpack(f.read(_PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(f"不是標籤檔: {path}")
+        if version > VERSION:
+            raise ValueError(f"不支援的標籤檔版本: {version}")
+        return json.loads(f.read(header_len).decode('utf-8'))
+
+
+def read_label_summary(path=LABELS_FILE, legacy_path=LEGACY_LABELS_FILE):
+    """
+    取得標籤統計（供網頁端點使用）
+
+    Returns:
+        {'classes', 'class_counts', 'num_vectors', 'meta', 'path'}；檔案不存在時回傳 None
+    """
+    if os.path.exists(path):
+        header = read_header(path)
+        return {
+            'classes': header['classes'],
+            'class_counts': header['class_counts'],
+            'num_vectors': header['num_vectors'],
+            'meta': header.get('meta', {}),
+            'path': path
+        }
+    if os.path.exists(legacy_path):
+        with open(legacy_path, 'rb') as f:
+            data = pickle.load(f)
+        if not isinstance(data, dict):
+            # 更早期的格式：類別名稱列表
+            classes = sorted(set(data))
+            return {'classes': classes, 'class_counts': [data.count(c) for c in classes],
+                    'num_vectors': len(data), 'meta': {}, 'path': legacy_path}
+        classes = data.get('classes', [])
+        counts = [0] * len(classes)
+        for label in data.get('labels', []):
+            counts[label['class_id']] += 1
+        meta = {key: data[key] for key in ('next_id', 'class_signatures', 'index_config') if key in data}
+        return {'classes': classes, 'class_counts': counts, 'num_vectors': len(data.get('labels', [])),
+                'meta': meta, 'path': legacy_path}
+    return None
+
+
+class LabelStore:
+    """
+    欄位式標籤表；以列索引取得相容於舊版 dict 的標籤
+
+    classes 為 list 時直接共用（不複製），呼叫端的類別列表與標籤表保持一致。
+    """
+
+    def __init__(self, classes, class_ids=None, vector_ids=None, path_offsets=None, path_blob=None):
+        self.classes = classes if isinstance(classes, list) else list(classes)
+        self.class_ids = np.asarray(class_ids if class_ids is not None else [], dtype=np.int32)
+        self.vector_ids = np.asarray(vector_ids if vector_ids is not None else [], dtype=np.int64)
+        self.path_offsets = np.asarray(path_offsets if path_offsets is not None else [0], dtype=np.int64)
+        self.path_blob = np.asarray(path_blob if path_blob is not None else [], dtype=np.uint8)
+
+    @classmethod
+    def from_columns(cls, classes, class_ids, vector_ids, image_paths):
+        """由欄位資料建立"""
+        path_offsets, path_blob = _encode_paths(image_paths)
+        return cls(classes, class_ids, vector_ids, path_offsets, path_blob)
+
+    @classmethod
+    def from_records(cls, records, classes):
+        """由舊版 dict 標籤列表建立（沒有 vector_id 的舊標籤以列索引作為 ID）"""
+        return cls.from_columns(classes,
+                                [r['class_id'] for r in records],
+                                [r.get('vector_id', row) for row, r in enumerate(records)],
+                                [r['image_path'] for r in records])
+
+    @classmethod
+    def load(cls, path=LABELS_FILE):
+        """
+        以記憶體映射載入
+
+        Returns:
+            (LabelStore, header 中的中繼資料 dict)
+        """
+        with open(path, 'rb') as f:
+            magic, version, header_len = _PREFIX.unpack(f.read(_PREFIX.size))
+            if magic != MAGIC:
+                raise ValueError(f"不是標籤檔: {path}")
+            if version > VERSION:
+                raise ValueError(f"不支援的標籤檔版本: {version}")
+            header = json.loads(f.read(header_len).decode('utf-8'))
+
+        count = header['num_vectors']
+        data_start = _align8(_PREFIX.size + header_len)
+        class_start, vector_start, offsets_start, blob_start = _section_offsets(data_start, count)
+        raw = np.memmap(path, dtype=np.uint8, mode='r')
+
+        store = cls(header['classes'])
+        store.class_ids = raw[class_start:class_start + 4 * count].view(np.int32)
+        store.vector_ids = raw[vector_start:vector_start + 8 * count].view(np.int64)
+        store.path_offsets = raw[offsets_start:offsets_start + 8 * (count + 1)].view(np.int64)
+        store.path_blob = raw[blob_start:blob_start + int(store.path_offsets[-1])]
+        return store, header.get('meta', {})
+
+    def save(self, path=LABELS_FILE, **meta):
+        """原子寫入（先寫暫存檔並 fsync，再取代）"""
+        header = json.dumps({
+            'classes': self.classes,
+            'class_counts': self.class_counts().tolist(),
+            'num_vectors': len(self),
+            'meta': meta
+        }, ensure_ascii=False).encode('utf-8')
+
+        count = len(self)
+        data_start = _align8(_PREFIX.size + len(header))
+        class_start, vector_start, offsets_start, blob_start = _section_offsets(data_start, count)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_PREFIX.pack(MAGIC, VERSION, len(header)))
+            f.write(header)
+            f.write(b'\0' * (class_start - f.tell()))
+            f.write(np.ascontiguousarray(self.class_ids, dtype='<i4').tobytes())
+            f.write(b'\0' * (vector_start - f.tell()))
+            f.write(np.ascontiguousarray(self.vector_ids, dtype='<i8').tobytes())
+            f.write(np.ascontiguousarray(self.path_offsets, dtype='<i8').tobytes())
+            f.write(np.ascontiguousarray(self.path_blob, dtype=np.uint8).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.class_ids)
+
+    def __getitem__(self, row):
+        class_id = int(self.class_ids[row])
+        return {
+            'class_id': class_id,
+            'class_name': self.classes[class_id],
+            'image_path': self.image_path(row),
+            'vector_id': int(self.vector_ids[row])
+        }
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def image_path(self, row):
+        start, end = self.path_offsets[row], self.path_offsets[row + 1]
+        return self.path_blob[start:end].tobytes().decode('utf-8')
+
+    def class_counts(self):
+        """各類別向量數"""
+        return np.bincount(self.class_ids, minlength=len(self.classes))
+
+    def extend(self, class_id, vector_ids, image_paths):
+        """附加同一類別的多筆標籤"""
+        offsets, blob = _encode_paths(image_paths)
+        self.class_ids = np.concatenate([self.class_ids, np.full(len(vector_ids), class_id, dtype=np.int32)])
+        self.vector_ids = np.concatenate([self.vector_ids, np.asarray(vector_ids, dtype=np.int64)])
+        self.path_offsets = np.concatenate([self.path_offsets, offsets[1:] + self.path_offsets[-1]])
+        self.path_blob = np.concatenate([self.path_blob, blob])
+
+    def remove_class(self, class_id):
+        """刪除一個類別（含類別名稱）的所有標籤，並將之後的 class_id 減一"""
+        keep = self.class_ids != class_id
+        lengths = np.diff(self.path_offsets)[keep]
+        byte_keep = np.repeat(keep, np.diff(self.path_offsets))
+
+        class_ids = self.class_ids[keep]
+        class_ids[class_ids > class_id] -= 1
+        self.class_ids = class_ids
+        self.vector_ids = self.vector_ids[keep]
+        self.path_blob = self.path_blob[byte_keep]
+        self.path_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        del self.classes[class_id]
+
+
+def _encode_paths(paths):
+    """將字串列表編碼為 (offsets, blob)"""
+    encoded = [p.encode('utf-8') for p in paths]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8).copy()
+    return offsets, blob
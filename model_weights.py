@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Model Weights Registry
+離線的模型權重目錄：啟動時直接讀取本機權重檔，不連網、不依賴使用者家目錄的下載快取
+
+目錄（MODEL_WEIGHTS_DIR，預設 model_weights）內放置與官方下載檔同名的權重檔：
+    model_weights/
+        resnet50-0676ba61.pth   torchvision 權重（檔名含 SHA-256 前綴）
+        ViT-B-32.pt             CLIP 權重（官方網址路徑含完整 SHA-256）
+        manifest.json           --fetch 時記錄的完整 SHA-256
+
+載入前以 SHA-256 驗證（結果依檔案大小與修改時間記錄於 <檔名>.sha256，檔案未變更時不重新計算）；
+torchvision 權重以記憶體映射讀取，張量內容在使用時才從磁碟讀入。
+
+權重檔不在目錄中時直接報錯，啟動不依賴網路；需要時才以 MODEL_WEIGHTS_ALLOW_DOWNLOAD=1 允許
+退回 torchvision / CLIP 的線上下載。在可連網的機器下載後，將整個目錄複製到部署主機：
+    python model_weights.py --fetch resnet50 clip:ViT-B/32
+    python model_weights.py --list
+"""
+
+import os
+import re
+import json
+import pickle
+import hashlib
+import argparse
+import torch
+
+WEIGHTS_DIR = os.environ.get('MODEL_WEIGHTS_DIR', 'model_weights')
+# 權重不在目錄中時預設直接報錯；1：允許退回 torchvision / CLIP 的線上下載
+ALLOW_DOWNLOAD = os.environ.get('MODEL_WEIGHTS_ALLOW_DOWNLOAD', '0') == '1'
+VERIFY = os.environ.get('MODEL_WEIGHTS_VERIFY', '1') != '0'
+
+MANIFEST_FILE = 'manifest.json'
+CLIP_PREFIX = 'clip:'
+# torchvision 權重檔名中的雜湊前綴，例如 resnet50-0676ba61.pth
+HASH_REGEX = re.compile(r'-([a-f0-9]+)\.')
+
+
+class WeightsNotFoundError(FileNotFoundError):
+    """權重檔不在權重目錄中（且未允許線上下載）"""
+
+
+class WeightsChecksumError(ValueError):
+    """權重檔的 SHA-256 與登錄值不符"""
+
+
+class WeightsCorruptError(ValueError):
+    """權重檔損毀或不完整，無法讀取"""
+
+
+# 權重無法使用的錯誤（重建索引也無法修復，呼叫端不應視為索引不存在）
+WEIGHTS_ERRORS = (WeightsNotFoundError, WeightsChecksumError, WeightsCorruptError)
+
+
+def torchvision_entry(weights_enum, tag):
+    """torchvision 權重 -> (檔名, 下載網址, SHA-256 前綴)"""
+    from torchvision import models
+    url = getattr(models, weights_enum)[tag].url
+    filename = os.path.basename(url)
+    match = HASH_REGEX.search(filename)
+    return filename, url, match.group(1) if match else None
+
+
+def clip_entry(model_name):
+    """CLIP 模型 -> (檔名, 下載網址, SHA-256)"""
+    from clip.clip import _MODELS
+    url = _MODELS[model_name]
+    return os.path.basename(url), url, url.split('/')[-2]
+
+
+def registry_entry(key):
+    """登錄名稱（骨幹網路名稱或 'clip:<模型名稱>'）-> (檔名, 下載網址, 預期 SHA-256 或前綴)"""
+    if key.startswith(CLIP_PREFIX):
+        return clip_entry(key[len(CLIP_PREFIX):])
+    from backbones import BACKBONES
+    if key not in BACKBONES:
+        raise ValueError(f"未登錄的權重: {key}")
+    _, weights_enum, tag, _ = BACKBONES[key]
+    return torchvision_entry(weights_enum, tag)
+
+
+def file_sha256(path):
+    """串流計算檔案的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cached_sha256(path):
+    """檔案大小與修改時間未變時沿用上次計算的 SHA-256（目錄唯讀時每次重新計算）"""
+    stat = os.stat(path)
+    stamp_path = path + '.sha256'
+    try:
+        with open(stamp_path, 'r', encoding='utf-8') as f:
+            stamp = json.load(f)
+        if stamp['size'] == stat.st_size and stamp['mtime_ns'] == stat.st_mtime_ns:
+            return stamp['sha256']
+    except (OSError, ValueError, KeyError):
+        pass
+    digest = file_sha256(path)
+    try:
+        with open(stamp_path, 'w', encoding='utf-8') as f:
+            json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}, f)
+    except OSError:
+        pass
+    return digest
+
+
+def _read_manifest(weights_dir=WEIGHTS_DIR):
+    path = os.path.join(weights_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def verify(path, expected=None, manifest=None):
+    """
+    驗證權重檔：SHA-256 須以登錄的前綴開頭，且與 manifest 記錄一致
+
+    Raises:
+        WeightsChecksumError
+    """
+    digest = _cached_sha256(path)
+    recorded = (manifest or {}).get(os.path.basename(path))
+    for reference in (expected, recorded):
+        if reference and not digest.startswith(reference):
+            raise WeightsChecksumError(f"權重檔校驗失敗: {path}（SHA-256 {digest[:16]}…，預期 {reference[:16]}…）")
+    return digest
+
+
+def resolve(key, weights_dir=None):
+    """
+    權重檔在權重目錄中的路徑（已驗證）
+
+    檔案不存在時拋出 WeightsNotFoundError；MODEL_WEIGHTS_ALLOW_DOWNLOAD=1 時回傳 None，由呼叫端退回線上下載。
+    """
+    weights_dir = weights_dir or WEIGHTS_DIR
+    filename, _, expected = registry_entry(key)
+    path = os.path.join(weights_dir, filename)
+    if not os.path.exists(path):
+        if ALLOW_DOWNLOAD:
+            return None
+        raise WeightsNotFoundError(
+            f"找不到 {key} 的權重檔: {path}；請在可連網的機器執行 python model_weights.py --fetch {key}，"
+            f"再將 {weights_dir} 目錄複製到此主機（或設定 MODEL_WEIGHTS_ALLOW_DOWNLOAD=1 允許線上下載）")
+    if VERIFY:
+        verify(path, expected, _read_manifest(weights_dir))
+    return path
+
+
+def load_state_dict(path):
+    """
+    以記憶體映射讀取 state dict；舊版 torch 或舊序列化格式不支援時一般讀取
+
+    Raises:
+        WeightsCorruptError: 檔案損毀或不完整（例如下載中斷後仍沿用舊的校驗記錄）
+    """
+    try:
+        try:
+            return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+        except (TypeError, RuntimeError):
+            return torch.load(path, map_location='cpu')
+    except (pickle.UnpicklingError, EOFError, RuntimeError, IndexError, ValueError) as e:
+        raise WeightsCorruptError(
+            f"權重檔損毀或不完整: {path}（{e}）；請刪除該檔案與 {os.path.basename(path)}.sha256 後重新執行 "
+            f"python model_weights.py --fetch") from e
+
+
+def clip_weights(model_name):
+    """clip.load() 的參數：權重目錄中的檔案路徑（允許線上下載且檔案不存在時為模型名稱）"""
+    return resolve(CLIP_PREFIX + model_name) or model_name
+
+
+def registered_keys():
+    """所有可登錄的權重名稱（未安裝 clip 時不含 CLIP 模型）"""
+    from backbones import BACKBONES
+    keys = list(BACKBONES)
+    try:
+        from clip.clip import _MODELS
+        keys += [CLIP_PREFIX + name for name in _MODELS]
+    except ImportError:
+        pass
+    return keys
+
+
+def fetch(keys, weights_dir=None):
+    """下載權重到權重目錄並記錄完整 SHA-256（在可連網的機器執行）"""
+    weights_dir = weights_dir or WEIGHTS_DIR
+    os.makedirs(weights_dir, exist_ok=True)
+    manifest = _read_manifest(weights_dir)
+    ok = True
+    for key in keys:
+        filename, url, expected = registry_entry(key)
+        path = os.path.join(weights_dir, filename)
+        if not os.path.exists(path):
+            print(f"⬇️  下載 {key}: {url}")
+            torch.hub.download_url_to_file(url, path + '.tmp', progress=True)
+            os.replace(path + '.tmp', path)
+        digest = file_sha256(path)
+        if expected and not digest.startswith(expected):
+            print(f"❌ {key} 校驗失敗，已刪除: {path}")
+            os.remove(path)
+            ok = False
+            continue
+        manifest[filename] = digest
+        print(f"✅ {key}: {filename} ({os.path.getsize(path) / (1024 * 1024):.1f} MB, SHA-256 {digest[:16]}…)")
+
+    tmp_path = os.path.join(weights_dir, MANIFEST_FILE + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(weights_dir, MANIFEST_FILE))
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="離線模型權重目錄")
+    parser.add_argument('--fetch', nargs='+', metavar='NAME', default=[],
+                        help="下載權重（骨幹網路名稱或 clip:<模型>，例如 resnet50 clip:ViT-B/32）")
+    parser.add_argument('--list', action='store_true', help='列出並驗證權重目錄內容')
+    parser.add_argument('--dir', default=None, help=f'權重目錄（預設 MODEL_WEIGHTS_DIR 或 {WEIGHTS_DIR}）')
+    args = parser.parse_args()
+
+    if args.fetch and not fetch(args.fetch, args.dir):
+        raise SystemExit(1)
+    if args.list or not args.fetch:
+        weights_dir = args.dir or WEIGHTS_DIR
+        manifest = _read_manifest(weights_dir)
+        print(f"📂 權重目錄: {os.path.abspath(weights_dir)}")
+        for key in registered_keys():
+            filename, _, expected = registry_entry(key)
+            path = os.path.join(weights_dir, filename)
+            if not os.path.exists(path):
+                status = '－ 缺少'
+            else:
+                try:
+                    verify(path, expected, manifest)
+                    status = '✅ 已驗證'
+                except WeightsChecksumError:
+                    status = '❌ 校驗失敗'
+            print(f"  {status}  {key:<24}{filename}")
@@ -0,0 +1,92 @@
+"""
+移除類別後的索引一致性（IVF 索引的 remove_ids 不會壓縮內部 ID，需以重建取代）
+"""
+
+import os
+import sys
+import zlib
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from faiss_recognition import FAISSRecognitionEngine  # noqa: E402
+
+N_CLASSES = 6
+PER_CLASS = 60
+DIM = 64
+
+
+def _class_centers():
+    rng = np.random.RandomState(0)
+    centers = rng.randn(N_CLASSES, DIM).astype(np.float32)
+    return centers / np.linalg.norm(centers, axis=1, keepdims=True)
+
+
+def _features_for(paths, centers):
+    """依圖片所在的類別目錄產生類別中心附近的特徵（取代骨幹網路）"""
+    features = np.empty((len(paths), DIM), dtype=np.float32)
+    for i, path in enumerate(paths):
+        class_id = int(os.path.basename(os.path.dirname(path))[1:])
+        noise = np.random.RandomState(zlib.crc32(path.encode('utf-8'))).randn(DIM).astype(np.float32)
+        features[i] = centers[class_id] + 0.05 * noise
+    return features / np.linalg.norm(features, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    for class_id in range(N_CLASSES):
+        class_dir = tmp_path / 'dataset' / f"c{class_id}"
+        class_dir.mkdir(parents=True)
+        for i in range(PER_CLASS):
+            (class_dir / f"{i:03d}.png").write_bytes(b'')
+    return tmp_path
+
+
+def _make_engine(root, index_type, centers, monkeypatch):
+    engine = FAISSRecognitionEngine(feature_cache_dir=None, index_type=index_type,
+                                    index_root=str(root / 'faiss_index'), coarse_classes=0)
+    engine.open_set = False
+    # 不載入骨幹網路：特徵由類別中心產生
+    engine.feature_extractor = object()
+    monkeypatch.setattr(engine, '_extract_paths',
+                        lambda paths, *args, **kwargs: (_features_for(paths, centers), list(range(len(paths)))))
+    return engine
+
+
+def _top1_accuracy(engine, centers):
+    """以各類別中心附近的新查詢檢查最近鄰是否屬於同一類別"""
+    rng = np.random.RandomState(1)
+    correct = total = 0
+    for class_id, class_name in enumerate(engine.classes):
+        center = centers[int(class_name[1:])]
+        queries = center + 0.05 * rng.randn(20, DIM).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        _, indices = engine._search(queries, 1)
+        predicted = engine._class_ids_of(indices[:, 0])
+        correct += int(np.sum(predicted == class_id))
+        total += len(queries)
+    return correct / total
+
+
+@pytest.mark.parametrize('index_type', ['flat', 'ivf_flat', 'ivf_pq', 'hnsw'])
+def test_remove_class_keeps_remaining_predictions(dataset, monkeypatch, index_type):
+    centers = _class_centers()
+    engine = _make_engine(dataset, index_type, centers, monkeypatch)
+    assert engine.build_index(str(dataset / 'dataset'), num_workers=0, shards=1)
+    assert _top1_accuracy(engine, centers) == 1.0
+
+    assert engine.remove_class('c2', save=False)
+    assert 'c2' not in engine.classes
+    assert _top1_accuracy(engine, centers) == 1.0
+
+    engine.save_index()
+    reloaded = _make_engine(dataset, index_type, centers, monkeypatch)
+    assert reloaded.load_index()
+    assert reloaded.classes == engine.classes
+    assert _top1_accuracy(reloaded, centers) == 1.0
+
+    # 重新加入後仍與自身標籤一致
+    assert reloaded.add_class('c2', str(dataset / 'dataset'), save=False)
+    assert _top1_accuracy(reloaded, centers) == 1.0
@@ -0,0 +1,67 @@
+"""
+多個行程共用同一特徵快取命名空間：在 locked() 內 refresh → put → save 時不會互相覆寫列
+"""
+
+import os
+import sys
+import multiprocessing
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from feature_cache import FeatureCache  # noqa: E402
+
+DIM = 8
+BATCHES = 10
+PER_BATCH = 5
+
+
+def _vector(worker, i):
+    return np.full(DIM, worker * 1000 + i, dtype=np.float32)
+
+
+def _key(worker, i):
+    return f"{worker}:{i}".encode('utf-8')
+
+
+def _write(cache_dir, worker):
+    """模擬一個工作行程：每批在跨行程鎖內追加（行程內的記錄在其他行程寫入後已過期）"""
+    cache = FeatureCache('shared', cache_dir)
+    for batch in range(BATCHES):
+        items = range(batch * PER_BATCH, (batch + 1) * PER_BATCH)
+        with cache.locked():
+            cache.refresh()
+            cache.put([_key(worker, i) for i in items], np.stack([_vector(worker, i) for i in items]))
+            cache.save()
+
+
+def test_concurrent_writers_keep_every_row(tmp_path):
+    workers = [multiprocessing.Process(target=_write, args=(str(tmp_path), w)) for w in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+        assert process.exitcode == 0
+
+    cache = FeatureCache('shared', str(tmp_path))
+    assert len(cache) == 4 * BATCHES * PER_BATCH
+    keys = [_key(w, i) for w in range(4) for i in range(BATCHES * PER_BATCH)]
+    rows = cache.find(keys)
+    assert (rows >= 0).all()
+    expected = np.stack([_vector(w, i) for w in range(4) for i in range(BATCHES * PER_BATCH)])
+    np.testing.assert_array_equal(cache.read(rows), expected)
+
+
+def test_refresh_sees_other_writers(tmp_path):
+    reader = FeatureCache('shared', str(tmp_path))
+    writer = FeatureCache('shared', str(tmp_path))
+    assert not reader.refresh()
+    with writer.locked():
+        writer.put([b'a'], np.ones((1, DIM), dtype=np.float32))
+        writer.save()
+
+    assert reader.find([b'a'])[0] == -1
+    assert reader.refresh()
+    np.testing.assert_array_equal(reader.read(reader.find([b'a'])), np.ones((1, DIM)))
+    assert not reader.refresh()
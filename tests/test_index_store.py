@@ -0,0 +1,207 @@
+"""
+版本化索引目錄：原子發布、舊版本清除，以及查詢進行中的熱切換
+"""
+
+import os
+import sys
+import time
+import threading
+import zlib
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index_store import (CURRENT_FILE, RWLock, abort_version, begin_version, current_index_dir,  # noqa: E402
+                         current_version, gc_versions, list_versions, publish)
+from faiss_recognition import FAISSRecognitionEngine  # noqa: E402
+
+DIM = 32
+PER_CLASS = 20
+
+
+def _publish(root, content, keep=3):
+    staging = begin_version(str(root))
+    with open(os.path.join(staging, 'data.txt'), 'w') as f:
+        f.write(content)
+    return publish(staging, str(root), keep=keep)
+
+
+def _set_current(root, version):
+    with open(os.path.join(root, CURRENT_FILE), 'w') as f:
+        f.write(version)
+
+
+def test_publish_switches_current_index_dir(tmp_path):
+    assert current_version(str(tmp_path)) is None
+    assert current_index_dir(str(tmp_path)) == '.'
+
+    first = _publish(tmp_path, 'first')
+    assert current_version(str(tmp_path)) == first
+    second = _publish(tmp_path, 'second')
+    assert second > first
+    with open(os.path.join(current_index_dir(str(tmp_path)), 'data.txt')) as f:
+        assert f.read() == 'second'
+    # 發布後沒有殘留的暫存目錄或指標暫存檔
+    assert sorted(os.listdir(tmp_path)) == sorted([CURRENT_FILE, first, second])
+
+
+def test_abort_leaves_current_version(tmp_path):
+    live = _publish(tmp_path, 'live')
+    staging = begin_version(str(tmp_path))
+    abort_version(staging)
+    assert not os.path.exists(staging)
+    assert current_version(str(tmp_path)) == live
+
+
+def test_gc_keeps_live_version(tmp_path):
+    versions = [_publish(tmp_path, str(i), keep=0) for i in range(4)]
+    assert list_versions(str(tmp_path)) == [versions[-1]]
+
+    versions = [_publish(tmp_path, str(i), keep=10) for i in range(4)]
+    # 回滾到較舊的版本後清除：最新 keep 個與目前版本都保留
+    _set_current(str(tmp_path), versions[0])
+    gc_versions(str(tmp_path), keep=1)
+    assert current_version(str(tmp_path)) == versions[0]
+    assert set(list_versions(str(tmp_path))) == {versions[0], versions[-1]}
+
+
+def test_gc_removes_only_stale_staging(tmp_path):
+    _publish(tmp_path, 'live')
+    stale, fresh = begin_version(str(tmp_path)), begin_version(str(tmp_path))
+    old = time.time() - 7 * 3600
+    os.utime(stale, (old, old))
+    gc_versions(str(tmp_path))
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
+
+
+def test_rwlock_prefers_waiting_writer():
+    lock = RWLock()
+    events = []
+    reader_in, release_reader = threading.Event(), threading.Event()
+
+    def first_reader():
+        with lock.read_lock():
+            reader_in.set()
+            release_reader.wait()
+            events.append('reader-1 done')
+
+    def writer():
+        with lock.write_lock():
+            events.append('writer')
+
+    def second_reader():
+        with lock.read_lock():
+            events.append('reader-2')
+
+    threads = [threading.Thread(target=first_reader, daemon=True)]
+    threads[0].start()
+    reader_in.wait()
+    threads.append(threading.Thread(target=writer, daemon=True))
+    threads[1].start()
+    while not lock._waiting_writers:
+        time.sleep(0.001)
+    threads.append(threading.Thread(target=second_reader, daemon=True))
+    threads[2].start()
+    time.sleep(0.05)
+    # 寫入者等待中：新的讀取者不能插隊
+    assert events == []
+    release_reader.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert events == ['reader-1 done', 'writer', 'reader-2']
+
+
+def _features_for(paths):
+    """依類別目錄產生各類別中心附近的特徵（取代骨幹網路）"""
+    centers = np.random.RandomState(0).randn(8, DIM).astype(np.float32)
+    features = np.empty((len(paths), DIM), dtype=np.float32)
+    for i, path in enumerate(paths):
+        class_id = int(os.path.basename(os.path.dirname(path))[1:])
+        noise = np.random.RandomState(zlib.crc32(path.encode('utf-8'))).randn(DIM).astype(np.float32)
+        features[i] = centers[class_id] + 0.05 * noise
+    return features / np.linalg.norm(features, axis=1, keepdims=True)
+
+
+def _make_engine(root, monkeypatch):
+    engine = FAISSRecognitionEngine(feature_cache_dir=None, index_root=str(root / 'faiss_index'),
+                                    coarse_classes=0)
+    engine.feature_extractor = object()
+    monkeypatch.setattr(engine, '_extract_paths',
+                        lambda paths, *args, **kwargs: (_features_for(paths), list(range(len(paths)))))
+    return engine
+
+
+@pytest.fixture
+def versions(tmp_path, monkeypatch):
+    """兩個已發布的版本：3 個類別與 6 個類別"""
+    published = []
+    for n_classes in (3, 6):
+        dataset = tmp_path / f"dataset{n_classes}"
+        for class_id in range(n_classes):
+            (dataset / f"c{class_id}").mkdir(parents=True)
+            for i in range(PER_CLASS):
+                (dataset / f"c{class_id}" / f"{i:03d}.png").write_bytes(b'')
+        engine = _make_engine(tmp_path, monkeypatch)
+        assert engine.build_index(str(dataset), num_workers=0, shards=1)
+        published.append(str(tmp_path / 'faiss_index' / engine.version))
+    return published
+
+
+def test_load_index_waits_for_running_query(tmp_path, monkeypatch, versions):
+    engine = _make_engine(tmp_path, monkeypatch)
+    assert engine.load_index(versions[0])
+    query_in, finish_query = threading.Event(), threading.Event()
+
+    def query():
+        with engine._state_lock.read_lock():
+            query_in.set()
+            finish_query.wait()
+
+    reader = threading.Thread(target=query, daemon=True)
+    reader.start()
+    query_in.wait()
+    swap = threading.Thread(target=engine.load_index, args=(versions[1],), daemon=True)
+    swap.start()
+    time.sleep(0.1)
+    try:
+        # 新版本已在暫存副本載入，但進行中的查詢結束前不會替換
+        assert len(engine.classes) == 3
+    finally:
+        finish_query.set()
+    reader.join(timeout=5)
+    swap.join(timeout=5)
+    assert len(engine.classes) == 6
+    assert engine.index_dir == versions[1]
+
+
+def test_queries_see_consistent_state_during_swaps(tmp_path, monkeypatch, versions):
+    engine = _make_engine(tmp_path, monkeypatch)
+    assert engine.load_index(versions[0])
+    queries = _features_for([f"/q/c{c}/{i}.png" for c in range(3) for i in range(5)])
+    errors, stop = [], threading.Event()
+
+    def query_loop():
+        while not stop.is_set():
+            try:
+                with engine._state_lock.read_lock():
+                    assert engine.index.ntotal == len(engine.labels) == len(engine.classes) * PER_CLASS
+                    _, indices = engine._search(queries, 3)
+                    class_ids = engine._class_ids_of(indices)
+                    assert ((class_ids >= 0) & (class_ids < len(engine.classes))).all()
+                    assert (class_ids[:, 0] == np.repeat(np.arange(3), 5)).all()
+            except Exception as e:  # 收集後在主執行緒檢查
+                errors.append(e)
+                return
+
+    readers = [threading.Thread(target=query_loop, daemon=True) for _ in range(3)]
+    for reader in readers:
+        reader.start()
+    for i in range(10):
+        assert engine.load_index(versions[(i + 1) % 2])
+    stop.set()
+    for reader in readers:
+        reader.join(timeout=5)
+    assert errors == []
@@ -0,0 +1,131 @@
+"""
+欄位式標籤檔（FLBL）：儲存/載入、記憶體映射、增量修改與 header 統計
+"""
+
+import os
+import sys
+import pickle
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from label_store import LabelStore, read_header, read_label_summary  # noqa: E402
+
+CLASSES = ['ring', '戒指', 'pendant']
+
+
+def _records(store):
+    return [store[row] for row in range(len(store))]
+
+
+@pytest.fixture
+def store():
+    # 非 ASCII 與長度不同的路徑，檢查位移表與對齊
+    return LabelStore.from_columns(
+        list(CLASSES),
+        [0, 0, 1, 2, 2, 2],
+        [0, 1, 2, 5, 6, 7],
+        ['dataset/ring/a.png', 'dataset/ring/bb.png', 'dataset/戒指/正面.jpg',
+         'dataset/pendant/x.png', 'dataset/pendant/yy.png', 'dataset/pendant/zzz.png'])
+
+
+def test_save_load_round_trip(tmp_path, store):
+    path = str(tmp_path / 'labels.bin')
+    store.save(path, next_id=8, class_signatures={'ring': [1, 2]})
+    loaded, meta = LabelStore.load(path)
+
+    assert loaded.classes == CLASSES
+    assert _records(loaded) == _records(store)
+    assert meta == {'next_id': 8, 'class_signatures': {'ring': [1, 2]}}
+    assert loaded.class_counts().tolist() == [2, 1, 3]
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_load_is_memory_mapped(tmp_path, store):
+    path = str(tmp_path / 'labels.bin')
+    store.save(path)
+    loaded, _ = LabelStore.load(path)
+    for column in (loaded.class_ids, loaded.vector_ids, loaded.path_offsets, loaded.path_blob):
+        assert isinstance(column, np.memmap)
+        assert not column.flags.writeable
+    assert loaded.vector_ids.ctypes.data % 8 == 0
+    assert loaded.path_offsets.ctypes.data % 8 == 0
+
+
+def test_empty_store_round_trip(tmp_path):
+    path = str(tmp_path / 'labels.bin')
+    LabelStore(['only']).save(path)
+    loaded, meta = LabelStore.load(path)
+    assert len(loaded) == 0
+    assert loaded.classes == ['only']
+    assert loaded.class_counts().tolist() == [0]
+    assert meta == {}
+
+
+def test_extend_and_remove_class_on_loaded_store(tmp_path, store):
+    path = str(tmp_path / 'labels.bin')
+    store.save(path)
+    loaded, _ = LabelStore.load(path)
+
+    loaded.classes.append('鍊子')
+    loaded.extend(3, [8, 9], ['dataset/鍊子/1.png', 'dataset/鍊子/22.png'])
+    assert loaded[6] == {'class_id': 3, 'class_name': '鍊子', 'image_path': 'dataset/鍊子/1.png', 'vector_id': 8}
+
+    loaded.remove_class(1)
+    assert loaded.classes == ['ring', 'pendant', '鍊子']
+    assert loaded.class_ids.tolist() == [0, 0, 1, 1, 1, 2, 2]
+    assert loaded.vector_ids.tolist() == [0, 1, 5, 6, 7, 8, 9]
+    assert [loaded.image_path(row) for row in range(len(loaded))] == [
+        'dataset/ring/a.png', 'dataset/ring/bb.png', 'dataset/pendant/x.png', 'dataset/pendant/yy.png',
+        'dataset/pendant/zzz.png', 'dataset/鍊子/1.png', 'dataset/鍊子/22.png']
+
+    # 覆寫仍被映射中的檔案後重新載入
+    expected = _records(loaded)
+    loaded.save(path)
+    reloaded, _ = LabelStore.load(path)
+    assert _records(reloaded) == expected
+
+
+def test_remove_class_shares_caller_class_list(store):
+    classes = store.classes
+    store.remove_class(0)
+    assert classes == ['戒指', 'pendant']
+    assert store.class_ids.tolist() == [0, 1, 1, 1]
+
+
+def test_from_records_matches_legacy_labels(store):
+    records = _records(store)
+    assert _records(LabelStore.from_records(records, list(CLASSES))) == records
+    # 沒有 vector_id 的舊標籤以列索引作為 ID
+    legacy = [{k: v for k, v in r.items() if k != 'vector_id'} for r in records]
+    assert LabelStore.from_records(legacy, list(CLASSES)).vector_ids.tolist() == list(range(len(records)))
+
+
+def test_read_label_summary(tmp_path, store):
+    path, legacy = str(tmp_path / 'labels.bin'), str(tmp_path / 'labels.pkl')
+    assert read_label_summary(path, legacy) is None
+
+    with open(legacy, 'wb') as f:
+        pickle.dump({'classes': list(CLASSES), 'labels': _records(store), 'next_id': 8}, f)
+    summary = read_label_summary(path, legacy)
+    assert summary == {'classes': CLASSES, 'class_counts': [2, 1, 3], 'num_vectors': 6,
+                       'meta': {'next_id': 8}, 'path': legacy}
+
+    # 新格式優先，只讀 header
+    store.save(path, next_id=8)
+    summary = read_label_summary(path, legacy)
+    assert summary == {'classes': CLASSES, 'class_counts': [2, 1, 3], 'num_vectors': 6,
+                       'meta': {'next_id': 8}, 'path': path}
+    assert read_header(path)['num_vectors'] == 6
+
+
+def test_rejects_other_files(tmp_path):
+    path = str(tmp_path / 'labels.bin')
+    with open(path, 'wb') as f:
+        f.write(b'NOPE' + b'\0' * 16)
+    with pytest.raises(ValueError):
+        LabelStore.load(path)
+    with pytest.raises(ValueError):
+        read_header(path)
@@ -0,0 +1,93 @@
+"""
+開放集合拒識：門檻以同類別相似度為準，不屬於任何類別的查詢應被拒識
+"""
+
+import os
+import sys
+import zlib
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from faiss_recognition import REJECT_MARGIN, FAISSRecognitionEngine, _class_threshold  # noqa: E402
+
+N_CLASSES = 8
+N_UNKNOWN = 4
+PER_CLASS = 40
+DIM = 64
+NOISE = 0.05
+
+
+def _centers():
+    """已知類別與未知物件的中心（隨機方向，彼此相似度約 0 ± 0.3）"""
+    rng = np.random.RandomState(0)
+    centers = rng.randn(N_CLASSES + N_UNKNOWN, DIM).astype(np.float32)
+    return centers / np.linalg.norm(centers, axis=1, keepdims=True)
+
+
+def _around(center, n, seed):
+    points = center + NOISE * np.random.RandomState(seed).randn(n, DIM).astype(np.float32)
+    return points / np.linalg.norm(points, axis=1, keepdims=True)
+
+
+def _features_for(paths, centers):
+    features = np.empty((len(paths), DIM), dtype=np.float32)
+    for i, path in enumerate(paths):
+        class_id = int(os.path.basename(os.path.dirname(path))[1:])
+        features[i] = _around(centers[class_id], 1, zlib.crc32(path.encode('utf-8')))[0]
+    return features
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    for class_id in range(N_CLASSES):
+        class_dir = tmp_path / 'dataset' / f"c{class_id}"
+        class_dir.mkdir(parents=True)
+        for i in range(PER_CLASS):
+            (class_dir / f"{i:03d}.png").write_bytes(b'')
+    centers = _centers()
+    engine = FAISSRecognitionEngine(feature_cache_dir=None, index_type='flat',
+                                    index_root=str(tmp_path / 'faiss_index'), coarse_classes=0)
+    engine.open_set = True
+    engine.feature_extractor = object()
+    monkeypatch.setattr(engine, '_extract_paths',
+                        lambda paths, *args, **kwargs: (_features_for(paths, centers), list(range(len(paths)))))
+    engine.dataset_dir = str(tmp_path / 'dataset')
+    engine.centers = centers
+    return engine
+
+
+def _accept_rates(engine, class_ids, seed):
+    accepted = [engine._open_set_check(_around(engine.centers[c], 20, seed + c))[0] for c in class_ids]
+    return float(np.mean(np.concatenate(accepted)))
+
+
+def test_threshold_is_not_lowered_by_nearby_classes():
+    genuine = np.full(16, 0.9)
+    assert _class_threshold(genuine, np.full(16, 0.3)) >= 0.9 - REJECT_MARGIN
+    assert _class_threshold(genuine, np.full(16, 0.95)) == pytest.approx(0.9 - REJECT_MARGIN)
+    assert _class_threshold([], np.full(16, 0.3)) == pytest.approx(0.3 - REJECT_MARGIN)
+    assert _class_threshold([], []) == float('-inf')
+
+
+def test_rejects_out_of_set_clusters(engine):
+    assert engine.build_index(engine.dataset_dir, num_workers=0, shards=1)
+    assert engine.build_report['open_set']['unknown_reject_rate'] == 1.0
+    assert _accept_rates(engine, range(N_CLASSES), seed=100) == 1.0
+    assert _accept_rates(engine, range(N_CLASSES, N_CLASSES + N_UNKNOWN), seed=200) == 0.0
+
+
+def test_incremental_changes_recalibrate_thresholds(engine):
+    assert engine.build_index(engine.dataset_dir, num_workers=0, shards=1)
+    built = engine.class_thresholds.copy()
+
+    assert engine.remove_class('c3', save=False)
+    assert engine.add_class('c3', engine.dataset_dir, save=False)
+    assert len(engine.class_thresholds) == N_CLASSES
+    assert np.isfinite(engine.class_thresholds).all()
+    # 重新加入的類別與建立時的門檻一致（class_id 移到最後）
+    assert engine.class_thresholds[-1] == pytest.approx(built[3], abs=0.05)
+    assert _accept_rates(engine, range(N_CLASSES), seed=100) == 1.0
+    assert _accept_rates(engine, range(N_CLASSES, N_CLASSES + N_UNKNOWN), seed=200) == 0.0
@@ -24,10 +24,15 @@ import json
 import time
 import random
 import psutil
+from label_store import read_label_summary, LABELS_FILE, LEGACY_LABELS_FILE
+from index_store import current_index_dir
 
 # 導入 FAISS 識別引擎
 try:
-    from faiss_recognition import predict_with_faiss, initialize_faiss
+    from faiss_recognition import predict_with_faiss, predict_with_faiss_batch, initialize_faiss, faiss_batcher, \
+        start_index_watcher, faiss_engine
+    from confusability import generate_report, load_report, loo_evaluation, CONFUSION_NEIGHBOURS, \
+        EVAL_EXCLUDE_VIEWS
     FAISS_AVAILABLE = True
     print("✅ FAISS 識別引擎可用")
 except ImportError as e:
@@ -238,6 +243,14 @@ class DataManager:
 data_manager = DataManager()
 model_manager = DataManager()  # 保持相容性，雖然不使用
 
+def faiss_artifact_paths():
+    """目前發布版本的 (索引檔, 標籤檔) 路徑"""
+    index_dir = current_index_dir()
+    labels_path = os.path.join(index_dir, LABELS_FILE)
+    if not os.path.exists(labels_path):
+        labels_path = os.path.join(index_dir, LEGACY_LABELS_FILE)
+    return Path(index_dir) / 'faiss_features.index', Path(labels_path)
+
 def load_model():
     """載入模型 - 使用 FAISS 識別引擎"""
     global model, model_loaded, model_info
@@ -248,6 +261,8 @@ def load_model():
         # 初始化 FAISS
         try:
             initialize_faiss()
+            # 訓練發布新索引版本後自動熱切換
+            start_index_watcher()
             model_loaded = True
             model_info = {
                 'method': 'FAISS',
@@ -266,6 +281,15 @@ def predict_with_faiss_wrapper(image_path):
     """FAISS 預測包裝函數，統一輸出格式"""
     try:
         result = predict_with_faiss(image_path)
+    except Exception as e:
+        result = e
+    return format_faiss_result(result)
+
+def format_faiss_result(result):
+    """將 FAISS 原始預測結果轉換為網頁輸出格式（result 為例外時回傳錯誤）"""
+    try:
+        if isinstance(result, Exception):
+            raise result
         if not result:
             return {
                 'predictions': [],
@@ -276,6 +300,18 @@ def predict_with_faiss_wrapper(image_path):
                 'method': 'FAISS'
             }
 
+        if result.get('no_match'):
+            # 不屬於任何已建模類別：不複製參考圖片、不查找 STL
+            return {
+                'predictions': [],
+                'no_match': True,
+                'best_match': result.get('best_match'),
+                'inference_time': result['inference_time'],
+                'result_image': None,
+                'success': True,
+                'method': 'FAISS'
+            }
+
         # 轉換格式使其與 FAISS 結果一致
         formatted_predictions = []
         detailed_results = result.get('detailed_results', [])
@@ -347,6 +383,7 @@ def predict_with_faiss_wrapper(image_path):
 
         return {
             'predictions': formatted_predictions,
+            'no_match': False,
             'inference_time': result['inference_time'],
             'result_image': None,  # FAISS 不產生標註圖片
             'success': True,
@@ -379,6 +416,19 @@ def predict_image(image_path, method='FAISS'):
 
     return predict_with_faiss_wrapper(image_path)
 
+def predict_images(image_paths):
+    """批次預測多張圖片（一次前向傳播），回傳與 image_paths 對應的結果列表"""
+    if not FAISS_AVAILABLE:
+        return [predict_image(path) for path in image_paths]
+    if not image_paths:
+        return []
+
+    try:
+        raw_results = predict_with_faiss_batch(image_paths)
+    except Exception as e:
+        raw_results = [e] * len(image_paths)
+    return [format_faiss_result(result) for result in raw_results]
+
 def get_dataset_samples():
     """取得數據集樣本"""
     samples = []
@@ -556,7 +606,8 @@ def model_status():
     """獲取模型狀態"""
     return jsonify({
         'loaded': model_loaded,
-        'info': model_info if model_loaded else {}
+        'info': model_info if model_loaded else {},
+        'batcher': faiss_batcher.stats() if FAISS_AVAILABLE else {}
     })
 
 @app.route('/api/upload', methods=['POST'])
@@ -577,6 +628,7 @@ def upload_file():
     # 允許的圖片格式
     allowed_image_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
 
+    pending = []  # (results 位置, 上傳檔案, 儲存檔名, 儲存路徑, 上傳記錄 ID)
     for i, file in enumerate(files):
         # 檢查是否為圖片檔案
         if not file.filename.lower().endswith(allowed_image_extensions):
@@ -587,94 +639,99 @@ def upload_file():
             })
             continue
 
-        if file and file.filename.lower().endswith(allowed_image_extensions):
-            filename = safe_filename(file.filename)
-            unique_filename = f"{timestamp}_{i:03d}_{filename}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(filepath)
-
-            file_size = os.path.getsize(filepath)
-
-            # 記錄上傳
-            upload_id = data_manager.add_upload_record(
-                filename=file.filename,
-                file_size=file_size,
-                file_path=filepath,
-                client_ip=client_ip,
-                user_agent=user_agent
-            )
+        filename = safe_filename(file.filename)
+        unique_filename = f"{timestamp}_{i:03d}_{filename}"
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+        file.save(filepath)
 
-            # 進行預測（使用選定的方法）
-            result = predict_image(filepath, method=recognition_method)
-
-            if result and result.get('success'):
-                # 記錄辨識結果
-                predictions = result.get('predictions', [])
-                if predictions:
-                    pred = predictions[0]  # 取第一個預測結果
-                    data_manager.add_recognition_record(
-                        upload_id=upload_id,
-                        method=recognition_method,
-                        predicted_class=pred.get('class_name'),
-                        confidence=pred.get('confidence'),
-                        inference_time=result.get('inference_time'),
-                        result_image_path=result.get('result_image'),
-                        success=True
-                    )
-                else:
-                    data_manager.add_recognition_record(
-                        upload_id=upload_id,
-                        method=recognition_method,
-                        success=False,
-                        error_message='未偵測到物件'
-                    )
+        file_size = os.path.getsize(filepath)
 
-                # 扁平化結果以匹配前端格式
-                predictions = result.get('predictions', [])
-                top_prediction = predictions[0] if predictions else None
-
-                result_data = {
-                    'original_filename': file.filename,
-                    'saved_filename': unique_filename,
-                    'original_image_url': f"/static/uploads/{unique_filename}",
-                    'success': True,
-                    'method': result.get('method', 'FAISS'),
-                    'inference_time': result.get('inference_time', 0)
-                }
+        # 記錄上傳
+        upload_id = data_manager.add_upload_record(
+            filename=file.filename,
+            file_size=file_size,
+            file_path=filepath,
+            client_ip=client_ip,
+            user_agent=user_agent
+        )
+
+        pending.append((len(results), file, unique_filename, filepath, upload_id))
+        results.append(None)
+
+    # 所有圖片一次批次預測
+    batch_results = predict_images([item[3] for item in pending])
 
-                # 添加預測結果
-                if top_prediction:
-                    result_data['class_id'] = top_prediction.get('class_id', -1)
-                    result_data['class_name'] = top_prediction.get('class_name', 'Unknown')
-                    result_data['confidence'] = top_prediction.get('confidence', 0)
-                    result_data['top_k'] = predictions[:5]  # Top 5 結果
-                    result_data['reference_images'] = top_prediction.get('reference_images', [])
-                    result_data['stl_file'] = top_prediction.get('stl_file')
-                    result_data['stl_preview'] = top_prediction.get('stl_preview')
-
-                results.append(result_data)
+    for (position, file, unique_filename, filepath, upload_id), result in zip(pending, batch_results):
+        if result and result.get('success'):
+            # 記錄辨識結果
+            predictions = result.get('predictions', [])
+            if predictions:
+                pred = predictions[0]  # 取第一個預測結果
+                data_manager.add_recognition_record(
+                    upload_id=upload_id,
+                    method=recognition_method,
+                    predicted_class=pred.get('class_name'),
+                    confidence=pred.get('confidence'),
+                    inference_time=result.get('inference_time'),
+                    result_image_path=result.get('result_image'),
+                    success=True
+                )
             else:
-                # 記錄失敗的辨識
-                error_msg = result.get('error', '預測失敗') if result else '預測失敗'
                 data_manager.add_recognition_record(
                     upload_id=upload_id,
                     method=recognition_method,
                     success=False,
-                    error_message=error_msg
+                    error_message='無相符模型' if result.get('no_match') else '未偵測到物件'
                 )
 
-                results.append({
-                    'original_filename': file.filename,
-                    'saved_filename': unique_filename,
-                    'error': error_msg,
-                    'success': False
-                })
+            # 扁平化結果以匹配前端格式
+            predictions = result.get('predictions', [])
+            top_prediction = predictions[0] if predictions else None
+
+            result_data = {
+                'original_filename': file.filename,
+                'saved_filename': unique_filename,
+                'original_image_url': f"/static/uploads/{unique_filename}",
+                'success': True,
+                'method': result.get('method', 'FAISS'),
+                'inference_time': result.get('inference_time', 0)
+            }
+
+            # 添加預測結果
+            if top_prediction:
+                result_data['class_id'] = top_prediction.get('class_id', -1)
+                result_data['class_name'] = top_prediction.get('class_name', 'Unknown')
+                result_data['confidence'] = top_prediction.get('confidence', 0)
+                result_data['top_k'] = predictions[:5]  # Top 5 結果
+                result_data['reference_images'] = top_prediction.get('reference_images', [])
+                result_data['stl_file'] = top_prediction.get('stl_file')
+                result_data['stl_preview'] = top_prediction.get('stl_preview')
+            elif result.get('no_match'):
+                # 與所有已建模類別都不夠相似
+                best_match = result.get('best_match') or {}
+                result_data['no_match'] = True
+                result_data['class_id'] = -1
+                result_data['class_name'] = '無相符模型'
+                result_data['confidence'] = best_match.get('similarity', 0)
+                result_data['best_match'] = best_match or None
+
+            results[position] = result_data
         else:
-            results.append({
-                'original_filename': file.filename if file else 'unknown',
-                'error': '不支援的檔案格式',
+            # 記錄失敗的辨識
+            error_msg = result.get('error', '預測失敗') if result else '預測失敗'
+            data_manager.add_recognition_record(
+                upload_id=upload_id,
+                method=recognition_method,
+                success=False,
+                error_message=error_msg
+            )
+
+            results[position] = {
+                'original_filename': file.filename,
+                'saved_filename': unique_filename,
+                'error': error_msg,
                 'success': False
-            })
+            }
 
     # 計算成功率
     successful = len([r for r in results if r['success']])
@@ -796,74 +853,29 @@ def performance_test():
 
 @app.route('/api/batch_test')
 def batch_test():
-    """批次測試"""
+    """
+    批次測試：以索引中已儲存的向量對整個資料集做留一法評估
+
+    每個向量排除自身（exclude_views 參數可再排除同類別前後相鄰的視角）後以一次批次搜尋預測，
+    不重新解碼或提取特徵。回傳各類別準確率、top-k 準確率與稀疏混淆矩陣。
+    """
     # FAISS 系統不需要檢查 model_loaded，因為它始終可用
     if not FAISS_AVAILABLE:
         return jsonify({'success': False, 'error': 'FAISS 引擎不可用'})
 
     try:
-        # 使用 dataset 資料夾（原始數據集）
-        dataset_dir = "dataset"
-        if not os.path.exists(dataset_dir):
-            return jsonify({'success': False, 'error': f'資料集目錄 {dataset_dir} 不存在'})
-
-        classes = [d for d in os.listdir(dataset_dir)
-                   if os.path.isdir(os.path.join(dataset_dir, d))]
-
-        if not classes:
-            return jsonify({'success': False, 'error': '資料集中沒有找到任何類別'})
-
-        results = {}
-        total_correct = 0
-        total_tested = 0
-
-        for class_name in classes:
-            class_dir = os.path.join(dataset_dir, class_name)
-            # 支援 .jpg 和 .png 格式
-            images = [f for f in os.listdir(class_dir) if f.lower().endswith(('.jpg', '.png'))]
-
-            if not images:
-                continue
-
-            # 隨機選擇10張圖片測試
-            test_images = random.sample(images, min(10, len(images)))
-
-            correct = 0
-            for img_name in test_images:
-                img_path = os.path.join(class_dir, img_name)
-
-                # 使用 FAISS 進行預測
-                try:
-                    result = predict_with_faiss(img_path)
-                    if result and 'predictions' in result and result['predictions']:
-                        predicted_class = result['predictions'][0]['class_name']
-                        if predicted_class == class_name:
-                            correct += 1
-                except Exception as pred_error:
-                    print(f"預測失敗: {img_path}, 錯誤: {pred_error}")
-                    continue
-
-                total_tested += 1
-
-            accuracy = correct / len(test_images) if test_images else 0
-            total_correct += correct
-
-            results[class_name] = {
-                'correct': correct,
-                'total': len(test_images),
-                'accuracy': round(accuracy * 100, 1)
-            }
-
-        overall_accuracy = total_correct / total_tested if total_tested > 0 else 0
+        if not faiss_engine.loaded and not initialize_faiss():
+            return jsonify({'success': False, 'error': 'FAISS 索引未建立'})
+        if faiss_engine.index is None or faiss_engine.index.ntotal < 2:
+            return jsonify({'success': False, 'error': '索引中的向量不足，無法評估'})
 
+        exclude_views = request.args.get('exclude_views', EVAL_EXCLUDE_VIEWS, type=int)
+        evaluation = loo_evaluation(faiss_engine, exclude_views=max(0, exclude_views))
         return jsonify({
             'success': True,
-            'results': results,
-            'overall_accuracy': round(overall_accuracy * 100, 1),
-            'accuracy': round(overall_accuracy * 100, 1),
-            'map50': round(overall_accuracy * 100, 1),  # 簡化處理，實際使用時應計算真正的 mAP50
-            'total_correct': total_correct,
-            'total_tested': total_tested
+            **evaluation,
+            'accuracy': evaluation['overall_accuracy'],
+            'map50': evaluation['overall_accuracy'],  # 舊版前端欄位，等同 top-1 準確率
         })
 
     except Exception as e:
@@ -1044,6 +1056,28 @@ def get_system_info():
     except Exception as e:
         return {'error': str(e)}
 
+@app.route('/api/confusability', methods=['GET', 'POST'])
+def confusability():
+    """類別混淆報告：GET 讀取上次的報告，POST 以目前索引重新計算（不重新提取特徵）"""
+    if not FAISS_AVAILABLE:
+        return jsonify({'success': False, 'error': 'FAISS 識別引擎不可用'})
+    try:
+        if request.method == 'POST':
+            options = request.get_json(silent=True) or {}
+            report = generate_report(faiss_engine, k=int(options.get('k', CONFUSION_NEIGHBOURS)))
+        else:
+            report = load_report()
+        if report is None:
+            return jsonify({'success': False, 'error': '尚未產生混淆報告' if request.method == 'GET' else '索引不存在'})
+
+        # 報告對應的索引版本已被取代時提示重新計算
+        current = os.path.basename(current_index_dir())
+        return jsonify({'success': True, 'report': report, 'stale': report.get('version') != current})
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)})
+
 @app.route('/api/system_status')
 def system_status():
     """系統狀態API"""
@@ -1301,19 +1335,19 @@ def start_training():
 
                     # 檢查 FAISS 訓練的模型數量
                     try:
-                        import pickle
                         import datetime
 
-                        if os.path.exists('faiss_labels.pkl'):
-                            with open('faiss_labels.pkl', 'rb') as f:
-                                faiss_data = pickle.load(f)
-                                trained_classes = len(faiss_data.get('classes', []))
-                                total_features = len(faiss_data.get('labels', []))
+                        faiss_index_path, faiss_labels_path = faiss_artifact_paths()
+                        faiss_data = read_label_summary(str(faiss_labels_path))
+                        if faiss_data:
+                            trained_classes = len(faiss_data['classes'])
+                            total_features = faiss_data['num_vectors']
+                            index_type = faiss_data['meta'].get('index_config', {}).get('type', 'flat')
 
                             # 獲取索引文件大小
                             index_size = 0
-                            if os.path.exists('faiss_features.index'):
-                                index_size = os.path.getsize('faiss_features.index') / (1024 * 1024)  # MB
+                            if faiss_index_path.exists():
+                                index_size = faiss_index_path.stat().st_size / (1024 * 1024)  # MB
 
                             add_log('📦 資料集統計：')
                             add_log(f'   └─ STL 模型數量: {stl_count} 個')
@@ -1325,7 +1359,19 @@ def start_training():
                             add_log(f'   └─ 訓練類別數: {trained_classes} 個')
                             add_log(f'   └─ 特徵向量數: {total_features} 個')
                             add_log(f'   └─ 索引檔案大小: {index_size:.2f} MB')
-                            add_log(f'   └─ 索引類型: IndexFlatIP (內積相似度)')
+                            add_log(f'   └─ 索引類型: {index_type} (內積相似度)')
+                            backbone = faiss_data['meta'].get('backbone') or {'name': 'resnet50', 'dim': 2048}
+                            add_log(f"   └─ 骨幹網路: {backbone['name']} ({backbone['dim']} 維)")
+                            pca_report = faiss_data['meta'].get('build_report', {}).get('pca')
+                            if pca_report:
+                                add_log(f"   └─ PCA 白化降維: {pca_report['input_dim']} → {pca_report['output_dim']} 維")
+                                add_log(f"   └─ LOO top-1 準確率: 降維前 {pca_report['loo_top1_before']:.1%} → "
+                                        f"降維後 {pca_report['loo_top1_after']:.1%}")
+                            open_set_report = faiss_data['meta'].get('build_report', {}).get('open_set')
+                            if open_set_report and open_set_report.get('known_accept_rate') is not None:
+                                unknown_rate = open_set_report.get('unknown_reject_rate')
+                                add_log(f"   └─ 未知物件拒識: 已知類別接受率 {open_set_report['known_accept_rate']:.1%}"
+                                        + (f"，未知物件拒識率 {unknown_rate:.1%}" if unknown_rate is not None else ''))
                             add_log('')
 
                             # 檢查完整性
@@ -1403,7 +1449,7 @@ def start_training():
                                     rf.write(f'訓練類別數: {trained_classes} 個\n')
                                     rf.write(f'特徵向量數: {total_features} 個\n')
                                     rf.write(f'索引檔案大小: {index_size:.2f} MB\n')
-                                    rf.write(f'索引類型: IndexFlatIP (內積相似度)\n\n')
+                                    rf.write(f'索引類型: {index_type} (內積相似度)\n\n')
 
                                     rf.write('━' * 60 + '\n')
                                     rf.write('✅ 訓練完整性檢查\n')
@@ -1672,33 +1718,21 @@ def list_models():
         models = []
 
         # 檢查 FAISS 模型檔案
-        faiss_index_path = Path('faiss_features.index')
-        faiss_labels_path = Path('faiss_labels.pkl')
+        faiss_index_path, faiss_labels_path = faiss_artifact_paths()
 
         if faiss_index_path.exists() and faiss_labels_path.exists():
-            import pickle
-
             # 獲取檔案信息
             index_stat = faiss_index_path.stat()
             labels_stat = faiss_labels_path.stat()
             total_size = index_stat.st_size + labels_stat.st_size
 
-            # 讀取標籤獲取類別信息
+            # 只讀取標籤檔 header 獲取類別信息
             try:
-                with open(faiss_labels_path, 'rb') as f:
-                    labels_data = pickle.load(f)
-                    # labels_data 是字典，包含 'labels' 和 'classes' 鍵
-                    if isinstance(labels_data, dict):
-                        class_names = labels_data.get('classes', [])
-                        label_array = labels_data.get('labels', [])
-                        num_classes = len(class_names)
-                        num_features = len(label_array)
-                    else:
-                        # 如果是舊格式（list）
-                        num_classes = len(set(labels_data))
-                        num_features = len(labels_data)
-                        class_names = sorted(set(labels_data))
-            except:
+                labels_data = read_label_summary(str(faiss_labels_path))
+                class_names = labels_data['classes']
+                num_classes = len(class_names)
+                num_features = labels_data['num_vectors']
+            except Exception:
                 num_classes = 0
                 num_features = 0
                 class_names = []
@@ -2526,11 +2560,8 @@ def settings_page():
 def get_models():
     """獲取模型列表（兼容舊版 API）- FAISS 版本"""
     try:
-        import pickle
-
         # 檢查 FAISS 模型檔案
-        faiss_index_path = Path('faiss_features.index')
-        faiss_labels_path = Path('faiss_labels.pkl')
+        faiss_index_path, faiss_labels_path = faiss_artifact_paths()
 
         current_model = None
         available_models = []
@@ -2542,20 +2573,13 @@ def get_models():
             total_size = index_stat.st_size + labels_stat.st_size
             size_mb = total_size / (1024 * 1024)
 
-            # 讀取標籤獲取類別信息
+            # 只讀取標籤檔 header 獲取類別信息
             try:
-                with open(faiss_labels_path, 'rb') as f:
-                    labels_data = pickle.load(f)
-                    if isinstance(labels_data, dict):
-                        class_names = labels_data.get('classes', [])
-                        label_array = labels_data.get('labels', [])
-                        num_classes = len(class_names)
-                        num_features = len(label_array)
-                    else:
-                        num_classes = len(set(labels_data))
-                        num_features = len(labels_data)
-                        class_names = sorted(set(labels_data))
-            except:
+                labels_data = read_label_summary(str(faiss_labels_path))
+                class_names = labels_data['classes']
+                num_classes = len(class_names)
+                num_features = labels_data['num_vectors']
+            except Exception:
                 num_classes = 0
                 num_features = 0
                 class_names = []